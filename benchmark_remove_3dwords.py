@@ -0,0 +1,86 @@
+# ==============================================================================
+# Benchmark remove_caption_3Dwords.py.
+#
+# The old path loaded the full spaCy pipeline and built the matcher for every
+# caption; the new path loads a tokenizer-only pipeline once and streams
+# captions through nlp.pipe. Reports captions/sec of both and checks that
+# they produce identical outputs. Captions come from a caption CSV (uid,
+# caption) or are generated from templates.
+#
+# python benchmark_remove_3dwords.py --input_csv caption.csv --num_captions 20000 --n_process 4
+# ==============================================================================
+
+import argparse
+import csv
+import itertools
+import random
+import time
+
+import spacy
+from spacy.matcher import Matcher
+
+from remove_caption_3Dwords import (SPACY_MODEL, pattern1, pattern2, pattern3, prepare_text,
+                                    remove_3d_phrases_batch, remove_3d_phrases_doc)
+
+PREFIXES = ['A 3D model of ', 'a white 3D rendering of ', '3D object: ', '"3D-printed ', '', 'A ']
+OBJECTS = ['a wooden chair', 'red sports car', "a knight's helmet", 'a blue vase with floral patterns', 'small house with a chimney']
+MIDDLES = ['', ' with a 3D model of a lamp', ' and a 3D-rendered tree', ' featuring golden trim']
+SUFFIXES = ['.', ' in 3D.', ' in a 3D rendering.', ' (3D model).', ', 3D printed.']
+
+
+def template_captions(num_captions, seed=0):
+    rng = random.Random(seed)
+    return [rng.choice(PREFIXES) + rng.choice(OBJECTS) + rng.choice(MIDDLES) + rng.choice(SUFFIXES) for _ in range(num_captions)]
+
+
+def csv_captions(path, num_captions):
+    with open(path, newline='') as f:
+        rows = (row[1] for row in csv.reader(f) if len(row) > 1 and ('3D' in row[1] or '3d' in row[1]))
+        return list(itertools.islice(rows, num_captions))
+
+
+def legacy_remove_3d_phrases(text, model):
+    # what remove_3d_phrases did per caption before the pipeline was shared
+    text = prepare_text(text)
+    nlp = spacy.load(model)
+    matcher = Matcher(nlp.vocab)
+    matcher.add("PRE_PATTERN1", [pattern1])
+    matcher.add("MID_PATTERN", [pattern2])
+    matcher.add("END_PATTERN", [pattern3])
+    return remove_3d_phrases_doc(text, nlp(text), nlp, matcher)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--input_csv', type = str, default = 'none', help = 'caption CSV, none to use template captions')
+    parser.add_argument('--num_captions', type = int, default = 10000)
+    parser.add_argument('--num_legacy', type = int, default = 50, help = 'captions to run through the old per-caption path')
+    parser.add_argument('--batch_size', type = int, default = 1000)
+    parser.add_argument('--n_process', type = int, default = 1)
+    parser.add_argument('--spacy_model', type = str, default = SPACY_MODEL)
+    args = parser.parse_args()
+
+    if args.input_csv != 'none':
+        captions = csv_captions(args.input_csv, args.num_captions)
+    else:
+        captions = template_captions(args.num_captions)
+
+    start = time.time()
+    legacy = [legacy_remove_3d_phrases(text, args.spacy_model) for text in captions[:args.num_legacy]]
+    legacy_rate = len(legacy) / (time.time() - start)
+    print('per-caption load: %.1f captions/s (%d captions)' % (legacy_rate, len(legacy)))
+
+    start = time.time()
+    outputs = list(remove_3d_phrases_batch(captions, batch_size=args.batch_size, n_process=args.n_process, model=args.spacy_model))
+    rate = len(outputs) / (time.time() - start)
+    print('shared pipeline, nlp.pipe x %d: %.1f captions/s (%d captions, incl. load), %.0fx'
+          % (args.n_process, rate, len(outputs), rate / legacy_rate))
+
+    mismatches = [(text, a, b) for text, a, b in zip(captions, legacy, outputs) if a != b]
+    for text, a, b in mismatches[:5]:
+        print('mismatch: %r -> %r vs %r' % (text, a, b))
+    print('outputs identical: %s' % (not mismatches))
+
+
+if __name__ == '__main__':
+    main()
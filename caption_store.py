@@ -0,0 +1,106 @@
+# ==============================================================================
+# A resumable per-view caption store for captioning_images.py.
+#
+# Captions are kept in one SQLite database (WAL mode, so several captioning
+# processes can share it) keyed by (uid, view). Every batch of views is
+# committed as soon as it is captioned, so an interrupted run only redoes
+# the views that were in flight, instead of whole objects.
+#
+# Bulk export, either into one pickle {uid: {view: [5 captions]}} or into
+# the per-folder caption.pkl files that DiffuRank reads:
+# python caption_store.py --store ./example_material/captions.sqlite --out captions.pkl
+# python caption_store.py --store ./example_material/captions.sqlite --parent_dir ./example_material
+# ==============================================================================
+import argparse
+import json
+import os
+import pickle
+import sqlite3
+
+
+class CaptionStore:
+    def __init__(self, path, timeout=60.0):
+        self.path = path
+        self.conn = sqlite3.connect(path, timeout=timeout)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.conn.execute(
+            'CREATE TABLE IF NOT EXISTS captions ('
+            'uid TEXT NOT NULL, view INTEGER NOT NULL, captions TEXT NOT NULL, '
+            'PRIMARY KEY (uid, view))'
+        )
+        self.conn.commit()
+
+    def put_many(self, rows):
+        """
+        Store an iterable of (uid, view, captions) in one transaction.
+        """
+        with self.conn:
+            self.conn.executemany(
+                'INSERT OR REPLACE INTO captions (uid, view, captions) VALUES (?, ?, ?)',
+                ((uid, int(view), json.dumps(list(captions))) for uid, view, captions in rows),
+            )
+
+    def views(self, uid):
+        return set(view for (view,) in self.conn.execute('SELECT view FROM captions WHERE uid = ?', (uid,)))
+
+    def missing_views(self, uid, num_views=28):
+        done = self.views(uid)
+        return [view for view in range(num_views) if view not in done]
+
+    def get(self, uid):
+        """
+        Return the captions of one object in the caption.pkl layout, a dict
+        from view to a list of captions.
+        """
+        rows = self.conn.execute('SELECT view, captions FROM captions WHERE uid = ? ORDER BY view', (uid,))
+        return {view: json.loads(captions) for view, captions in rows}
+
+    def uids(self):
+        return [uid for (uid,) in self.conn.execute('SELECT DISTINCT uid FROM captions ORDER BY uid')]
+
+    def items(self):
+        """
+        Stream (uid, {view: captions}) for all objects in uid order.
+        """
+        uid, captions = None, {}
+        for row_uid, view, row_captions in self.conn.execute('SELECT uid, view, captions FROM captions ORDER BY uid, view'):
+            if row_uid != uid:
+                if uid is not None:
+                    yield uid, captions
+                uid, captions = row_uid, {}
+            captions[view] = json.loads(row_captions)
+        if uid is not None:
+            yield uid, captions
+
+    def close(self):
+        self.conn.close()
+
+
+def write_caption_pkl(folder, captions):
+    path = os.path.join(folder, 'caption.pkl')
+    with open(path + '.tmp', 'wb') as f:
+        pickle.dump(captions, f)
+    os.replace(path + '.tmp', path)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--store', type = str, required=True)
+    parser.add_argument('--out', type = str, default='none', help = 'write all captions into one pickle')
+    parser.add_argument('--parent_dir', type = str, default='none', help = 'write caption.pkl into parent_dir/Cap3D_imgs/{uid}')
+    parser.add_argument('--num_views', type = int, default = 28, help = 'only export objects with this many captioned views to caption.pkl')
+    args = parser.parse_args()
+
+    store = CaptionStore(args.store)
+    if args.out != 'none':
+        with open(args.out, 'wb') as f:
+            pickle.dump(dict(store.items()), f)
+    if args.parent_dir != 'none':
+        count = 0
+        for uid, captions in store.items():
+            folder = os.path.join(args.parent_dir, 'Cap3D_imgs', uid)
+            if len(captions) == args.num_views and os.path.isdir(folder):
+                write_caption_pkl(folder, captions)
+                count += 1
+        print('wrote %d caption.pkl files' % count)
@@ -0,0 +1,145 @@
+# ==============================================================================
+# Captioner backends for captioning_images.py.
+#
+# A backend preprocesses single views, captions batches of views, and can be
+# warmed up before timing. LavisBLIP2Captioner wraps the BLIP2 model used for
+# Cap3D; StubCaptioner returns deterministic fake captions after a
+# configurable delay, so the captioning pipeline (batching, prefetching,
+# resuming) can be run and benchmarked without a GPU or model weights.
+# ==============================================================================
+import hashlib
+import time
+from abc import ABC, abstractmethod
+
+import torch
+
+
+class StagingBuffer:
+    """
+    A reusable pinned host buffer, so that batches are copied to the device
+    asynchronously instead of through pageable memory.
+    """
+    def __init__(self, device):
+        self.device = torch.device(device)
+        self.buffer = None
+
+    def stage(self, images):
+        if self.device.type != 'cuda':
+            return torch.stack(images)
+        shape = (len(images),) + tuple(images[0].shape)
+        if self.buffer is None or self.buffer.shape[0] < shape[0] or self.buffer.shape[1:] != shape[1:]:
+            self.buffer = torch.empty(shape, dtype=images[0].dtype).pin_memory()
+        out = self.buffer[:len(images)]
+        torch.stack(images, out=out)
+        return out.to(self.device, non_blocking=True)
+
+
+class Captioner(ABC):
+    """
+    A captioning backend. Subclasses implement preprocess() and generate();
+    caption_views() maps views to their captions on top of them.
+    """
+    num_captions = 5
+
+    def __init__(self, device='cpu'):
+        self.device = torch.device(device)
+        self.staging = StagingBuffer(self.device)
+
+    @abstractmethod
+    def preprocess(self, image):
+        """
+        Turn one RGB PIL image into a [3 x H x W] tensor. Called from
+        prefetching threads, so it must not touch the model.
+        """
+
+    @abstractmethod
+    def generate(self, images, use_qa=False):
+        """
+        Caption a [B x 3 x H x W] batch of views on self.device, and return B
+        lists of self.num_captions captions.
+        """
+
+    def warmup(self):
+        """
+        Run the model once, so that one-time costs (kernel selection, lazy
+        allocations) are not attributed to the first batch.
+        """
+
+    def caption_views(self, views, use_qa=False):
+        """
+        Caption a list of (key, image) pairs, and return a dict from key to
+        captions. If the batch fails, the views are retried one by one, and
+        views that still fail are skipped.
+        """
+        images = self.staging.stage([image for _, image in views])
+        try:
+            outputs = self.generate(images, use_qa=use_qa)
+        except Exception:
+            if len(views) == 1:
+                return {}
+            results = {}
+            for view in views:
+                results.update(self.caption_views([view], use_qa=use_qa))
+            return results
+        return {key: captions for (key, _), captions in zip(views, outputs)}
+
+
+class LavisBLIP2Captioner(Captioner):
+    def __init__(self, model_type='pretrain_flant5xxl', device='cpu'):
+        super().__init__(device)
+        # Lazy import, so that other backends work without LAVIS installed.
+        from lavis.models import load_model_and_preprocess
+        self.model, vis_processors, _ = load_model_and_preprocess(name='blip2_t5', model_type=model_type, is_eval=True, device=self.device)
+        self.vis_processor = vis_processors["eval"]
+
+    def preprocess(self, image):
+        return self.vis_processor(image)
+
+    def generate(self, images, use_qa=False):
+        num_captions = self.num_captions
+        if use_qa:
+            prompt = "Question: what object is in this image? Answer:"
+            objects = self.model.generate({"image": images, "prompt": prompt})
+            prompts = ["Question: what is the structure and geometry of this %s?" % object for object in objects]
+            x = self.model.generate({"image": images, "prompt": prompts}, use_nucleus_sampling=True, num_captions=num_captions)
+        else:
+            x = self.model.generate({"image": images}, use_nucleus_sampling=True, num_captions=num_captions)
+        # generate returns the captions of every image next to each other
+        return [[z for z in x[i*num_captions:(i+1)*num_captions]] for i in range(len(images))]
+
+    def warmup(self):
+        from PIL import Image
+        image = self.preprocess(Image.new('RGB', (512, 512), (255, 255, 255)))
+        self.generate(image[None].to(self.device))
+
+
+class StubCaptioner(Captioner):
+    """
+    Deterministic fake captions derived from the image content, returned
+    after latency + latency_per_image * batch_size seconds.
+    """
+    def __init__(self, latency=0.0, latency_per_image=0.0, image_size=224, device='cpu'):
+        super().__init__(device)
+        self.latency = latency
+        self.latency_per_image = latency_per_image
+        self.image_size = image_size
+
+    def preprocess(self, image):
+        image = image.resize((self.image_size, self.image_size))
+        return torch.frombuffer(bytearray(image.tobytes()), dtype=torch.uint8).reshape(self.image_size, self.image_size, 3).permute(2, 0, 1)
+
+    def generate(self, images, use_qa=False):
+        time.sleep(self.latency + self.latency_per_image * len(images))
+        outputs = []
+        for image in images:
+            digest = hashlib.sha1(image.cpu().numpy().tobytes()).hexdigest()[:8]
+            outputs.append(['a stub caption %d of image %s' % (i, digest) for i in range(self.num_captions)])
+        return outputs
+
+
+def get_captioner(name, args, device):
+    if name == 'blip2':
+        return LavisBLIP2Captioner(model_type=args.model_type, device=device)
+    elif name == 'stub':
+        return StubCaptioner(latency=args.stub_latency, latency_per_image=args.stub_latency_per_image, device=device)
+    raise ValueError('unknown captioner backend: %s' % name)
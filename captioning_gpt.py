@@ -4,8 +4,9 @@
 #
 # This code is licensed under the MIT License.
 # ==============================================================================
-import base64
-import requests
+import time
+import collections
+from concurrent.futures import ThreadPoolExecutor
 import openai
 import os
 import pickle
@@ -15,52 +16,81 @@ import pandas as pd
 import glob
 import argparse
 from IPython import embed
-
-# Function to encode the image
-def encode_image(image_path):
-  with open(image_path, "rb") as image_file:
-    return base64.b64encode(image_file.read()).decode('utf-8')
+from shap_e.util.score_store import ScoreStore
+from shap_e.util.view_store import ViewStore, list_objects
+from gpt_client import OPENAI_CHAT_URL, ChatClient
+from view_encoding import FORMATS, encode_view_data, parse_background, read_views
+from gpt_cache import ResponseCache, ResumeIndex, request_key
+from gpt_batch import BatchWriter, read_batch_results
 
 parser = argparse.ArgumentParser(description="Process API key and CSV file path.")
 parser.add_argument('--api_key', type=str, required=True, help="Your OpenAI API Key.")
 parser.add_argument('--csv_file', type=str, default='./caption.csv', help="Path to the output CSV file.")
 parser.add_argument("--parent_dir", type = str, default='./example_material/Cap3D_imgs')
+parser.add_argument("--api_url", type = str, default=OPENAI_CHAT_URL, help="chat completions endpoint, e.g. of mock_openai_server.py")
+parser.add_argument("--concurrency", type = int, default = 8, help="requests in flight")
+parser.add_argument("--max_retries", type = int, default = 6, help="retries of 429s, 5xx and connection errors")
+parser.add_argument("--rpm", type = int, default = 500, help="requests per minute budget")
+parser.add_argument("--tpm", type = int, default = 200000, help="tokens per minute budget")
+parser.add_argument("--ordered", action="store_true", help="write CSV rows in object order instead of completion order")
+parser.add_argument("--image_format", type = str, default='jpeg', choices=FORMATS, help="how views are encoded, raw sends the rendered PNGs unchanged")
+parser.add_argument("--image_quality", type = int, default = 90, help="JPEG/WebP quality")
+parser.add_argument("--image_size", type = int, default = 512, help="downscale views to at most this size, 0 keeps the rendered size")
+parser.add_argument("--background", type = str, default='white', help="white, black, gray or r,g,b to composite transparent pixels onto")
+parser.add_argument("--mosaic", action="store_true", help="send the views tiled into a single image")
+parser.add_argument("--encode_workers", type = int, default = 4, help="threads encoding views ahead of the requests")
+parser.add_argument("--cache_dir", type = str, default='./gpt_cache', help="content-addressed cache of responses, or none")
+parser.add_argument("--flush_every_rows", type = int, default = 50, help="make the CSV and resume index durable after this many rows")
+parser.add_argument("--flush_every_seconds", type = float, default = 30.0, help="... or after this many seconds, whichever comes first")
+parser.add_argument("--batch_dir", type = str, default='none', help="write Batch API request files here instead of sending requests")
+parser.add_argument("--batch_max_requests", type = int, default = 50000, help="requests per batch file")
+parser.add_argument("--batch_max_mb", type = float, default = 190, help="size of a batch file in MB")
+parser.add_argument("--ingest", type = str, default='none', help="glob of Batch API output/error files to add to the CSV")
+parser.add_argument("--score_store", type = str, default='./example_material/diffurank_scores', help="DiffuRank score store, or none to read diffurank_scores.pkl per folder")
+parser.add_argument("--view_store", type = str, default='auto', help="read views packed by pack_renders.py, auto uses Cap3D_packed next to parent_dir if it exists, none reads the object folders")
 args = parser.parse_args()
 
 api_key = args.api_key
 csv_file = args.csv_file
 
-output_csv = open(csv_file, 'a')
+# objects whose caption in the CSV came from the same request are skipped
+resume = ResumeIndex(csv_file)
+cache = ResponseCache(args.cache_dir) if args.cache_dir != 'none' else None
+
+output_csv = open(csv_file, 'a+', newline='')
+if output_csv.tell() > 0:
+    # terminate a row torn by an interrupted run, its object is redone
+    output_csv.seek(output_csv.tell() - 1)
+    if output_csv.read(1) != '\n':
+        output_csv.write('\n')
 writer = csv.writer(output_csv)
 
-paths = glob.glob(os.path.join(args.parent_dir, '*'))
+if args.view_store == 'auto':
+    args.view_store = os.path.join(os.path.dirname(os.path.normpath(args.parent_dir)), 'Cap3D_packed')
+    if not os.path.isdir(args.view_store):
+        args.view_store = 'none'
+view_store = ViewStore(args.view_store) if args.view_store != 'none' else None
+
+if args.ingest != 'none':
+    # the results carry their uids, views are not needed
+    paths, top_views = [], None
+elif args.score_store != 'none' and os.path.isdir(args.score_store):
+    # in DiffuRank, we send the top-6 views after ranking with DiffuRank,
+    # selected for all objects at once from the consolidated score store
+    uids, top_views = ScoreStore(args.score_store).top_k(6)
+    paths = [os.path.join(args.parent_dir, uid) for uid in uids]
+elif view_store is not None:
+    # packed objects and the folders rendered since the last pack
+    paths = [os.path.join(args.parent_dir, uid) for uid in list_objects(args.parent_dir, view_store)]
+    top_views = None
+else:
+    paths = glob.glob(os.path.join(args.parent_dir, '*'))
+    top_views = None
+# (uid, error) of the objects that could not be captioned
 wrong_or_none_files = []
 captions = {}
-for index, path in enumerate(paths):
-    uid = path.split('/')[-1]
-    image_paths = []
-    # insert your image_path
-    # in DiffuRank, we send the top-6 views after ranking with DiffuRank
-    diffurank_scores = pickle.load(open(os.path.join(path, 'diffurank_scores.pkl'), 'rb'))
-    ranks = np.argsort(diffurank_scores)
 
-    for i in range(6):
-        image_paths.append(os.path.join(path, '%05d.png'%ranks[i]))
-
-    base64_images = []
-    try:
-        for p in image_paths:
-            base64_images.append(encode_image(p))
-    except:
-        wrong_or_none_files.append(u)
-        print('image enconding error')
-        continue
-    
-    headers = {
-      "Content-Type": "application/json",
-      "Authorization": f"Bearer {api_key}"
-    }
-    
+def build_payload(image_urls):
     payload = {
       # GPT-4o-mini is much cheaper than GPT-4o, 
       # DiffuRank captions are generated by GPT-4o
@@ -79,31 +109,166 @@ for index, path in enumerate(paths):
       ],
       "max_tokens": 300
     }
-    for i in range(len(base64_images)):
+    for i in range(len(image_urls)):
         payload['messages'][0]['content'].append( {
        "type": "image_url",
        "image_url": {
-         "url": f"data:image/jpeg;base64,{base64_images[i]}"
+         "url": image_urls[i]
        }
      }
     )
-    
-    try:
-        response = requests.post("https://api.openai.com/v1/chat/completions", headers=headers, json=payload)
-    except:
-        continue
-    try:
-        r = response.json()
-    except:
-        continue
-    captions[uid] = r
-    try:
-        cur_caption = r['choices'][0]['message']['content']
-    except:
-        continue
-    writer.writerow([uid, cur_caption])
-    print(index, uid, cur_caption)
-    if (index)% 100 == 0:
-        output_csv.flush()
-        os.fsync(output_csv.fileno())
-output_csv.close()
+    return payload
+
+def select_views(index, path):
+    image_paths = []
+    # insert your image_path
+    # in DiffuRank, we send the top-6 views after ranking with DiffuRank
+    if top_views is not None:
+        ranks = top_views[index]
+    else:
+        diffurank_scores = pickle.load(open(os.path.join(path, 'diffurank_scores.pkl'), 'rb'))
+        ranks = np.argsort(diffurank_scores)
+
+    for i in range(6):
+        image_paths.append(os.path.join(path, '%05d.png'%ranks[i]))
+    return image_paths
+
+encode_options = dict(
+    fmt=args.image_format, quality=args.image_quality, size=args.image_size,
+    background=parse_background(args.background), mosaic=args.mosaic,
+)
+num_skipped = 0
+
+def prepare(index, path, uid):
+    """
+    Read the selected views of one object and key the request on them.
+    Returns None if the object is already captioned from the same request,
+    and no payload if the response is cached, so nothing is encoded.
+    """
+    image_paths = select_views(index, path)
+    if view_store is not None and uid in view_store:
+        # one open of the object's container instead of a file per view
+        raw = view_store.read(uid, [os.path.basename(image_path) for image_path in image_paths])
+    else:
+        raw = read_views(image_paths)
+    key = request_key(build_payload([]), encode_options, raw)
+    if resume.is_done(uid, key):
+        return None
+    if cache is not None and cache.get(key) is not None:
+        return key, None, 0, 0
+    image_urls, raw_bytes, encoded_bytes = encode_view_data(raw, **encode_options)
+    return key, build_payload(image_urls), raw_bytes, encoded_bytes
+
+def jobs():
+    """
+    Lazily yield ((index, uid, key, raw bytes, encoded bytes), payload, key)
+    for every object that needs a caption. Views are read and encoded in a
+    thread pool, a bounded number of objects ahead of the requests.
+    """
+    with ThreadPoolExecutor(args.encode_workers) as executor:
+        pending = collections.deque()
+        def finish():
+            global num_skipped
+            index, uid, future = pending.popleft()
+            try:
+                job = future.result()
+            except Exception:
+                wrong_or_none_files.append((uid, 'image encoding error'))
+                print('image enconding error', uid)
+                return
+            if job is None:
+                num_skipped += 1
+                return
+            key, payload, raw_bytes, encoded_bytes = job
+            yield (index, uid, key, raw_bytes, encoded_bytes), payload, key
+        for index, path in enumerate(paths):
+            uid = path.split('/')[-1]
+            pending.append((index, uid, executor.submit(prepare, index, path, uid)))
+            if len(pending) > 2 * args.concurrency:
+                yield from finish()
+        while pending:
+            yield from finish()
+
+client = ChatClient(
+    api_key, url=args.api_url, concurrency=args.concurrency, max_retries=args.max_retries,
+    requests_per_minute=args.rpm, tokens_per_minute=args.tpm, cache=cache,
+)
+
+def batch_build():
+    """
+    Write every request into batch files; cached responses are written to
+    the CSV right away.
+    """
+    with BatchWriter(args.batch_dir, max_requests=args.batch_max_requests, max_bytes=int(args.batch_max_mb * 2**20)) as batch:
+        for info, payload, key in jobs():
+            if payload is None:
+                yield info, cache.get(key)
+            else:
+                batch.add(info[1], key, payload)
+    for path, num_requests, num_bytes in batch.shards:
+        print('%s: %d requests, %.1fMB' % (path, num_requests, num_bytes / 2**20))
+
+def batch_ingest():
+    """
+    Add the results of finished batches to the CSV. Results already in the
+    CSV are skipped, so files can be ingested again as more batches finish.
+    """
+    global num_skipped
+    for uid, key, r, error in read_batch_results(sorted(glob.glob(args.ingest))):
+        if error is not None:
+            wrong_or_none_files.append((uid, error))
+            print('batch error', uid, error)
+        elif resume.is_done(uid, key):
+            num_skipped += 1
+        else:
+            if cache is not None:
+                cache.put(key, r)
+            yield ('-', uid, key, 0, 0), r
+
+if args.ingest != 'none':
+    results = batch_ingest()
+elif args.batch_dir != 'none':
+    results = batch_build()
+else:
+    results = client.map(jobs(), ordered=args.ordered)
+
+def flush():
+    # the index only ever points at rows that are already on disk
+    output_csv.flush()
+    os.fsync(output_csv.fileno())
+    resume.flush()
+
+start_time = time.time()
+last_flush, unflushed = time.time(), 0
+num_written = 0
+raw_total, encoded_total = 0, 0
+try:
+    for (index, uid, key, raw_bytes, encoded_bytes), r in results:
+        raw_total += raw_bytes
+        encoded_total += encoded_bytes
+        if r is None:
+            r = {'error': 'no response', 'status_code': None}
+        captions[uid] = r
+        try:
+            cur_caption = r['choices'][0]['message']['content']
+        except (KeyError, IndexError, TypeError):
+            # requests that failed for good, or responses without a caption
+            error = (r.get('status_code'), r.get('error', 'no caption in the response'))
+            wrong_or_none_files.append((uid, error))
+            print('request error', uid, *error)
+            continue
+        writer.writerow([uid, cur_caption])
+        resume.add(uid, key)
+        num_written += 1
+        unflushed += 1
+        print(index, uid, cur_caption, '(images %.0fKB -> %.0fKB)' % (raw_bytes / 1024, encoded_bytes / 1024))
+        if unflushed >= args.flush_every_rows or time.time() - last_flush >= args.flush_every_seconds:
+            flush()
+            last_flush, unflushed = time.time(), 0
+finally:
+    flush()
+    output_csv.close()
+elapsed = time.time() - start_time
+print('%d objects already captioned, %d failed' % (num_skipped, len(wrong_or_none_files)))
+print('images: %.1fMB -> %.1fMB, %.1fMB saved' % (raw_total / 2**20, encoded_total / 2**20, (raw_total - encoded_total) / 2**20))
+print('%d captions in %.1fs (%.2f/s), %s' % (num_written, elapsed, num_written / max(elapsed, 1e-6), dict(client.stats)))
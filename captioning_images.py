@@ -1,6 +1,7 @@
 import torch
 from PIL import Image
-from lavis.models import load_model_and_preprocess
+from captioners import get_captioner
+from caption_store import CaptionStore, write_caption_pkl
 import glob
 import pickle as pkl
 from tqdm import tqdm
@@ -8,7 +9,10 @@ import os
 import argparse
 import random
 import pickle
+import io
 import time
+import collections
+from concurrent.futures import ThreadPoolExecutor
 from PIL import Image
 import numpy as np
 from IPython import embed
@@ -18,8 +22,81 @@ def parse_args():
     parser.add_argument("--parent_dir", type = str, default='./example_material')
     parser.add_argument("--model_type", type = str, default='pretrain_flant5xxl', choices=['pretrain_flant5xxl', 'pretrain_flant5xl'])
     parser.add_argument("--use_qa", action="store_true")
+    parser.add_argument("--backend", type = str, default='blip2', choices=['blip2', 'stub'], help = 'stub returns fake captions, to benchmark the pipeline without a model')
+    parser.add_argument("--stub_latency", type = float, default = 0.0, help = 'seconds per generate call of the stub backend')
+    parser.add_argument("--stub_latency_per_image", type = float, default = 0.0, help = 'additional seconds per view of the stub backend')
+    parser.add_argument("--max_batch", type = int, default = 28, help = 'max views (possibly of several objects) per generate call')
+    parser.add_argument("--decode_workers", type = int, default = 4, help = 'threads decoding and preprocessing views ahead of the model')
+    parser.add_argument("--caption_store", type = str, default='auto', help = 'SQLite file keeping captions per view for resuming, auto for parent_dir/captions.sqlite, or none')
+    parser.add_argument("--prefetch_objects", type = int, default = 8, help = 'max objects decoded ahead, bounds host memory')
+    parser.add_argument("--view_store", type = str, default='auto', help = 'read views packed by pack_renders.py, auto uses parent_dir/Cap3D_packed if it exists, none reads the object folders')
     return parser.parse_args()
 
+def load_views(folder, preprocess, view_ids=range(28), view_store=None):
+    """
+    Decode and preprocess the given views of one object, skipping unreadable
+    files. Views of objects in the view store are read from their container,
+    those of objects that are not packed yet from their folder.
+    """
+    views = []
+    packed = None
+    if view_store is not None and folder.split('/')[-1] in view_store:
+        try:
+            packed = view_store.open(folder.split('/')[-1])
+        except:
+            print("container not work skipping", folder)
+            return views
+    for j in view_ids:
+        filename = os.path.join(folder, '%05d.png'%j)
+        try:
+            if packed is not None:
+                raw_image = Image.open(io.BytesIO(packed.read('%05d.png'%j))).convert("RGB")
+            else:
+                raw_image = Image.open(filename).convert("RGB")
+        except:
+            print("file not work skipping", filename)
+            continue
+        views.append((j, preprocess(raw_image)))
+    if packed is not None:
+        packed.close()
+    return views
+
+class ViewPrefetcher:
+    """
+    Decode and preprocess the views of upcoming objects in a thread pool
+    while the model captions the current batch. At most max_objects objects
+    are in flight, which bounds host memory. stall_time counts how long the
+    consumer waited for decoding.
+    """
+    def __init__(self, objects, preprocess, num_workers=4, max_objects=8, view_store=None):
+        """
+        :param objects: an iterable of (folder, view ids to load).
+        """
+        self.objects = iter(objects)
+        self.preprocess = preprocess
+        self.view_store = view_store
+        self.num_workers = num_workers
+        self.max_objects = max_objects
+        self.stall_time = 0.0
+
+    def __iter__(self):
+        with ThreadPoolExecutor(self.num_workers) as executor:
+            futures = collections.deque()
+            def submit():
+                item = next(self.objects, None)
+                if item is not None:
+                    folder, view_ids = item
+                    futures.append((folder, executor.submit(load_views, folder, self.preprocess, view_ids, self.view_store)))
+            for _ in range(self.max_objects):
+                submit()
+            while futures:
+                folder, future = futures.popleft()
+                start = time.time()
+                views = future.result()
+                self.stall_time += time.time() - start
+                submit()
+                yield folder, views
+
 def main():
     args = parse_args()
 
@@ -28,49 +105,105 @@ def main():
 
     all_output = {}
 
-    name = 'blip2_t5'
-    model_type = args.model_type
-
-    infolder = glob.glob(os.path.join(args.parent_dir, 'Cap3D_imgs', '*'))
+    if args.view_store == 'auto':
+        args.view_store = os.path.join(args.parent_dir, 'Cap3D_packed')
+        if not os.path.isdir(args.view_store):
+            args.view_store = 'none'
+    if args.view_store != 'none':
+        # packed objects come from the store's index, their folders only hold
+        # caption.pkl; folders rendered since the last pack are listed as well
+        from shap_e.util.view_store import ViewStore, list_objects
+        view_store = ViewStore(args.view_store)
+        infolder = [os.path.join(args.parent_dir, 'Cap3D_imgs', uid) for uid in list_objects(os.path.join(args.parent_dir, 'Cap3D_imgs'), view_store)]
+    else:
+        view_store = None
+        infolder = glob.glob(os.path.join(args.parent_dir, 'Cap3D_imgs', '*'))
     random.shuffle(infolder)
     
-    model, vis_processors, _ = load_model_and_preprocess(name=name, model_type=model_type, is_eval=True, device=device)
+    if args.caption_store == 'auto':
+        args.caption_store = os.path.join(args.parent_dir, 'captions.sqlite')
+    store = CaptionStore(args.caption_store) if args.caption_store != 'none' else None
+
+    captioner = get_captioner(args.backend, args, device)
+    captioner.warmup()
     ct = 0
         
     count = 0
-    for folder in tqdm(infolder):
-        if not os.path.exists(folder):
+    # views of one or more objects waiting to be captioned together
+    batch = []
+    captions = {}
+    remaining = {}
+
+    model_time = 0.0
+
+    def flush(views):
+        nonlocal model_time
+        start = time.time()
+        outputs = captioner.caption_views(views, use_qa=args.use_qa)
+        model_time += time.time() - start
+        for (folder, j), x in outputs.items():
+            captions[folder][j] = x
+        if store is not None:
+            # commit every batch, so an interrupted run only redoes views in flight
+            store.put_many((folder.split('/')[-1], j, x) for (folder, j), x in outputs.items())
+        for (folder, _), _ in views:
+            remaining[folder] -= 1
+            if remaining[folder] == 0:
+                finish(folder)
+
+    def finish(folder):
+        nonlocal count
+        count += 1
+        print(count, folder)
+        folder_captions = captions.pop(folder)
+        del remaining[folder]
+        missing = [j for j in range(28) if j not in folder_captions]
+        if missing:
+            # DiffuRank needs all views, and a caption.pkl would stop reruns
+            # from retrying the views that were unreadable or failed
+            print('views %s not captioned, caption.pkl not written:' % missing, folder)
+            return
+        os.makedirs(folder, exist_ok=True)
+        write_caption_pkl(folder, folder_captions)
+
+    todo = []
+    for folder in infolder:
+        if view_store is None and not os.path.exists(folder):
             continue
+        uid = folder.split('/')[-1]
         if os.path.exists(os.path.join(folder,'caption.pkl')):
-            continue
-        captions = {}
-        for j in range(28):
-            filename = os.path.join(folder, '%05d.png'%j)
+            if store is None or not store.missing_views(uid):
+                continue
+            # captioned without the store, e.g. by an older run. Import its
+            # captions instead of sampling new ones, as DiffuRank scores
+            # may have been computed from them.
             try:
-                raw_image = Image.open(filename).convert("RGB")
+                with open(os.path.join(folder,'caption.pkl'), 'rb') as f:
+                    legacy = pickle.load(f)
             except:
-                print("file not work skipping", filename)
+                print("caption.pkl not work recaptioning", folder)
+                legacy = {}
+            store.put_many((uid, j, x) for j, x in legacy.items())
+            if not store.missing_views(uid):
                 continue
+        # resume: only views missing from the store are captioned again
+        captions[folder] = store.get(uid) if store is not None else {}
+        todo.append((folder, [j for j in range(28) if j not in captions[folder]]))
+    prefetcher = ViewPrefetcher(todo, captioner.preprocess, num_workers=args.decode_workers, max_objects=args.prefetch_objects, view_store=view_store)
+    for folder, views in tqdm(prefetcher, total=len(todo)):
+        remaining[folder] = len(views)
+        for j, image in views:
+            batch.append(((folder, j), image))
 
-            image = vis_processors["eval"](raw_image).unsqueeze(0).to(device)
+        if remaining[folder] == 0:
+            finish(folder)
+        while len(batch) >= args.max_batch:
+            flush(batch[:args.max_batch])
+            batch = batch[args.max_batch:]
 
-            if args.use_qa:
-                prompt = "Question: what object is in this image? Answer:"
-                object = model.generate({"image": image, "prompt": prompt})[0]
-                full_prompt = "Question: what is the structure and geometry of this %s?" % object
-                x = model.generate({"image": image, "prompt": full_prompt}, use_nucleus_sampling=True, num_captions=5)
-            else:
-                try:
-                    x = model.generate({"image": image}, use_nucleus_sampling=True, num_captions=5)
-                except:
-                    continue
-
-            captions[j] = [z for z in x]
-
-        count += 1
-        print(count, folder)
-        with open(os.path.join(folder,'caption.pkl'),'wb') as f:
-            pickle.dump(captions, f)
+    if len(batch):
+        flush(batch)
+    print('decode stall: %.1fs, model: %.1fs' % (prefetcher.stall_time, model_time))
             
 if __name__ == "__main__":
     main()
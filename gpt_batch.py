@@ -0,0 +1,108 @@
+# ==============================================================================
+# Offline captioning through the Batch API, used by captioning_gpt.py.
+#
+# BatchWriter streams requests into sharded JSONL files bounded in requests
+# and bytes, ready to be uploaded with purpose "batch". read_batch_results()
+# streams the output and error files of finished batches back as
+# (uid, key, response, error), skipping torn lines. Each request's
+# custom_id is "uid/key", so results can be joined back to the uid and to
+# the request key of gpt_cache.py.
+#
+# python captioning_gpt.py --api_key x --batch_dir ./gpt_batches
+# ... submit ./gpt_batches/batch_*.jsonl, download the output/error files ...
+# python captioning_gpt.py --api_key x --ingest './gpt_batches/results/*.jsonl'
+# ==============================================================================
+import glob
+import json
+import os
+
+BATCH_ENDPOINT = '/v1/chat/completions'
+
+
+def custom_id(uid, key):
+    return '%s/%s' % (uid, key)
+
+
+def parse_custom_id(value):
+    uid, _, key = value.rpartition('/')
+    return uid, key
+
+
+class BatchWriter:
+    """
+    Write batch requests into batch_dir/batch_{NNNNN}.jsonl, starting a new
+    shard before one would exceed max_requests lines or max_bytes bytes.
+    Shards are written under a .tmp name and renamed when complete, so a
+    shard that exists is always safe to submit. Numbering continues after
+    the shards already in batch_dir.
+    """
+    def __init__(self, batch_dir, max_requests=50000, max_bytes=190 * 2**20):
+        self.batch_dir = batch_dir
+        self.max_requests = max_requests
+        self.max_bytes = max_bytes
+        os.makedirs(batch_dir, exist_ok=True)
+        existing = glob.glob(os.path.join(batch_dir, 'batch_*.jsonl'))
+        self.shard = max([int(os.path.basename(path)[6:11]) for path in existing], default=-1) + 1
+        self.file = None
+        self.num_requests = 0
+        self.num_bytes = 0
+        self.shards = []
+
+    def path(self, shard):
+        return os.path.join(self.batch_dir, 'batch_%05d.jsonl' % shard)
+
+    def add(self, uid, key, payload):
+        line = json.dumps({
+            'custom_id': custom_id(uid, key), 'method': 'POST', 'url': BATCH_ENDPOINT, 'body': payload,
+        }).encode('utf-8') + b'\n'
+        if self.file is not None and (self.num_requests >= self.max_requests or self.num_bytes + len(line) > self.max_bytes):
+            self.close_shard()
+        if self.file is None:
+            self.file = open(self.path(self.shard) + '.tmp', 'wb')
+        self.file.write(line)
+        self.num_requests += 1
+        self.num_bytes += len(line)
+
+    def close_shard(self):
+        self.file.close()
+        os.replace(self.path(self.shard) + '.tmp', self.path(self.shard))
+        self.shards.append((self.path(self.shard), self.num_requests, self.num_bytes))
+        self.shard += 1
+        self.file = None
+        self.num_requests, self.num_bytes = 0, 0
+
+    def close(self):
+        if self.file is not None:
+            self.close_shard()
+        return self.shards
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        self.close()
+
+
+def read_batch_results(paths):
+    """
+    Stream (uid, key, response, error) from batch output and error files.
+    response is the chat completion body of a successful request, otherwise
+    None and error describes the failure. Lines that are not valid JSON
+    (e.g. a truncated download) yield (None, None, None, error).
+    """
+    for path in paths:
+        with open(path, 'rb') as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                try:
+                    result = json.loads(line)
+                    uid, key = parse_custom_id(result['custom_id'])
+                except (ValueError, KeyError, TypeError):
+                    yield None, None, None, 'unreadable line in %s' % path
+                    continue
+                response = result.get('response') or {}
+                if result.get('error') or response.get('status_code') != 200:
+                    yield uid, key, None, result.get('error') or response.get('body') or 'no response'
+                    continue
+                yield uid, key, response.get('body'), None
@@ -0,0 +1,96 @@
+# ==============================================================================
+# Resume and response caching for captioning_gpt.py.
+#
+# Every request is identified by a content-addressed key: a hash of the model,
+# prompt and request settings, the view encoding options, and the bytes of the
+# selected views. ResumeIndex remembers which key produced each uid's caption
+# in the output CSV, so a rerun only sends requests for new objects or objects
+# whose selected views changed. ResponseCache keeps every successful response
+# under its key, so a request is never paid for twice.
+# ==============================================================================
+import csv
+import hashlib
+import json
+import os
+
+
+def request_key(payload, encode_options, images):
+    """
+    :param payload: the request payload without images.
+    :param encode_options: the keyword arguments of encode_view_data().
+    :param images: the bytes of the selected view files.
+    """
+    header = json.dumps([payload, encode_options], sort_keys=True)
+    digest = hashlib.sha256(header.encode('utf-8'))
+    for data in images:
+        digest.update(hashlib.sha256(data).digest())
+    return digest.hexdigest()
+
+
+class ResponseCache:
+    def __init__(self, root):
+        self.root = root
+        os.makedirs(root, exist_ok=True)
+
+    def path(self, key):
+        return os.path.join(self.root, key[:2], key + '.json')
+
+    def get(self, key):
+        try:
+            with open(self.path(key), 'r') as f:
+                return json.load(f)
+        except (FileNotFoundError, ValueError):
+            return None
+
+    def put(self, key, response):
+        path = self.path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = '%s.tmp.%d' % (path, os.getpid())
+        with open(tmp_path, 'w') as f:
+            json.dump(response, f)
+        os.replace(tmp_path, path)
+
+
+class ResumeIndex:
+    """
+    Maps uids in the output CSV to the request key of their caption. The
+    index is appended to only after the CSV has been fsynced, so every uid in
+    it has a complete CSV row. If there is no index yet (output of older
+    runs), every uid in the CSV counts as done.
+    """
+    def __init__(self, csv_file):
+        self.path = csv_file + '.index'
+        self.done = {}
+        self.pending = []
+        if os.path.exists(self.path):
+            with open(self.path, 'rb') as f:
+                data = f.read()
+            if not data.endswith(b'\n'):
+                # cut off the torn last line of an interrupted run, so the
+                # next flush does not append to it
+                data = data[:data.rfind(b'\n') + 1]
+                os.truncate(self.path, len(data))
+            for line in data.decode('utf-8').splitlines():
+                entry = json.loads(line)
+                self.done[entry['uid']] = entry['key']
+        elif os.path.exists(csv_file):
+            with open(csv_file, 'r', newline='') as f:
+                for row in csv.reader(f):
+                    if row:
+                        self.done[row[0]] = None
+
+    def is_done(self, uid, key):
+        return uid in self.done and self.done[uid] in (None, key)
+
+    def add(self, uid, key):
+        self.done[uid] = key
+        self.pending.append(json.dumps({'uid': uid, 'key': key}))
+
+    def flush(self):
+        if not self.pending:
+            return
+        with open(self.path, 'a') as f:
+            f.write(''.join(line + '\n' for line in self.pending))
+            f.flush()
+            os.fsync(f.fileno())
+        self.pending = []
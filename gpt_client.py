@@ -0,0 +1,252 @@
+# ==============================================================================
+# A concurrent client for the chat completions API, used by captioning_gpt.py.
+#
+# Requests run in a thread pool over one keep-alive session. A shared budget
+# limits requests and tokens per minute, and follows the x-ratelimit-* and
+# retry-after headers of the server, so that workers slow down before they
+# run into 429s. Failed requests are retried with exponential backoff and
+# full jitter.
+#
+# It can be tried against mock_openai_server.py, e.g.
+# python mock_openai_server.py --port 8000 --latency 0.5 --p429 0.1
+# python captioning_gpt.py --api_key x --api_url http://127.0.0.1:8000/v1/chat/completions
+# ==============================================================================
+import collections
+import random
+import re
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+import requests
+from requests.adapters import HTTPAdapter
+
+OPENAI_CHAT_URL = "https://api.openai.com/v1/chat/completions"
+RETRY_STATUS = {408, 409, 429, 500, 502, 503, 504}
+
+
+def parse_duration(value):
+    """
+    Parse rate-limit reset durations such as '1s', '6m0s', '20ms' or '0.5'
+    into seconds.
+    """
+    if value is None:
+        return None
+    value = value.strip()
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    units = {'h': 3600.0, 'm': 60.0, 's': 1.0, 'ms': 0.001}
+    parts = re.findall(r'([0-9.]+)(ms|h|m|s)', value)
+    if not parts:
+        return None
+    return sum(float(number) * units[unit] for number, unit in parts)
+
+
+def estimate_tokens(payload, image_tokens=255):
+    """
+    A rough upper bound of the tokens a request consumes, for budgeting.
+    """
+    tokens = payload.get('max_tokens', 0)
+    for message in payload['messages']:
+        content = message['content']
+        if isinstance(content, str):
+            tokens += len(content) // 4
+            continue
+        for part in content:
+            if part['type'] == 'text':
+                tokens += len(part['text']) // 4
+            else:
+                tokens += image_tokens
+    return tokens
+
+
+class RateBudget:
+    """
+    A requests-per-minute and tokens-per-minute budget shared by all worker
+    threads, refilled continuously and corrected by rate-limit headers.
+    """
+    def __init__(self, requests_per_minute=500, tokens_per_minute=200000):
+        self.capacity = {'requests': float(requests_per_minute), 'tokens': float(tokens_per_minute)}
+        self.available = dict(self.capacity)
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self.cond = threading.Condition()
+
+    def _refill(self, now):
+        elapsed = now - self.updated
+        self.updated = now
+        for key, capacity in self.capacity.items():
+            self.available[key] = min(capacity, self.available[key] + capacity * elapsed / 60.0)
+
+    def acquire(self, tokens):
+        tokens = min(tokens, self.capacity['tokens'])
+        with self.cond:
+            while True:
+                now = time.monotonic()
+                self._refill(now)
+                delay = self.paused_until - now
+                if delay <= 0:
+                    missing_requests = 1 - self.available['requests']
+                    missing_tokens = tokens - self.available['tokens']
+                    delay = max(
+                        missing_requests * 60.0 / self.capacity['requests'],
+                        missing_tokens * 60.0 / self.capacity['tokens'],
+                    )
+                    if delay <= 0:
+                        self.available['requests'] -= 1
+                        self.available['tokens'] -= tokens
+                        return
+                self.cond.wait(delay)
+
+    def pause(self, seconds):
+        """
+        Stop all workers from sending for the given number of seconds.
+        """
+        with self.cond:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+    def update(self, headers):
+        """
+        Trust the server's view of the remaining budget when it reports one.
+        """
+        with self.cond:
+            self._refill(time.monotonic())
+            for key in ['requests', 'tokens']:
+                remaining = headers.get('x-ratelimit-remaining-' + key)
+                if remaining is None:
+                    continue
+                try:
+                    remaining = float(remaining)
+                except ValueError:
+                    continue
+                self.available[key] = min(self.available[key], remaining)
+                if remaining <= 0:
+                    reset = parse_duration(headers.get('x-ratelimit-reset-' + key))
+                    if reset is not None:
+                        self.paused_until = max(self.paused_until, time.monotonic() + reset)
+            self.cond.notify_all()
+
+
+class ChatClient:
+    def __init__(self, api_key, url=OPENAI_CHAT_URL, concurrency=8, max_retries=6, backoff_base=1.0, backoff_cap=60.0,
+                 timeout=120.0, requests_per_minute=500, tokens_per_minute=200000, image_tokens=255, cache=None):
+        self.url = url
+        self.cache = cache
+        self.concurrency = concurrency
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_cap = backoff_cap
+        self.timeout = timeout
+        self.image_tokens = image_tokens
+        self.budget = RateBudget(requests_per_minute, tokens_per_minute)
+        self.session = requests.Session()
+        # one pooled keep-alive connection per worker thread
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=concurrency)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.session.headers.update({
+            "Content-Type": "application/json",
+            "Authorization": f"Bearer {api_key}",
+        })
+        self.stats = collections.Counter()
+        self.stats_lock = threading.Lock()
+
+    def count(self, key):
+        with self.stats_lock:
+            self.stats[key] += 1
+
+    def backoff(self, attempt):
+        # exponential backoff with full jitter
+        return random.uniform(0, min(self.backoff_cap, self.backoff_base * 2 ** attempt))
+
+    def post(self, payload, cache_key=None):
+        """
+        Send one request, retrying transient failures. Returns the decoded
+        JSON response. A failed request returns a dict with the 'error' and
+        the 'status_code' of the last attempt (None if it never got a
+        response) instead. With a cache and a cache_key, a cached response
+        is returned without a request (the payload may then be None), and
+        successful responses are cached.
+        """
+        if self.cache is not None and cache_key is not None:
+            response = self.cache.get(cache_key)
+            if response is not None:
+                self.count('cache_hits')
+                return response
+            if payload is None:
+                self.count('cache_misses')
+                return {'error': 'not in the cache', 'status_code': None}
+        tokens = estimate_tokens(payload, self.image_tokens)
+        status_code = None
+        for attempt in range(self.max_retries + 1):
+            self.budget.acquire(tokens)
+            self.count('requests')
+            try:
+                response = self.session.post(self.url, json=payload, timeout=self.timeout)
+            except requests.RequestException:
+                self.count('connection_errors')
+                time.sleep(self.backoff(attempt))
+                continue
+            self.budget.update(response.headers)
+            status_code = response.status_code
+            if response.status_code in RETRY_STATUS:
+                self.count('status_%d' % response.status_code)
+                delay = parse_duration(response.headers.get('retry-after'))
+                if delay is None:
+                    delay = self.backoff(attempt)
+                if response.status_code == 429:
+                    self.budget.pause(delay)
+                time.sleep(delay)
+                continue
+            try:
+                result = response.json()
+            except ValueError:
+                self.count('bad_json')
+                return {'error': 'response is not JSON', 'status_code': status_code}
+            if response.status_code != 200:
+                # not retryable, e.g. a 400 for a malformed request
+                self.count('status_%d' % response.status_code)
+                if isinstance(result, dict):
+                    result = result.get('error', result)
+                return {'error': result, 'status_code': status_code}
+            if self.cache is not None and cache_key is not None:
+                self.cache.put(cache_key, result)
+            return result
+        self.count('gave_up')
+        return {'error': 'gave up after %d attempts' % (self.max_retries + 1), 'status_code': status_code}
+
+    def map(self, jobs, ordered=False):
+        """
+        Run (key, payload) or (key, payload, cache_key) jobs concurrently
+        and yield (key, response). At
+        most 2 x concurrency jobs are pulled from the iterable at a time, so
+        jobs can be built lazily. If ordered, results are yielded in job
+        order, otherwise as soon as they complete.
+        """
+        jobs = iter(jobs)
+        with ThreadPoolExecutor(self.concurrency) as executor:
+            in_flight = collections.deque()
+            def submit():
+                job = next(jobs, None)
+                if job is None:
+                    return False
+                key, payload, *cache_key = job
+                in_flight.append((key, executor.submit(self.post, payload, *cache_key)))
+                return True
+            for _ in range(2 * self.concurrency):
+                if not submit():
+                    break
+            while in_flight:
+                if ordered:
+                    key, future = in_flight.popleft()
+                else:
+                    # wait for whichever request finishes first
+                    done, _ = wait([future for _, future in in_flight], return_when=FIRST_COMPLETED)
+                    index = next(i for i, (_, future) in enumerate(in_flight) if future in done)
+                    key, future = in_flight[index]
+                    del in_flight[index]
+                response = future.result()
+                submit()
+                yield key, response
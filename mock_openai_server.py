@@ -0,0 +1,101 @@
+# ==============================================================================
+# A local stand-in for the chat completions endpoint, to test captioning_gpt.py
+# without an API key. It answers every request after a random latency, keeps
+# a requests-per-minute window, reports it in x-ratelimit-* headers, and
+# returns 429s when the window is exhausted or at random.
+#
+# python mock_openai_server.py --port 8000 --latency 0.5 --p429 0.1 --rpm 300
+# ==============================================================================
+import argparse
+import collections
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class MockState:
+    def __init__(self, rpm):
+        self.rpm = rpm
+        self.sent = collections.deque()
+        self.lock = threading.Lock()
+        self.counts = collections.Counter()
+
+    def admit(self):
+        """
+        Return (admitted, remaining requests, seconds until the window frees up).
+        """
+        with self.lock:
+            now = time.monotonic()
+            while self.sent and now - self.sent[0] > 60:
+                self.sent.popleft()
+            reset = 60 - (now - self.sent[0]) if self.sent else 0.0
+            if len(self.sent) >= self.rpm:
+                return False, 0, reset
+            self.sent.append(now)
+            return True, self.rpm - len(self.sent), reset
+
+
+def make_handler(args, state):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'  # keep-alive
+
+        def log_message(self, *_):
+            pass
+
+        def send_json(self, status, body, headers):
+            data = json.dumps(body).encode('utf-8')
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(data)))
+            for key, value in headers.items():
+                self.send_header(key, value)
+            self.end_headers()
+            self.wfile.write(data)
+
+        def do_POST(self):
+            payload = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+            admitted, remaining, reset = state.admit()
+            headers = {
+                'x-ratelimit-limit-requests': str(args.rpm),
+                'x-ratelimit-remaining-requests': str(remaining),
+                'x-ratelimit-reset-requests': '%.3fs' % reset,
+            }
+            if not admitted or random.random() < args.p429:
+                state.counts['429'] += 1
+                headers['retry-after'] = '%.3f' % (reset if not admitted else args.retry_after)
+                self.send_json(429, {'error': {'message': 'Rate limit reached', 'type': 'requests'}}, headers)
+                return
+            time.sleep(random.uniform(0.5, 1.5) * args.latency)
+            state.counts['200'] += 1
+            content = payload['messages'][0]['content']
+            num_images = sum(1 for part in content if part['type'] == 'image_url')
+            num_bytes = sum(len(part['image_url']['url']) for part in content if part['type'] == 'image_url')
+            body = {
+                'model': payload.get('model'),
+                'choices': [{'index': 0, 'message': {'role': 'assistant', 'content': 'a mock caption of %d images (%d bytes)' % (num_images, num_bytes)}}],
+                'usage': {'prompt_tokens': 0, 'completion_tokens': 0, 'total_tokens': 0},
+            }
+            self.send_json(200, body, headers)
+
+    return Handler
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--host', type = str, default='127.0.0.1')
+    parser.add_argument('--port', type = int, default = 8000)
+    parser.add_argument('--latency', type = float, default = 0.5, help = 'mean seconds per successful response')
+    parser.add_argument('--p429', type = float, default = 0.0, help = 'probability of a random 429')
+    parser.add_argument('--retry_after', type = float, default = 1.0, help = 'retry-after seconds sent with random 429s')
+    parser.add_argument('--rpm', type = int, default = 500, help = 'requests per minute before 429s')
+    args = parser.parse_args()
+
+    state = MockState(args.rpm)
+    server = ThreadingHTTPServer((args.host, args.port), make_handler(args, state))
+    print('mock chat completions endpoint at http://%s:%d/v1/chat/completions' % (args.host, args.port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print(dict(state.counts))
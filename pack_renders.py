@@ -0,0 +1,37 @@
+# ==============================================================================
+# Pack rendered object folders into a view store (see
+# shap-e/shap_e/util/view_store.py): one uncompressed zip per object instead of
+# ~115 files, plus a sharded index of the packed objects. Folders whose files
+# are all in the store already are skipped, so packing can be interrupted and
+# resumed; folders that were rendered again since are packed again.
+#
+# With --delete, the files of a folder are removed once it is packed; files
+# that later stages read from the folder (caption.pkl, diffurank_scores.pkl)
+# are kept. captioning_images.py, captioning_gpt.py and DiffuRank then read
+# views from the store.
+#
+# python pack_renders.py --parent_dir ./example_material --delete
+# ==============================================================================
+import argparse
+import os
+import time
+
+from shap_e.util.view_store import ViewStore, pack_folders
+
+KEEP_FILES = ['caption.pkl', 'diffurank_scores.pkl']
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--parent_dir', type = str, default = './example_material')
+    parser.add_argument('--view_store', type = str, default = 'auto', help = 'default: {parent_dir}/Cap3D_packed')
+    parser.add_argument('--delete', action = 'store_true', help = 'remove the view files of a folder once it is packed')
+    args = parser.parse_args()
+
+    if args.view_store == 'auto':
+        args.view_store = os.path.join(args.parent_dir, 'Cap3D_packed')
+    start = time.time()
+    store = ViewStore(args.view_store)
+    counts = pack_folders(store, os.path.join(args.parent_dir, 'Cap3D_imgs'), delete=args.delete, keep=KEEP_FILES)
+    print('packed %d objects (%d already packed) in %.1fs, store now holds %d objects'
+          % (counts['packed'], counts['skipped'], time.time() - start, len(store)))
@@ -7,37 +7,68 @@
 
 import os
 from IPython import embed
+import collections
 import csv
+import itertools
+import json
+import re
+import sys
 import argparse
 import pandas as pd
 import tqdm
 import spacy
 from spacy.matcher import Matcher
 
-parser = argparse.ArgumentParser()
-parser.add_argument('--input_csv', type=str, default='path_to_csv')
-parser.add_argument('--output_csv', type=str, default='path_to_output_csv')
-args = parser.parse_args()
+SPACY_MODEL = 'en_core_web_sm'
+# The matcher only looks at the token text and punctuation, which come from
+# the tokenizer, so none of the trained components are loaded.
+UNUSED_COMPONENTS = ['tok2vec', 'tagger', 'parser', 'senter', 'attribute_ruler', 'lemmatizer', 'ner']
 
-def remove_3d_phrases(text):
-    text=text.replace('\'','\"')
-    nlp = spacy.load('en_core_web_sm')
-    
-    # Initialize the matcher with the shared vocab
-    matcher = Matcher(nlp.vocab)
+# Define the patterns
+pattern1 = [{"LOWER": "\"", "OP": "?"}, {"LOWER": "a", "OP": "?"}, {"LOWER": "white", "OP": "?"}, {"LOWER": "3d"}, {"ORTH": "-", "OP": "?"}, {"LOWER": "white", "OP": "?"}, {"LOWER": {"IN": ["rendering", "model", "object", "models", "scene", "printed", "rendered"]}, "OP": "?"}, {"LOWER": {"IN": ["of", "featuring", "resembling"]}, "OP": "?"}, {"LOWER": ":", "OP": "?"}, {"IS_PUNCT": True, "OP": "?"}]
+pattern2 = [{"LOWER": "with", "OP": "?"}, {"LOWER": "a", "OP": "?"}, {"LOWER": "3d"}, {"ORTH": "-", "OP": "?"}, {"LOWER": {"IN": ["models", "model", "rendered", "object", "models", "scene", "printed", "rendering", "modeled", "modeling"]}, "OP": "?"}, {"LOWER": {"IN": ["of", "featuring", "and"]}, "OP": "?"}]
+pattern3 = [{"LOWER": {"IN": ["in", "for", "featuring"]}, "OP": "?"}, {"LOWER": "a", "OP": "?"}, {"LOWER": "(", "OP": "?"},{"LOWER": "3d"}, {"ORTH": "-", "OP": "?"}, {"LOWER": {"IN": ["rendering", "model", "setting", "object", "models", "rendered", "printing", "printer"]}, "OP": "?"}, {"LOWER": ")", "OP": "?"}, {"LOWER": "inside", "OP": "?"}, {"IS_PUNCT": True, "OP": "?"}]
+
+# the same test as '3D' in text or '3d' in text, routing captions to spaCy
+THREE_D = re.compile('3[Dd]')
+
+_pipeline = None
 
-    # Define the patterns
-    pattern1 = [{"LOWER": "\"", "OP": "?"}, {"LOWER": "a", "OP": "?"}, {"LOWER": "white", "OP": "?"}, {"LOWER": "3d"}, {"ORTH": "-", "OP": "?"}, {"LOWER": "white", "OP": "?"}, {"LOWER": {"IN": ["rendering", "model", "object", "models", "scene", "printed", "rendered"]}, "OP": "?"}, {"LOWER": {"IN": ["of", "featuring", "resembling"]}, "OP": "?"}, {"LOWER": ":", "OP": "?"}, {"IS_PUNCT": True, "OP": "?"}]
-    pattern2 = [{"LOWER": "with", "OP": "?"}, {"LOWER": "a", "OP": "?"}, {"LOWER": "3d"}, {"ORTH": "-", "OP": "?"}, {"LOWER": {"IN": ["models", "model", "rendered", "object", "models", "scene", "printed", "rendering", "modeled", "modeling"]}, "OP": "?"}, {"LOWER": {"IN": ["of", "featuring", "and"]}, "OP": "?"}]
-    pattern3 = [{"LOWER": {"IN": ["in", "for", "featuring"]}, "OP": "?"}, {"LOWER": "a", "OP": "?"}, {"LOWER": "(", "OP": "?"},{"LOWER": "3d"}, {"ORTH": "-", "OP": "?"}, {"LOWER": {"IN": ["rendering", "model", "setting", "object", "models", "rendered", "printing", "printer"]}, "OP": "?"}, {"LOWER": ")", "OP": "?"}, {"LOWER": "inside", "OP": "?"}, {"IS_PUNCT": True, "OP": "?"}]
+def get_pipeline(model=SPACY_MODEL):
+    """
+    Load the spaCy pipeline and compile the matcher once per process.
+    """
+    global _pipeline
+    if _pipeline is None or _pipeline[0] != model:
+        nlp = spacy.load(model, exclude=UNUSED_COMPONENTS)
+        # Initialize the matcher with the shared vocab
+        matcher = Matcher(nlp.vocab)
+        # Add patterns to the matcher
+        matcher.add("PRE_PATTERN1", [pattern1])
+        matcher.add("MID_PATTERN", [pattern2])
+        matcher.add("END_PATTERN", [pattern3])
+        _pipeline = (model, nlp, matcher)
+    return _pipeline[1], _pipeline[2]
 
-    # Add patterns to the matcher
-    matcher.add("PRE_PATTERN1", [pattern1])
-    matcher.add("MID_PATTERN", [pattern2])
-    matcher.add("END_PATTERN", [pattern3])
+def prepare_text(text):
+    return text.replace('\'','\"')
 
+def remove_3d_phrases(text, model=SPACY_MODEL):
+    text = prepare_text(text)
+    nlp, matcher = get_pipeline(model)
+    return remove_3d_phrases_doc(text, nlp(text), nlp, matcher)
 
-    doc = nlp(text)
+def remove_3d_phrases_batch(texts, batch_size=1000, n_process=1, model=SPACY_MODEL):
+    """
+    remove_3d_phrases() for an iterable of captions, tokenized in batches by
+    nlp.pipe, with n_process worker processes. Yields results in order.
+    """
+    nlp, matcher = get_pipeline(model)
+    texts = ((text, text) for text in map(prepare_text, texts))
+    for doc, text in nlp.pipe(texts, as_tuples=True, batch_size=batch_size, n_process=n_process):
+        yield remove_3d_phrases_doc(text, doc, nlp, matcher)
+
+def remove_3d_phrases_doc(text, doc, nlp, matcher):
     matches = matcher(doc)
     spans_pre=[]
     spans_mid=[]
@@ -126,30 +157,120 @@ def remove_3d_phrases(text):
 
     return text
 
-cur_caption_csv = pd.read_csv(args.input_csv, header=None)
-uids = list(set(cur_caption_csv[0].values))
+def read_chunks(path, chunksize, usecols=None):
+    # captions are kept verbatim, e.g. "NA" stays a string
+    return pd.read_csv(path, header=None, dtype=str, keep_default_na=False, chunksize=chunksize, usecols=usecols)
 
-n2idx = {}
-for i in range(len(cur_caption_csv)):
-    n2idx[cur_caption_csv[0][i]] = i
+def last_rows(path, chunksize):
+    """
+    Return a boolean mask over the rows of the CSV that marks the last row of
+    every uid, reading only the uid column in chunks.
+    """
+    uids = pd.concat([chunk[0] for chunk in read_chunks(path, chunksize, usecols=[0])] or [pd.Series([], dtype=str)], ignore_index=True)
+    return ~uids.duplicated(keep='last').to_numpy()
 
-f = open(args.output_csv, 'a')
-writer = csv.writer(f)
-output = []
-print('############begin remove 3D-related words############')
-for cur_uid in tqdm.tqdm(uids):
-    out_idx = cur_caption_csv[0][n2idx[cur_uid]]
-    cur_final_caption = cur_caption_csv[1][n2idx[cur_uid]]
+def clean_chunks(chunks, args):
+    """
+    Yield (info, [(uid, caption)]) for every (info, uids, captions) in chunks,
+    in order. The captions that mention 3D in all chunks go through a single
+    nlp.pipe, so its worker processes are started only once.
+    """
+    # rows and chunk ends, in input order, read ahead by nlp.pipe
+    pending = collections.deque()
+    def texts():
+        for info, uids, captions in chunks:
+            for uid, caption in zip(uids, captions):
+                if THREE_D.search(caption):
+                    pending.append(('row', uid, None))
+                    yield caption
+                else:
+                    pending.append(('row', uid, caption))
+            pending.append(('end', info, None))
+    cleaned = remove_3d_phrases_batch(texts(), batch_size=args.batch_size, n_process=args.n_process, model=args.spacy_model)
+    rows = []
+    # a final None drains the chunks after the last caption sent to spaCy
+    for summary in itertools.chain(cleaned, [None]):
+        while pending:
+            kind, key, caption = pending.popleft()
+            if kind == 'end':
+                yield key, rows
+                rows = []
+            elif caption is None:
+                rows.append((key, summary))
+                break
+            else:
+                rows.append((key, caption))
 
-    if '3D' not in cur_final_caption and '3d' not in cur_final_caption:
-        summary = cur_final_caption
-    else:
-        summary = remove_3d_phrases(cur_final_caption)
+def input_signature(path):
+    stat = os.stat(path)
+    return {'input': os.path.abspath(path), 'size': stat.st_size, 'mtime': stat.st_mtime}
 
-    writer.writerow([out_idx, summary.replace('"', '')])
+def save_checkpoint(path, checkpoint):
+    with open(path + '.tmp', 'w') as f:
+        json.dump(checkpoint, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(path + '.tmp', path)
 
-f.flush()
-os.fsync(f.fileno())
-f.close()
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--input_csv', type=str, default='path_to_csv')
+    parser.add_argument('--output_csv', type=str, default='path_to_output_csv')
+    parser.add_argument('--batch_size', type=int, default=1000, help='captions per nlp.pipe batch')
+    parser.add_argument('--n_process', type=int, default=1, help='spaCy processes, tokenizing is cheap so more only pays off for very large CSVs')
+    parser.add_argument('--spacy_model', type=str, default=SPACY_MODEL)
+    parser.add_argument('--chunksize', type=int, default=100000, help='CSV rows read at a time')
+    parser.add_argument('--checkpoint_every', type=int, default=1, help='make the output durable every this many chunks')
+    args = parser.parse_args()
+
+    # Rows are streamed in chunks. For uids with several rows (e.g. captions
+    # redone by captioning_gpt.py) the last row wins, and the output keeps
+    # the input order of those rows. A checkpoint records how far the input
+    # and the output got, so an interrupted run resumes at the last chunk.
+    checkpoint_path = args.output_csv + '.checkpoint'
+    signature = input_signature(args.input_csv)
+    f = open(args.output_csv, 'a', newline='')
+    if os.path.exists(checkpoint_path):
+        with open(checkpoint_path) as cf:
+            checkpoint = json.load(cf)
+        if {key: checkpoint[key] for key in signature} != signature:
+            raise RuntimeError('%s belongs to a different input, remove it to start over' % checkpoint_path)
+        if checkpoint['done']:
+            print('%s is complete' % args.output_csv)
+            sys.exit(0)
+        # drop rows written after the last checkpoint
+        f.truncate(checkpoint['output_bytes'])
+    else:
+        checkpoint = dict(signature, rows=0, output_bytes=f.tell(), done=False)
+    writer = csv.writer(f)
 
+    keep = last_rows(args.input_csv, args.chunksize)
+    print('%d rows, %d uids' % (len(keep), keep.sum()))
+    print('############begin remove 3D-related words############')
+    progress = tqdm.tqdm(total=len(keep), initial=checkpoint['rows'])
+    start_row = checkpoint['rows']
+    def chunks():
+        for chunk_index, chunk in enumerate(read_chunks(args.input_csv, args.chunksize)):
+            rows = chunk.index.to_numpy()
+            if rows[-1] < start_row:
+                continue
+            selected = keep[rows] & (rows >= start_row)
+            info = (chunk_index, int(rows[-1]) + 1, int((rows >= start_row).sum()))
+            yield info, chunk[0][selected].tolist(), chunk[1][selected].tolist()
+    for (chunk_index, end_row, num_rows), cleaned in clean_chunks(chunks(), args):
+        for out_idx, summary in cleaned:
+            writer.writerow([out_idx, summary.replace('"', '')])
+        progress.update(num_rows)
+        checkpoint['rows'] = end_row
+        if (chunk_index + 1) % args.checkpoint_every == 0:
+            f.flush()
+            os.fsync(f.fileno())
+            checkpoint['output_bytes'] = f.tell()
+            save_checkpoint(checkpoint_path, checkpoint)
+    progress.close()
 
+    f.flush()
+    os.fsync(f.fileno())
+    checkpoint.update(rows=len(keep), output_bytes=f.tell(), done=True)
+    save_checkpoint(checkpoint_path, checkpoint)
+    f.close()
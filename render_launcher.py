@@ -0,0 +1,260 @@
+# ==============================================================================
+# Render many objects in parallel Blender processes with resume.
+#
+# The object list is split into shards, each rendered by its own Blender
+# process running render_script.py, render_script_type1.py or
+# render_script_type2.py, pinned to its own CPUs (and GPU, with --gpus). The
+# scripts append start/done/fail lines per object to a status file; the
+# launcher turns them into a manifest (one JSON line per attempt), so reruns
+# skip completed objects and retry failed ones up to --max_attempts. An
+# object that renders for longer than --timeout seconds gets its Blender
+# process killed, and the shard restarts with the objects it has left.
+#
+# python render_launcher.py --script render_script_type2.py --num_shards 4 --gpus 0,1,2,3 \
+#     --object_path_pkl ./example_material/example_object_path.pkl --parent_dir ./example_material
+# ==============================================================================
+import argparse
+import collections
+import json
+import os
+import pickle
+import signal
+import subprocess
+import threading
+import time
+
+# files an object's output folder must contain to count as rendered, for
+# objects rendered before there was a manifest
+EXPECTED_OUTPUTS = {
+    'render_script_type1.py': ['%05d.png' % i for i in range(20, 28)],
+    'render_script_type2.py': ['%05d.png' % i for i in range(20)] + ['transforms_train.json'],
+    'render_script.py': ['%05d.png' % i for i in range(28)] + ['transforms_train.json'],
+}
+
+
+def object_dir(parent_dir, path):
+    return os.path.join(parent_dir, 'Cap3D_imgs', path.split('/')[-1].split('.')[0])
+
+
+class Manifest:
+    """
+    An append-only JSONL log of render attempts {path, status, shard, time,
+    message}, with status one of done, fail, timeout, crash or skipped. Only the
+    launcher writes to it.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.done = set()
+        self.failures = collections.Counter()
+        if os.path.exists(path):
+            with open(path) as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # torn last line of an interrupted run
+                        continue
+                    self._apply(entry)
+        self.file = open(path, 'a')
+
+    def _apply(self, entry):
+        if entry['status'] == 'done':
+            self.done.add(entry['path'])
+        else:
+            self.failures[entry['path']] += 1
+
+    def record(self, path, status, shard, message=''):
+        entry = dict(path=path, status=status, shard=shard, time=time.time(), message=message[-2000:])
+        with self.lock:
+            self._apply(entry)
+            self.file.write(json.dumps(entry) + '\n')
+            self.file.flush()
+            os.fsync(self.file.fileno())
+
+    def close(self):
+        self.file.close()
+
+
+class Shard:
+    def __init__(self, index, paths, args, manifest, cpus, gpu):
+        self.index = index
+        self.queue = collections.deque(paths)
+        self.args = args
+        self.manifest = manifest
+        self.cpus = cpus
+        self.gpu = gpu
+        self.work_dir = os.path.join(args.work_dir, 'shard_%03d' % index)
+        os.makedirs(self.work_dir, exist_ok=True)
+        self.status_path = os.path.join(self.work_dir, 'status.tsv')
+        self.num_launches = 0
+
+    def log(self, message):
+        print('[shard %d] %s' % (self.index, message), flush=True)
+
+    def dequeue(self, path):
+        """
+        Remove a path from the queue, if it is still there: the render
+        script may report an object more than once.
+        """
+        if path not in self.queue:
+            return False
+        self.queue.remove(path)
+        return True
+
+    def failed(self, path, status, message=''):
+        self.manifest.record(path, status, self.index, message)
+        if not self.dequeue(path):
+            return
+        if self.manifest.failures[path] < self.args.max_attempts:
+            # retry after the objects that have not been tried yet
+            self.queue.append(path)
+        else:
+            self.log('giving up on %s after %d attempts' % (path, self.manifest.failures[path]))
+
+    def launch(self):
+        object_pkl = os.path.join(self.work_dir, 'objects.pkl')
+        with open(object_pkl, 'wb') as f:
+            pickle.dump(list(self.queue), f)
+        open(self.status_path, 'w').close()
+        command = [self.args.blender, '-b']
+        if self.cpus:
+            command += ['-t', str(len(self.cpus))]
+        command += ['-P', self.args.script, '--', '--object_path_pkl', object_pkl,
+                    '--parent_dir', self.args.parent_dir, '--status_file', self.status_path]
+        command += self.args.script_args.split()
+        env = dict(os.environ)
+        if self.gpu is not None:
+            env['CUDA_VISIBLE_DEVICES'] = self.gpu
+        cpus = self.cpus
+        def pin():
+            if cpus:
+                os.sched_setaffinity(0, cpus)
+        log = open(os.path.join(self.work_dir, 'blender.log'), 'ab')
+        self.num_launches += 1
+        # a new session, so that the whole process group can be killed
+        process = subprocess.Popen(command, stdout=log, stderr=subprocess.STDOUT, env=env,
+                                   preexec_fn=pin, start_new_session=True)
+        log.close()
+        return process
+
+    def run(self):
+        launches_without_progress = 0
+        while self.queue:
+            process = self.launch()
+            current, started, seen, timed_out = None, None, set(), False
+            with open(self.status_path, 'rb') as status_file:
+                while True:
+                    # check for exit before reading, so that no status line is missed
+                    exited = process.poll() is not None
+                    for line in status_file.readlines():
+                        if not line.endswith(b'\n'):
+                            # partially written, read it again next time
+                            status_file.seek(-len(line), os.SEEK_CUR)
+                            break
+                        status, path, message = line.decode('utf-8').rstrip('\n').split('\t', 2)
+                        if status == 'start':
+                            current, started = path, time.time()
+                            seen.add(path)
+                        elif status == 'done':
+                            self.manifest.record(path, 'done', self.index)
+                            self.dequeue(path)
+                            current = None
+                        elif status == 'fail':
+                            self.failed(path, 'fail', json.loads(message))
+                            current = None
+                    if exited:
+                        break
+                    if current is not None and time.time() - started > self.args.timeout:
+                        self.log('%s timed out after %.0fs, restarting Blender' % (current, self.args.timeout))
+                        os.killpg(process.pid, signal.SIGKILL)
+                        process.wait()
+                        self.failed(current, 'timeout')
+                        current, timed_out = None, True
+                        break
+                    time.sleep(self.args.poll_interval)
+            if current is not None:
+                # Blender died while rendering this object
+                self.failed(current, 'crash', 'exit code %s' % process.returncode)
+            if not timed_out and process.returncode == 0:
+                # the script went through its list, so objects it never started
+                # were skipped by it, e.g. because the input file is missing
+                for path in [path for path in self.queue if path not in seen]:
+                    self.manifest.record(path, 'skipped', self.index)
+                    self.dequeue(path)
+            if seen:
+                launches_without_progress = 0
+            else:
+                launches_without_progress += 1
+                if launches_without_progress >= 3:
+                    self.log('Blender exits without rendering (exit code %s), see %s'
+                             % (process.returncode, os.path.join(self.work_dir, 'blender.log')))
+                    return
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--script', type = str, default = 'render_script_type2.py', help = 'render_script.py, render_script_type1.py or render_script_type2.py')
+    parser.add_argument('--object_path_pkl', type = str, default = './example_material/example_object_path.pkl')
+    parser.add_argument('--parent_dir', type = str, default = './example_material')
+    parser.add_argument('--blender', type = str, default = './blender-3.4.1-linux-x64/blender')
+    parser.add_argument('--num_shards', type = int, default = 1, help = 'Blender processes')
+    parser.add_argument('--cpus_per_shard', type = int, default = 0, help = 'pin each shard to this many CPUs, 0 spreads all CPUs over the shards')
+    parser.add_argument('--gpus', type = str, default = 'none', help = 'comma separated GPU ids assigned to shards round robin')
+    parser.add_argument('--timeout', type = float, default = 600, help = 'seconds one object may render before Blender is restarted')
+    parser.add_argument('--max_attempts', type = int, default = 3, help = 'attempts per object, across runs')
+    parser.add_argument('--manifest', type = str, default = 'auto', help = 'default: {parent_dir}/render_manifest_{script}.jsonl')
+    parser.add_argument('--work_dir', type = str, default = 'auto', help = 'shard object lists, status files and Blender logs, default: {parent_dir}/render_shards_{script}')
+    parser.add_argument('--script_args', type = str, default = '', help = 'extra arguments passed to the render script')
+    parser.add_argument('--poll_interval', type = float, default = 1.0)
+    args = parser.parse_args()
+
+    script_name = os.path.basename(args.script)
+    name = os.path.splitext(script_name)[0]
+    if args.manifest == 'auto':
+        args.manifest = os.path.join(args.parent_dir, 'render_manifest_%s.jsonl' % name)
+    if args.work_dir == 'auto':
+        args.work_dir = os.path.join(args.parent_dir, 'render_shards_%s' % name)
+
+    os.makedirs(os.path.dirname(os.path.abspath(args.manifest)), exist_ok=True)
+    manifest = Manifest(args.manifest)
+    expected = EXPECTED_OUTPUTS.get(script_name, [])
+    paths, num_done, num_given_up = [], 0, 0
+    # an object listed twice is rendered once
+    for path in dict.fromkeys(pickle.load(open(args.object_path_pkl, 'rb'))):
+        if path in manifest.done:
+            num_done += 1
+        elif expected and all(os.path.exists(os.path.join(object_dir(args.parent_dir, path), file_name)) for file_name in expected):
+            manifest.record(path, 'done', -1, 'outputs found on disk')
+            num_done += 1
+        elif manifest.failures[path] >= args.max_attempts:
+            num_given_up += 1
+        else:
+            paths.append(path)
+    print('%d objects done, %d failed %d times, %d to render' % (num_done, num_given_up, args.max_attempts, len(paths)))
+
+    cpus = sorted(os.sched_getaffinity(0))
+    per_shard = args.cpus_per_shard or max(1, len(cpus) // args.num_shards)
+    gpus = args.gpus.split(',') if args.gpus != 'none' else None
+    shards = []
+    for index in range(args.num_shards):
+        shard_cpus = cpus[index * per_shard:(index + 1) * per_shard] if (index + 1) * per_shard <= len(cpus) else []
+        gpu = gpus[index % len(gpus)] if gpus else None
+        shards.append(Shard(index, paths[index::args.num_shards], args, manifest, shard_cpus, gpu))
+
+    start_time = time.time()
+    threads = [threading.Thread(target=shard.run) for shard in shards if shard.queue]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    manifest.close()
+
+    num_rendered = sum(path in manifest.done for path in paths)
+    launches = sum(shard.num_launches for shard in shards)
+    print('rendered %d of %d objects in %.1fs with %d Blender launches, see %s'
+          % (num_rendered, len(paths), time.time() - start_time, launches, args.manifest))
+
+
+if __name__ == '__main__':
+    main()
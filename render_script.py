@@ -0,0 +1,177 @@
+# ==============================================================================
+# Render both camera sets of an object with one Blender process and one import.
+#
+# Running render_script_type2.py and render_script_type1.py one after the other
+# imports and normalizes every object twice. This script imports it once,
+# renders the random views of render_script_type2.py as 00000-00019 and the
+# z-circular-elevated views of render_script_type1.py as 00020-00027 with the
+# settings of their own scripts into the same folder, and writes one
+# transforms_train.json with the cameras of all views.
+#
+# Type2 views are rendered with random lights and without material
+# extraction by default, which is what render_script_type2.py ends up
+# rendering: it passes --uniform_light_direction on as strings, so its
+# uniform light fails and it falls back to these settings.
+#
+# With --pack, each object folder is packed into a view store
+# (shap-e/shap_e/util/view_store.py) after rendering and then removed.
+#
+# ./blender-3.4.1-linux-x64/blender -b -P render_script.py -- --object_path_pkl './example_material/example_object_path.pkl' --parent_dir './example_material'
+# ==============================================================================
+import argparse
+import os
+import pickle
+import sys
+import time
+import traceback
+
+import bpy
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'shap-e'))
+import render_script_type1 as type1
+import render_script_type2 as type2
+from shap_e.util.view_store import ViewStore
+
+TYPE1_FIRST_INDEX = 20
+TYPE1_NUM_IMAGES = 8
+
+
+def startup_light():
+    """
+    The light of Blender's startup scene, which render_script_type1.py never
+    deletes and renders with.
+    """
+    for obj in bpy.context.scene.objects.values():
+        if isinstance(obj.data, bpy.types.Light):
+            return dict(type=obj.data.type, energy=obj.data.energy, color=tuple(obj.data.color),
+                        shadow_soft_size=obj.data.shadow_soft_size, location=tuple(obj.location),
+                        rotation=tuple(obj.rotation_euler))
+    return None
+
+
+def create_type1_light(light):
+    type2.clear_lights()
+    if light is None:
+        return
+    light_data = bpy.data.lights.new(name="Light", type=light['type'])
+    light_data.energy = light['energy']
+    light_data.color = light['color']
+    light_data.shadow_soft_size = light['shadow_soft_size']
+    light_object = bpy.data.objects.new(name="Light", object_data=light_data)
+    bpy.context.collection.objects.link(light_object)
+    light_object.location = light['location']
+    light_object.rotation_euler = light['rotation']
+
+
+def render_object(uid, output_path, args, light):
+    light_mode, extract_material = args.light_mode, args.extract_material
+    # render_script_type1.py's single pass mode changes it
+    bpy.context.scene.view_layers["ViewLayer"].pass_alpha_threshold = 0.5
+    t_start = time.time()
+    try:
+        default_material_objects = type2.setup_scene(uid, args.backend, light_mode, extract_material, delete_material=False)
+        t_import = time.time() - t_start
+        camera_data = type2.render_views(
+            output_path,
+            num_images=args.num_images,
+            light_mode=light_mode,
+            camera_pose="random",
+            camera_dist_min=args.camera_dist_min,
+            camera_dist_max=args.camera_dist_max,
+            fast_mode=True,
+            extract_material=extract_material,
+        )
+    except Exception:
+        # as render_script_type2.py does, start over without material extraction
+        print('render with material failed, rendering with random lights')
+        light_mode, extract_material = 'random', False
+        t_start = time.time()
+        default_material_objects = type2.setup_scene(uid, args.backend, light_mode, extract_material, delete_material=False)
+        t_import = time.time() - t_start
+        camera_data = type2.render_views(
+            output_path,
+            num_images=args.num_images,
+            light_mode=light_mode,
+            camera_pose="random",
+            camera_dist_min=args.camera_dist_min,
+            camera_dist_max=args.camera_dist_max,
+            fast_mode=True,
+            extract_material=extract_material,
+        )
+
+    # back to the scene of render_script_type1.py: no default materials and
+    # the startup light. It renders with its own render settings.
+    for obj in default_material_objects:
+        obj.data.materials.clear()
+    create_type1_light(light)
+    camera_data += type1.render_views(
+        output_path,
+        num_images=TYPE1_NUM_IMAGES,
+        camera_pose="z-circular-elevated",
+        first_index=TYPE1_FIRST_INDEX,
+        single_pass=args.single_pass,
+    )
+    type2.write_dataset_metadata(output_path, camera_data, args.backend, light_mode, True, extract_material)
+    print('imported in %.1fs, rendered %d views in %.1fs'
+          % (t_import, len(camera_data), time.time() - t_start - t_import))
+
+
+def main():
+    try:
+        dash_index = sys.argv.index("--")
+    except ValueError as exc:
+        raise ValueError("arguments must be preceded by '--'") from exc
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--object_path_pkl', type = str, default = './example_material/example_object_path.pkl')
+    parser.add_argument('--parent_dir', type = str, default = './example_material')
+    parser.add_argument('--status_file', type = str, default = 'none', help = 'append start/done/fail lines per object, read by render_launcher.py')
+    parser.add_argument('--num_images', type = int, default = 20, help = 'random (type2) views, rendered before the 8 type1 views 00020-00027')
+    parser.add_argument('--backend', type = str, default = 'CYCLES')
+    parser.add_argument('--light_mode', type = str, default = 'random', help = 'lights of the type2 views: random, uniform or camera')
+    parser.add_argument('--extract_material', action = 'store_true', help = 'render material color and alpha of the type2 views')
+    parser.add_argument('--camera_dist_min', type = float, default = 2.0)
+    parser.add_argument('--camera_dist_max', type = float, default = 2.0)
+    parser.add_argument('--uniform_light_direction', type = float, nargs = 3, default = type2.DEFAULT_UNIFORM_LIGHT_DIRECTION)
+    parser.add_argument('--single_pass', action = 'store_true', help = 'render every output of a view with one render')
+    parser.add_argument('--pack', action = 'store_true', help = 'pack each rendered object into a view store and remove its folder')
+    parser.add_argument('--view_store', type = str, default = 'auto', help = 'default: {parent_dir}/Cap3D_packed')
+    args = parser.parse_args(sys.argv[dash_index + 1:])
+    assert args.num_images <= TYPE1_FIRST_INDEX, 'type2 views would overwrite the type1 views'
+
+    type2.UNIFORM_LIGHT_DIRECTION = args.uniform_light_direction
+    type2.SINGLE_PASS = args.single_pass
+    # before the first import deletes it
+    light = startup_light()
+
+    writer = None
+    if args.pack:
+        if args.view_store == 'auto':
+            args.view_store = os.path.join(args.parent_dir, 'Cap3D_packed')
+        writer = ViewStore(args.view_store).writer()
+
+    uid_paths = pickle.load(open(args.object_path_pkl, 'rb'))
+    for uid in uid_paths:
+        if not os.path.exists(uid):
+            print('object not exist, check the file path')
+            continue
+
+        cur_output_path = os.path.join(args.parent_dir, 'Cap3D_imgs/%s'%(uid.split('/')[-1].split('.')[0]))
+        os.makedirs(cur_output_path, exist_ok=True)
+        type2.report_status(args.status_file, 'start', uid)
+        try:
+            render_object(uid, cur_output_path, args, light)
+            if writer is not None:
+                writer.pack(os.path.basename(cur_output_path), cur_output_path, delete=True)
+        except Exception:
+            print('render failed:', uid)
+            type2.report_status(args.status_file, 'fail', uid, traceback.format_exc())
+            continue
+        type2.report_status(args.status_file, 'done', uid)
+    if writer is not None:
+        writer.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -19,21 +19,21 @@ import pickle
 from PIL import Image
 import random
 import json
+import traceback
 
 ### solve the division problem
 from decimal import Decimal, getcontext
 
 getcontext().prec = 28  # Set the precision for the decimal calculations.
 
-parser = argparse.ArgumentParser()
-parser.add_argument('--object_path_pkl', type = str, default = './example_material/example_object_path.pkl')
-parser.add_argument('--parent_dir', type = str, default = './example_material')
+# set by main(); render_script.py imports this file and calls render_views() itself
+args = None
 
-argv = sys.argv[sys.argv.index("--") + 1 :]
-args = parser.parse_args(argv)
-
-uid_paths = pickle.load(open(args.object_path_pkl, 'rb'))
-# random.shuffle(uids)
+def report_status(status, uid, message=''):
+    if args.status_file == 'none':
+        return
+    with open(args.status_file, 'a') as f:
+        f.write('%s\t%s\t%s\n' % (status, uid, json.dumps(message)))
 
 def compute_bounding_box(mesh_objects):
     min_coords = Vector((float('inf'), float('inf'), float('inf')))
@@ -282,6 +282,43 @@ def setup_material_extraction_shaders(capturing_material_alpha: bool):
             undo_fns.append(undo_fn)
     return lambda: [undo_fn() for undo_fn in undo_fns]
 
+def setup_material_aov_for_material(mat, aov_name: str, input_name: str):
+    mat.use_nodes = True
+
+    bsdf_node = None
+    for node in mat.node_tree.nodes:
+        if node.type == "BSDF_PRINCIPLED":
+            bsdf_node = node
+    assert bsdf_node is not None, "material has no Principled BSDF node to modify"
+
+    node_name = f"AOV {aov_name}"
+    if node_name in mat.node_tree.nodes:
+        # Materials keep their AOV outputs across views.
+        return
+    source_socket, default = get_socket_value(mat.node_tree, bsdf_node.inputs[input_name])
+    aov_node = mat.node_tree.nodes.new("ShaderNodeOutputAOV")
+    aov_node.name = node_name
+    aov_node.aov_name = aov_name
+    aov_input = aov_node.inputs["Value" if isinstance(default, float) else "Color"]
+    if source_socket is not None:
+        mat.node_tree.links.new(source_socket, aov_input)
+    else:
+        aov_input.default_value = default
+
+def setup_material_aovs(aov_name: str, input_name: str, aov_type: str = "VALUE"):
+    """
+    Make every material write the value of one Principled BSDF input into a
+    shader AOV, next to its regular shading, so that the compositor gets it as
+    a render pass of the same render.
+    """
+    view_layer = bpy.context.scene.view_layers["ViewLayer"]
+    if not any(aov.name == aov_name for aov in view_layer.aovs):
+        aov = view_layer.aovs.add()
+        aov.name = aov_name
+        aov.type = aov_type
+    for mat in find_materials():
+        setup_material_aov_for_material(mat, aov_name, input_name)
+
 def scene_bbox(single_obj=None, ignore_matrix=False):
     bbox_min = (math.inf,) * 3
     bbox_max = (-math.inf,) * 3
@@ -461,11 +498,11 @@ def render_scene(output_path, fast_mode: bool, extract_material: bool, basic_lig
         for do_alpha in [False, True]:
             undo_fn = setup_material_extraction_shaders(capturing_material_alpha=do_alpha)
             setup_nodes(output_path, capturing_material_alpha=do_alpha)
-            bpy.ops.render.render(write_still=True)
+            render(write_still=True)
             undo_fn()
     else:
         setup_nodes(output_path, basic_lighting=basic_lighting)
-        bpy.ops.render.render(write_still=True)
+        render(write_still=True)
 
     # The output images must be moved from their own sub-directories, or
     # discarded if we are using workbench for the color.
@@ -493,17 +530,96 @@ def render_scene(output_path, fast_mode: bool, extract_material: bool, basic_lig
         bpy.context.scene.world.node_tree.nodes["Background"].inputs[0].default_value = (0, 0, 0, 0)
         bpy.context.scene.render.film_transparent = True
         os.remove(output_path)
-        bpy.ops.render.render(write_still=True)
+        render(write_still=True)
+
+def setup_single_pass_nodes(output_path, extract_material: bool):
+    """
+    Write every output of a view from one File Output node, with file names
+    that only lack the frame number. Returns the names.
+    """
+    tree = bpy.context.scene.node_tree
+    links = tree.links
+
+    for node in tree.nodes:
+        tree.nodes.remove(node)
+
+    input_node = tree.nodes.new(type="CompositorNodeRLayers")
+    input_node.scene = bpy.context.scene
+    input_sockets = {}
+    for output in input_node.outputs:
+        input_sockets[output.name] = output
+
+    depth_node = tree.nodes.new(type="CompositorNodeMath")
+    depth_node.operation = "MULTIPLY"
+    depth_node.use_clamp = True
+    links.new(input_sockets["Depth"], depth_node.inputs[0])
+    depth_node.inputs[1].default_value = 1 / MAX_DEPTH
+
+    name = os.path.splitext(os.path.basename(output_path))[0]
+    outputs = [(name, input_sockets["Image"], "RGBA"), (f"{name}_depth", depth_node.outputs[0], "BW")]
+    if extract_material:
+        outputs.append((f"{name}_MatAlpha", input_sockets["MatAlpha"], "BW"))
+
+    output_node = tree.nodes.new(type="CompositorNodeOutputFile")
+    output_node.base_path = os.path.dirname(output_path)
+    output_node.file_slots.remove(output_node.inputs[0])
+    for file_name, socket, color_mode in outputs:
+        slot = output_node.file_slots.new(file_name)
+        slot.use_node_format = False
+        slot.format.file_format = "PNG"
+        slot.format.color_mode = color_mode
+        slot.format.color_depth = "16"
+        links.new(socket, output_node.inputs[-1])
+    return [file_name for file_name, _, _ in outputs]
+
+def render_scene_single_pass(output_path, extract_material: bool):
+    """
+    Render what render_scene() renders with one Cycles render: the lit RGBA
+    image, depth from the Z pass, and the material alpha from a shader AOV
+    instead of an emission-only render. Nothing is written to be deleted later.
+    """
+    bpy.context.scene.render.engine = "CYCLES"
+    bpy.context.scene.cycles.samples = 16
+    bpy.context.scene.cycles.use_denoising = True
+    bpy.context.scene.cycles.denoiser = 'OPTIX'
+    bpy.context.view_layer.update()
+    bpy.context.scene.use_nodes = True
+    bpy.context.scene.view_layers["ViewLayer"].use_pass_z = True
+    if extract_material:
+        # render_scene() takes depth from a render where every material is
+        # opaque, so let every surface write depth.
+        bpy.context.scene.view_layers["ViewLayer"].pass_alpha_threshold = 0.0
+        setup_material_aovs("MatAlpha", "Alpha")
+    else:
+        bpy.context.scene.view_layers["ViewLayer"].pass_alpha_threshold = 0.5
+    bpy.context.scene.view_settings.view_transform = "Raw"
+    bpy.context.scene.render.film_transparent = True
+    bpy.context.scene.render.resolution_x = 512
+    bpy.context.scene.render.resolution_y = 512
+    bpy.context.scene.world.node_tree.nodes["Background"].inputs[0].default_value = (0, 0, 0, 0)
+    file_names = setup_single_pass_nodes(output_path, extract_material)
+    render(write_still=False)
+
+    # File Output nodes always append the frame number.
+    frame = bpy.context.scene.frame_current
+    output_dir = os.path.dirname(output_path)
+    for file_name in file_names:
+        os.replace(os.path.join(output_dir, f"{file_name}{frame:04d}.png"), os.path.join(output_dir, f"{file_name}.png"))
+
+num_renders = 0
+
+def render(write_still: bool):
+    global num_renders
+    num_renders += 1
+    bpy.ops.render.render(write_still=write_still)
 
 start_time = time.time()
 load_time = []
 render_time = []
 file_size = []
 dis = []
-for uid in uid_paths:
-    if not os.path.exists(uid):
-        print('object not exist, check the file path')
-        continue
+
+def render_object(uid):
     bpy.ops.object.select_by_type(type='MESH')
     bpy.ops.object.delete()
 
@@ -535,10 +651,17 @@ for uid in uid_paths:
     distance = max(bbox_size.x, bbox_size.y, bbox_size.z)
     dis.append(distance)
     create_vertex_color_shaders()
-    num_images = 8
-    camera_pose = "z-circular-elevated"
     cur_path = os.path.join(args.parent_dir, 'Cap3D_imgs/%s'%(uid.split('/')[-1].split('.')[0]))
     os.makedirs(cur_path, exist_ok=True)
+    render_views(cur_path, single_pass=args.single_pass)
+
+def render_views(cur_path, num_images=8, camera_pose="z-circular-elevated", first_index=20, single_pass=False):
+    """
+    Render the views of the imported, normalized object as {first_index + i:05}.png
+    and return their camera transforms, in the frame format of transforms_train.json.
+    """
+    camera_data = []
+    renders_before = num_renders
     for i in range(num_images):
         t = i / max(num_images - 1, 1)  # same as np.linspace(0, 1, num_images)
         place_camera(
@@ -553,20 +676,62 @@ for uid in uid_paths:
         transform_matrix_list = []
         for row in transform_matrix:
             transform_matrix_list.append(list(row))
+        camera_data.append({
+            "file_path": f"{i+first_index:05}",
+            "rotation": rotation,
+            "transform_matrix": transform_matrix_list
+        })
         try:
-            render_scene(
-               os.path.join(cur_path, f"{i+20:05}.png"),
-               fast_mode=True,
-               extract_material=True,
-               basic_lighting=True,
-            )
+            if single_pass:
+                render_scene_single_pass(os.path.join(cur_path, f"{i+first_index:05}.png"), extract_material=True)
+            else:
+                render_scene(
+                   os.path.join(cur_path, f"{i+first_index:05}.png"),
+                   fast_mode=True,
+                   extract_material=True,
+                   basic_lighting=True,
+                )
         except:
-            render_scene(
-               os.path.join(cur_path, f"{i+20:05}.png"),
-               fast_mode=True,
-               extract_material=False,
-               basic_lighting=False,
-            )
+            if single_pass:
+                render_scene_single_pass(os.path.join(cur_path, f"{i+first_index:05}.png"), extract_material=False)
+            else:
+                render_scene(
+                   os.path.join(cur_path, f"{i+first_index:05}.png"),
+                   fast_mode=True,
+                   extract_material=False,
+                   basic_lighting=False,
+                )
             print('render_scene with material failed')
-        write_camera_metadata(os.path.join(cur_path, f"{i+20:05}.json"))
-    continue
+        write_camera_metadata(os.path.join(cur_path, f"{i+first_index:05}.json"))
+    print('%d views, %.1f renders per view' % (num_images, (num_renders - renders_before) / num_images))
+    return camera_data
+
+def main():
+    global args
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--object_path_pkl', type = str, default = './example_material/example_object_path.pkl')
+    parser.add_argument('--parent_dir', type = str, default = './example_material')
+    parser.add_argument('--status_file', type = str, default = 'none', help = 'append start/done/fail lines per object, read by render_launcher.py')
+    parser.add_argument('--single_pass', action = 'store_true', help = 'render RGBA, depth and MatAlpha of a view with one render instead of three')
+
+    argv = sys.argv[sys.argv.index("--") + 1 :]
+    args = parser.parse_args(argv)
+
+    uid_paths = pickle.load(open(args.object_path_pkl, 'rb'))
+    # random.shuffle(uids)
+
+    for uid in uid_paths:
+        if not os.path.exists(uid):
+            print('object not exist, check the file path')
+            continue
+        report_status('start', uid)
+        try:
+            render_object(uid)
+        except Exception:
+            print('render failed:', uid)
+            report_status('fail', uid, traceback.format_exc())
+            continue
+        report_status('done', uid)
+
+if __name__ == "__main__":
+    main()
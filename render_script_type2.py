@@ -11,6 +11,7 @@ import math
 import os
 import random
 import sys
+import traceback
 
 import bpy
 from mathutils import Vector
@@ -20,11 +21,14 @@ import pickle
 MAX_DEPTH = 5.0
 FORMAT_VERSION = 6
 
+DEFAULT_UNIFORM_LIGHT_DIRECTION = [0.09387503, -0.63953443, -0.7630093]
+
 # Set by main(), these constants are passed to the script to avoid
 # duplicating them across multiple files.
 UNIFORM_LIGHT_DIRECTION = None
 BASIC_AMBIENT_COLOR = None
 BASIC_DIFFUSE_COLOR = None
+SINGLE_PASS = False
 
 
 def clear_scene():
@@ -247,12 +251,18 @@ def create_vertex_color_shaders():
 
 
 def create_default_materials():
+    """
+    Give every mesh without materials a default one. Returns these meshes.
+    """
+    objects = []
     for obj in bpy.context.scene.objects.values():
         if isinstance(obj.data, (bpy.types.Mesh)):
             if not len(obj.data.materials):
                 mat = bpy.data.materials.new(name="DefaultMaterial")
                 mat.use_nodes = True
                 obj.data.materials.append(mat)
+                objects.append(obj)
+    return objects
 
 
 def find_materials():
@@ -343,6 +353,45 @@ def setup_material_extraction_shader_for_material(mat, capturing_material_alpha:
     return undo_fn
 
 
+def setup_material_aov_for_material(mat, aov_name: str, input_name: str):
+    mat.use_nodes = True
+
+    bsdf_node = None
+    for node in mat.node_tree.nodes:
+        if node.type == "BSDF_PRINCIPLED":
+            bsdf_node = node
+    assert bsdf_node is not None, "material has no Principled BSDF node to modify"
+
+    node_name = f"AOV {aov_name}"
+    if node_name in mat.node_tree.nodes:
+        # Materials keep their AOV outputs across views.
+        return
+    source_socket, default = get_socket_value(mat.node_tree, bsdf_node.inputs[input_name])
+    aov_node = mat.node_tree.nodes.new("ShaderNodeOutputAOV")
+    aov_node.name = node_name
+    aov_node.aov_name = aov_name
+    aov_input = aov_node.inputs["Value" if isinstance(default, float) else "Color"]
+    if source_socket is not None:
+        mat.node_tree.links.new(source_socket, aov_input)
+    else:
+        aov_input.default_value = default
+
+
+def setup_material_aovs(aov_name: str, input_name: str, aov_type: str = "VALUE"):
+    """
+    Make every material write the value of one Principled BSDF input into a
+    shader AOV, next to its regular shading, so that the compositor gets it as
+    a render pass of the same render.
+    """
+    view_layer = bpy.context.scene.view_layers["ViewLayer"]
+    if not any(aov.name == aov_name for aov in view_layer.aovs):
+        aov = view_layer.aovs.add()
+        aov.name = aov_name
+        aov.type = aov_type
+    for mat in find_materials():
+        setup_material_aov_for_material(mat, aov_name, input_name)
+
+
 def get_socket_value(tree, socket):
     default = socket.default_value
     if not isinstance(default, float):
@@ -508,11 +557,11 @@ def render_scene(output_path, fast_mode: bool, extract_material: bool, basic_lig
         for do_alpha in [False, True]:
             undo_fn = setup_material_extraction_shaders(capturing_material_alpha=do_alpha)
             setup_nodes(output_path, capturing_material_alpha=do_alpha)
-            bpy.ops.render.render(write_still=True)
+            render(write_still=True)
             undo_fn()
     else:
         setup_nodes(output_path, basic_lighting=basic_lighting)
-        bpy.ops.render.render(write_still=True)
+        render(write_still=True)
 
     # The output images must be moved from their own sub-directories, or
     # discarded if we are using workbench for the color.
@@ -535,7 +584,7 @@ def render_scene(output_path, fast_mode: bool, extract_material: bool, basic_lig
         bpy.context.scene.render.image_settings.color_mode = "RGBA"
         bpy.context.scene.render.image_settings.color_depth = "16"
         os.remove(output_path)
-        bpy.ops.render.render(write_still=True)
+        render(write_still=True)
         ## Re-render RGBA using workbench with texture mode, since this seems
         ## to show the most reasonable colors when lighting is broken.
         #bpy.context.scene.use_nodes = False
@@ -553,6 +602,122 @@ def render_scene(output_path, fast_mode: bool, extract_material: bool, basic_lig
         #bpy.context.scene.render.image_settings.color_depth = "16"
 
 
+def setup_single_pass_nodes(output_path, extract_material: bool):
+    """
+    Write every output of a view from one File Output node, with file names
+    that only lack the frame number. Returns the names.
+
+    With extract_material, the render must be the material alpha emission
+    render, and the material colors come from the MatColor AOV.
+    """
+    tree = bpy.context.scene.node_tree
+    links = tree.links
+
+    for node in tree.nodes:
+        tree.nodes.remove(node)
+
+    input_node = tree.nodes.new(type="CompositorNodeRLayers")
+    input_node.scene = bpy.context.scene
+    input_sockets = {}
+    for output in input_node.outputs:
+        input_sockets[output.name] = output
+
+    depth_node = tree.nodes.new(type="CompositorNodeMath")
+    depth_node.operation = "MULTIPLY"
+    depth_node.use_clamp = True
+    links.new(input_sockets["Depth"], depth_node.inputs[0])
+    depth_node.inputs[1].default_value = 1 / MAX_DEPTH
+
+    image_split_node = tree.nodes.new(type="CompositorNodeSepRGBA")
+    links.new(input_sockets["Image"], image_split_node.inputs[0])
+
+    if extract_material:
+        # Show the world color where no surface was hit, as the emission
+        # render of render_scene() does. Cycles writes a depth of 1e10 there.
+        background_node = tree.nodes.new(type="CompositorNodeMath")
+        background_node.operation = "GREATER_THAN"
+        links.new(input_sockets["Depth"], background_node.inputs[0])
+        background_node.inputs[1].default_value = 1e9
+        mix_node = tree.nodes.new(type="CompositorNodeMixRGB")
+        links.new(background_node.outputs[0], mix_node.inputs[0])
+        links.new(input_sockets["MatColor"], mix_node.inputs[1])
+        mix_node.inputs[2].default_value = bpy.context.scene.world.node_tree.nodes["Background"].inputs[0].default_value
+        raw_color_socket = mix_node.outputs[0]
+    else:
+        raw_color_socket = input_sockets["Image"]
+    color_node = tree.nodes.new(type="CompositorNodeConvertColorSpace")
+    color_node.from_color_space = "Linear"
+    color_node.to_color_space = "sRGB"
+    links.new(raw_color_socket, color_node.inputs[0])
+    split_node = tree.nodes.new(type="CompositorNodeSepRGBA")
+    links.new(color_node.outputs[0], split_node.inputs[0])
+
+    name = os.path.splitext(os.path.basename(output_path))[0]
+    outputs = [(name, input_sockets["Image"])]
+    outputs += [(f"{name}_{channel}", split_node.outputs[i]) for i, channel in enumerate("rgb")]
+    # Without a transparent film, alpha is 1 in every render.
+    outputs.append((f"{name}_a", image_split_node.outputs[3]))
+    outputs.append((f"{name}_depth", depth_node.outputs[0]))
+    if extract_material:
+        outputs.append((f"{name}_MatAlpha", image_split_node.outputs[0]))
+
+    output_node = tree.nodes.new(type="CompositorNodeOutputFile")
+    output_node.base_path = os.path.dirname(output_path)
+    output_node.format.file_format = "PNG"
+    output_node.format.color_mode = "BW"
+    output_node.format.color_depth = "16"
+    output_node.file_slots.remove(output_node.inputs[0])
+    for file_name, socket in outputs:
+        output_node.file_slots.new(file_name)
+        links.new(socket, output_node.inputs[-1])
+    return [file_name for file_name, _ in outputs]
+
+
+def render_scene_single_pass(output_path, extract_material: bool):
+    """
+    Render what render_scene() renders with one Cycles render instead of two:
+    the material alpha emission render gives the image, MatAlpha and depth,
+    and the material colors come from a shader AOV of the same render.
+    Nothing is written to be overwritten or deleted later.
+    """
+    bpy.context.scene.render.engine = "CYCLES"
+    bpy.context.scene.cycles.samples = 16
+    bpy.context.scene.cycles.use_denoising = True
+    bpy.context.scene.cycles.denoiser = 'OPTIX'
+    bpy.context.view_layer.update()
+    bpy.context.scene.use_nodes = True
+    bpy.context.scene.view_layers["ViewLayer"].use_pass_z = True
+    bpy.context.scene.view_settings.view_transform = "Raw"  # sRGB done in graph nodes
+    bpy.context.scene.render.resolution_x = 512
+    bpy.context.scene.render.resolution_y = 512
+    bpy.context.scene.world.node_tree.nodes["Background"].inputs[0].default_value = (0.81, 0.81, 0.81, 0.81)
+    bpy.context.scene.render.film_transparent = False
+    if extract_material:
+        setup_material_aovs("MatColor", "Base Color", aov_type="COLOR")
+        undo_fn = setup_material_extraction_shaders(capturing_material_alpha=True)
+    file_names = setup_single_pass_nodes(output_path, extract_material)
+    try:
+        render(write_still=False)
+    finally:
+        if extract_material:
+            undo_fn()
+
+    # File Output nodes always append the frame number.
+    frame = bpy.context.scene.frame_current
+    output_dir = os.path.dirname(output_path)
+    for file_name in file_names:
+        os.replace(os.path.join(output_dir, f"{file_name}{frame:04d}.png"), os.path.join(output_dir, f"{file_name}.png"))
+
+
+num_renders = 0
+
+
+def render(write_still: bool):
+    global num_renders
+    num_renders += 1
+    bpy.ops.render.render(write_still=write_still)
+
+
 def scene_fov():
     x_fov = bpy.context.scene.camera.data.angle_x
     y_fov = bpy.context.scene.camera.data.angle_y
@@ -599,8 +764,27 @@ def save_rendering_dataset(
     extract_material: bool,
     delete_material: bool,
 ):
-    assert light_mode in ["random", "uniform", "camera", "basic"]
     assert camera_pose in ["random", "z-circular", "z-circular-elevated"]
+    setup_scene(input_path, backend, light_mode, extract_material, delete_material)
+    camera_data = render_views(
+        output_path,
+        num_images=num_images,
+        light_mode=light_mode,
+        camera_pose=camera_pose,
+        camera_dist_min=camera_dist_min,
+        camera_dist_max=camera_dist_max,
+        fast_mode=fast_mode,
+        extract_material=extract_material,
+    )
+    write_dataset_metadata(output_path, camera_data, backend, light_mode, fast_mode, extract_material)
+
+
+def setup_scene(input_path: str, backend: str, light_mode: str, extract_material: bool, delete_material: bool):
+    """
+    Import and normalize the object and set up lights, camera and materials.
+    Returns the meshes that were given a default material.
+    """
+    assert light_mode in ["random", "uniform", "camera", "basic"]
 
     basic_lighting = light_mode == "basic"
     assert not (basic_lighting and extract_material), "cannot extract material with basic lighting"
@@ -616,21 +800,36 @@ def save_rendering_dataset(
     create_camera()
     create_vertex_color_shaders()
 
+    default_material_objects = []
     if delete_material:
         delete_all_materials()
     if extract_material or basic_lighting:
-        create_default_materials()
+        default_material_objects = create_default_materials()
     if basic_lighting:
         # Make sure materials are uniformly lit, so that we can light
         # them in the output shader.
         setup_material_extraction_shaders(capturing_material_alpha=False)
+    return default_material_objects
 
+
+def render_views(
+    output_path: str,
+    num_images: int,
+    light_mode: str,
+    camera_pose: str,
+    camera_dist_min: float,
+    camera_dist_max: float,
+    fast_mode: bool,
+    extract_material: bool,
+):
+    """
+    Render the views of the scene set up by setup_scene() and return their
+    camera transforms, the frames of transforms_train.json.
+    """
+    basic_lighting = light_mode == "basic"
     camera_data = []
-    # Assuming you have one camera in the scene
-    camera = bpy.context.scene.camera  
-    # Retrieve the camera's angle_x value (in radians)
-    camera_angle_x = camera.data.angle_x
 
+    renders_before = num_renders
     for i in range(num_images):
         t = i / max(num_images - 1, 1)  # same as np.linspace(0, 1, num_images)
         place_camera(
@@ -656,13 +855,26 @@ def save_rendering_dataset(
             "transform_matrix": transform_matrix_list
         })
 
-        render_scene(
-            os.path.join(output_path, f"{i:05}.png"),
-            fast_mode=fast_mode,
-            extract_material=extract_material,
-            basic_lighting=basic_lighting,
-        )
+        if SINGLE_PASS and not basic_lighting:
+            render_scene_single_pass(os.path.join(output_path, f"{i:05}.png"), extract_material=extract_material)
+        else:
+            render_scene(
+                os.path.join(output_path, f"{i:05}.png"),
+                fast_mode=fast_mode,
+                extract_material=extract_material,
+                basic_lighting=basic_lighting,
+            )
         write_camera_metadata(os.path.join(output_path, f"{i:05}.json"))
+    print('%d views, %.1f renders per view' % (num_images, (num_renders - renders_before) / num_images))
+    return camera_data
+
+
+def write_dataset_metadata(output_path, camera_data, backend, light_mode, fast_mode, extract_material):
+    # Assuming you have one camera in the scene
+    camera = bpy.context.scene.camera  
+    # Retrieve the camera's angle_x value (in radians)
+    camera_angle_x = camera.data.angle_x
+
     # Wrap the camera data in a dictionary under the "camera_transforms" key
     output_data = {"camera_angle_x": camera_angle_x, "frames": camera_data}
 
@@ -685,8 +897,46 @@ def save_rendering_dataset(
         json.dump(info, f)
 
 
+def report_status(status_file, status, uid, message=''):
+    if status_file == 'none':
+        return
+    with open(status_file, 'a') as f:
+        f.write('%s\t%s\t%s\n' % (status, uid, json.dumps(message)))
+
+
+def render_object(uid, cur_output_path, args):
+    try:
+        save_rendering_dataset(
+            input_path=uid,
+            output_path=cur_output_path,
+            num_images=args.num_images,
+            backend=args.backend,
+            light_mode=args.light_mode,
+            camera_pose=args.camera_pose,
+            camera_dist_min=args.camera_dist_min,
+            camera_dist_max=args.camera_dist_max,
+            fast_mode=args.fast_mode,
+            extract_material=args.extract_material,
+            delete_material=args.delete_material,
+        )
+    except:
+        save_rendering_dataset(
+            input_path=uid,
+            output_path=cur_output_path,
+            num_images=args.num_images,
+            backend=args.backend,
+            light_mode='random',
+            camera_pose=args.camera_pose,
+            camera_dist_min=args.camera_dist_min,
+            camera_dist_max=args.camera_dist_max,
+            fast_mode=args.fast_mode,
+            extract_material=False,
+            delete_material=args.delete_material,
+        )
+
+
 def main():
-    global UNIFORM_LIGHT_DIRECTION, BASIC_AMBIENT_COLOR, BASIC_DIFFUSE_COLOR
+    global UNIFORM_LIGHT_DIRECTION, BASIC_AMBIENT_COLOR, BASIC_DIFFUSE_COLOR, SINGLE_PASS
 
     try:
         dash_index = sys.argv.index("--")
@@ -697,6 +947,7 @@ def main():
     parser = argparse.ArgumentParser()
     parser.add_argument('--object_path_pkl', type = str, default = './example_material/example_object_path.pkl')
     parser.add_argument('--parent_dir', type = str, default = './example_material')
+    parser.add_argument('--status_file', type = str, default = 'none', help = 'append start/done/fail lines per object, read by render_launcher.py')
     parser.add_argument("--num_images", type=int, default=20)
     parser.add_argument("--backend", type=str, default="CYCLES")
     parser.add_argument("--light_mode", type=str, default="uniform")
@@ -706,9 +957,10 @@ def main():
     parser.add_argument("--fast_mode", action="store_true", default=True)
     parser.add_argument("--extract_material", action="store_true", default=True)
     parser.add_argument("--delete_material", action="store_true")
+    parser.add_argument("--single_pass", action="store_true", help="render every output of a view with one render instead of two")
 
     # Prevent constants from being repeated.
-    UNIFORM_LIGHT_DIRECTION = [0.09387503, -0.63953443, -0.7630093]
+    UNIFORM_LIGHT_DIRECTION = DEFAULT_UNIFORM_LIGHT_DIRECTION
     default_uniform_light_direction = [str(x) for x in UNIFORM_LIGHT_DIRECTION]
     parser.add_argument(
         "--uniform_light_direction",
@@ -723,6 +975,7 @@ def main():
     UNIFORM_LIGHT_DIRECTION = args.uniform_light_direction
     BASIC_AMBIENT_COLOR = args.basic_ambient
     BASIC_DIFFUSE_COLOR = args.basic_diffuse
+    SINGLE_PASS = args.single_pass
 
     # args.backend = "CYCLES"
     uid_paths = pickle.load(open(args.object_path_pkl, 'rb'))
@@ -732,34 +985,15 @@ def main():
             continue
 
         cur_output_path = os.path.join(args.parent_dir, 'Cap3D_imgs/%s'%(uid.split('/')[-1].split('.')[0]))
+        report_status(args.status_file, 'start', uid)
         try:
-            save_rendering_dataset(
-                input_path=uid,
-                output_path=cur_output_path,
-                num_images=args.num_images,
-                backend=args.backend,
-                light_mode=args.light_mode,
-                camera_pose=args.camera_pose,
-                camera_dist_min=args.camera_dist_min,
-                camera_dist_max=args.camera_dist_max,
-                fast_mode=args.fast_mode,
-                extract_material=args.extract_material,
-                delete_material=args.delete_material,
-            )
-        except:
-            save_rendering_dataset(
-                input_path=uid,
-                output_path=cur_output_path,
-                num_images=args.num_images,
-                backend=args.backend,
-                light_mode='random',
-                camera_pose=args.camera_pose,
-                camera_dist_min=args.camera_dist_min,
-                camera_dist_max=args.camera_dist_max,
-                fast_mode=args.fast_mode,
-                extract_material=False,
-                delete_material=args.delete_material,
-            )
+            render_object(uid, cur_output_path, args)
+        except Exception:
+            print('render failed:', uid)
+            report_status(args.status_file, 'fail', uid, traceback.format_exc())
+            continue
+        report_status(args.status_file, 'done', uid)
 
 
-main()
+if __name__ == "__main__":
+    main()
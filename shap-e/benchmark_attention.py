@@ -0,0 +1,77 @@
+# ==============================================================================
+# Compare the attention backends of the shap-e transformers.
+#
+# Builds a randomly initialized transformer backbone shaped like text300M
+# (1024 latent tokens plus one conditioning token), checks that the "sdpa"
+# backend matches the "einsum" backend numerically, and reports the forward
+# latency and peak device memory of both backends per batch size.
+#
+# python benchmark_attention.py --batch_sizes 1,35,70,140 --dtype float16
+# ==============================================================================
+
+import argparse
+import time
+
+import torch
+
+from shap_e.models.generation.transformer import ATTENTION_BACKENDS, Transformer, attention_backend
+
+
+def measure(model, x, device, repeats):
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+        torch.cuda.reset_peak_memory_stats(device)
+    start = time.time()
+    for _ in range(repeats):
+        out = model(x)
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+        peak = torch.cuda.max_memory_allocated(device) / 2**20
+    else:
+        peak = float('nan')
+    return out, (time.time() - start) / repeats, peak
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--batch_sizes', type = str, default = '1,35,70,140')
+    parser.add_argument('--n_ctx', type = int, default = 1025, help = 'tokens per sequence')
+    parser.add_argument('--width', type = int, default = 1024)
+    parser.add_argument('--heads', type = int, default = 16)
+    parser.add_argument('--layers', type = int, default = 4, help = 'text300M has 24, fewer keep the benchmark short')
+    parser.add_argument('--dtype', type = str, default = 'float32', choices = ['float32', 'float16', 'bfloat16'])
+    parser.add_argument('--repeats', type = int, default = 3)
+    args = parser.parse_args()
+
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    dtype = getattr(torch, args.dtype)
+    torch.manual_seed(0)
+    model = Transformer(
+        device=device, dtype=dtype, n_ctx=args.n_ctx, width=args.width, layers=args.layers, heads=args.heads
+    ).eval()
+
+    print('%6s %-8s %12s %14s %12s' % ('batch', 'backend', 'latency (s)', 'peak mem (MiB)', 'max |diff|'))
+    with torch.no_grad():
+        for batch_size in [int(x) for x in args.batch_sizes.split(',')]:
+            x = torch.randn(batch_size, args.n_ctx, args.width, device=device, dtype=dtype)
+            reference = None
+            for backend in ATTENTION_BACKENDS:
+                with attention_backend(backend):
+                    try:
+                        model(x[:1])  # warmup
+                        out, latency, peak = measure(model, x, device, args.repeats)
+                    except torch.cuda.OutOfMemoryError:
+                        print('%6d %-8s %12s %14s %12s' % (batch_size, backend, 'OOM', '-', '-'))
+                        continue
+                if reference is None:
+                    reference = out
+                diff = (out.float() - reference.float()).abs().max().item()
+                print('%6d %-8s %12.4f %14.1f %12.2e' % (batch_size, backend, latency, peak, diff))
+                del out
+            del x, reference
+            if device.type == 'cuda':
+                torch.cuda.empty_cache()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,115 @@
+# ==============================================================================
+# Benchmark how quickly DiffuRank view rankings stabilize under different
+# timestep/noise sampling designs.
+#
+# For a handful of objects we compute a high-budget reference ranking, then
+# re-score every object with each design at increasing pass counts and report
+# the rank agreement (Spearman correlation and top-k overlap) against the
+# reference, together with the number of model evaluations spent.
+#
+# python benchmark_diffurank_sampling.py --num_objects 8 --ref_passes 40
+# ==============================================================================
+
+import argparse
+import glob
+import os
+import pickle
+
+import torch
+
+from shap_e.diffusion.diffurank import diffurank_view_scores
+from shap_e.diffusion.gaussian_diffusion import diffusion_from_config
+from shap_e.models.download import load_config, load_model
+from shap_e.models.generation.text_cache import TextEmbeddingCache
+
+DESIGNS = [
+    ('iid', False),
+    ('iid', True),
+    ('stratified', False),
+    ('stratified', True),
+    ('sobol', False),
+    ('sobol', True),
+]
+
+
+def spearman(a, b):
+    ra = a.argsort(-1).argsort(-1).float()
+    rb = b.argsort(-1).argsort(-1).float()
+    ra = ra - ra.mean(-1, keepdim=True)
+    rb = rb - rb.mean(-1, keepdim=True)
+    return (ra * rb).sum(-1) / (ra.norm(dim=-1) * rb.norm(dim=-1))
+
+
+def top_k_overlap(a, b, k):
+    top_a = a.argsort(-1)[..., :k]
+    top_b = b.argsort(-1)[..., :k]
+    return (top_a[..., :, None] == top_b[..., None, :]).any(-1).float().mean(-1)
+
+
+def load_objects(args):
+    latents, prompts = [], []
+    for path in sorted(glob.glob(args.image_dir+'/*')):
+        uid = path.split('/')[-1]
+        latent_file = os.path.join(args.latent_dir, uid+'.pt')
+        caption_file = os.path.join(path, 'caption.pkl')
+        if not os.path.exists(latent_file) or not os.path.exists(caption_file):
+            continue
+        captions = pickle.load(open(caption_file, 'rb'))
+        if any(len(captions.get(i, [])) != 5 for i in range(28)):
+            continue
+        latents.append(torch.load(latent_file, map_location='cpu').reshape(1, -1))
+        prompts.append(sum((captions[i] for i in range(28)), []))
+        if len(latents) == args.num_objects:
+            break
+    return torch.cat(latents), prompts
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--image_dir', type = str, default='../example_material/Cap3D_imgs')
+    parser.add_argument('--latent_dir', type = str, default='../example_material/extracted_shapE_latent')
+    parser.add_argument('--num_objects', type = int, default = 8)
+    parser.add_argument('--ref_passes', type = int, default = 40, help = 'passes for the reference ranking')
+    parser.add_argument('--max_passes', type = int, default = 5)
+    parser.add_argument('--repeats', type = int, default = 4, help = 'independent trials per setting')
+    parser.add_argument('--top_k', type = int, default = 6)
+    parser.add_argument('--max_batch', type = int, default = 140)
+    parser.add_argument('--seed', type = int, default = 0)
+    args = parser.parse_args()
+
+    torch.manual_seed(args.seed)
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    model = load_model('text300M', device=device)
+    diffusion = diffusion_from_config(load_config('diffusion'))
+    text_cache = TextEmbeddingCache(model.wrapped.clip)
+
+    latents, prompts = load_objects(args)
+    latents = latents.to(device)
+    embeddings = torch.stack([text_cache.embed(prompt) for prompt in prompts])
+    num_objects = len(latents)
+    rows_per_pass = embeddings.shape[1]
+    print('objects: %d, rows per pass per object: %d' % (num_objects, rows_per_pass))
+
+    reference = diffurank_view_scores(
+        diffusion, model, latents, embeddings, num_views=28, num_passes=args.ref_passes, max_batch=args.max_batch
+    ).view_scores
+
+    print('%-12s %-10s %6s %12s %10s %10s' % ('t_design', 'antithetic', 'passes', 'evals/object', 'spearman', 'top%d' % args.top_k))
+    for t_design, antithetic in DESIGNS:
+        for num_passes in range(1, args.max_passes + 1):
+            rho, overlap = [], []
+            for _ in range(args.repeats):
+                scores = diffurank_view_scores(
+                    diffusion, model, latents, embeddings, num_views=28, num_passes=num_passes,
+                    max_batch=args.max_batch, t_design=t_design, antithetic=antithetic,
+                ).view_scores
+                rho.append(spearman(scores, reference))
+                overlap.append(top_k_overlap(scores, reference, args.top_k))
+            print('%-12s %-10s %6d %12d %10.4f %10.4f' % (
+                t_design, antithetic, num_passes, num_passes * rows_per_pass,
+                torch.cat(rho).mean().item(), torch.cat(overlap).mean().item(),
+            ))
+
+
+if __name__ == '__main__':
+    main()
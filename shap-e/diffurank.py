@@ -6,13 +6,20 @@
 # ==============================================================================
 
 import torch
+import torch.multiprocessing as mp
 import torch.optim as optim
 
 from shap_e.diffusion.sample import sample_latents
 from shap_e.diffusion.gaussian_diffusion import diffusion_from_config
+from shap_e.diffusion.diffurank import adaptive_view_scores, diffurank_view_scores
 from shap_e.models.download import load_model, load_config
 from shap_e.models.configs import model_from_config
+from shap_e.models.generation.text_cache import TextEmbeddingCache
+from shap_e.models.generation.transformer import set_attention_backend
+from shap_e.util.score_store import ScoreStore
+from shap_e.util.view_store import ViewStore, list_objects
 from shap_e.util.notebooks import create_pan_cameras, decode_latent_images, gif_widget
+from shap_e.util.work_queue import Lease, default_owner, shard_of
 
 import os
 import argparse
@@ -21,6 +28,7 @@ import pickle
 import pandas as pd
 import csv
 import time
+import queue
 import random
 import numpy as np
 from datetime import datetime
@@ -29,10 +37,67 @@ from PIL import Image
 
 from IPython import embed
 
-def train(rank, args):
-    if args.gpus > 1:
-        setup_ddp(rank, args)
+def score_objects(objects, diffusion, model, text_cache, args, device, score_writer=None):
+    """
+    Score all 28 views of several objects at once, packing their latents and
+    captions into shared forwards of at most args.max_batch rows. Scores go
+    to score_writer if given, otherwise to a pickle in every object folder.
+    """
+    latents = torch.cat([
+        torch.load(os.path.join(args.latent_dir, path.split('/')[-1]+'.pt'), map_location=device).reshape(1, -1)
+        for path, _ in objects
+    ])
+    embeddings = torch.stack([text_cache.embed(prompt) for _, prompt in objects])
+    if args.adaptive_top_k > 0:
+        # captioning_gpt.py only consumes the top-k views, so stop spending
+        # passes on views once that set is settled.
+        result = adaptive_view_scores(
+            diffusion, model, latents, embeddings, num_views=28, top_k=args.adaptive_top_k,
+            max_passes=5, min_passes=args.adaptive_min_passes, times=5,
+            confidence=args.adaptive_confidence, max_batch=args.max_batch, t_design=args.t_design,
+            antithetic=args.antithetic, dedup=not args.no_dedup,
+        )
+    else:
+        result = diffurank_view_scores(
+            diffusion, model, latents, embeddings, num_views=28, num_passes=5, times=5, max_batch=args.max_batch,
+            t_design=args.t_design, antithetic=args.antithetic, dedup=not args.no_dedup,
+        )
+    view_scores = result.view_scores
+    print('DiffuRank rows: %d/%d evaluated, %d saved (%.1f%%)' % (
+        result.num_rows, result.max_rows, result.rows_saved, 100.0 * result.rows_saved / result.max_rows))
+    if score_writer is not None:
+        rows_per_object = result.num_rows // len(objects)
+        for (path, _), scores in zip(objects, view_scores.cpu().numpy()):
+            score_writer.append(path.split('/')[-1], scores, num_rows=rows_per_object)
+        score_writer.flush()
+        return
+    for (path, _), scores in zip(objects, view_scores.cpu().numpy()):
+        # Write atomically, so a crash never leaves a truncated score file
+        # that later runs would mistake for a finished object.
+        index_file = os.path.join(path, 'diffurank_scores.pkl')
+        with open(index_file + '.tmp', 'wb') as f:
+            pickle.dump(scores, f)
+        os.replace(index_file + '.tmp', index_file)
 
+def score_pending(pending, diffusion, model, text_cache, args, device, rank, stats_queue, score_writer):
+    for _, _, lease in pending:
+        lease.renew()
+    try:
+        score_objects([(path, prompt) for path, prompt, _ in pending], diffusion, model, text_cache, args, device, score_writer)
+    finally:
+        for _, _, lease in pending:
+            lease.release()
+    if stats_queue is not None:
+        stats_queue.put((rank, len(pending)))
+
+def worker_device(rank, args):
+    if args.device == 'cuda' and torch.cuda.is_available():
+        return torch.device('cuda', rank % torch.cuda.device_count())
+    if args.cpu_threads > 0:
+        torch.set_num_threads(args.cpu_threads)
+    return torch.device('cpu')
+
+def train(rank, args, stats_queue=None):
     niter = 5
     batch_size = 8
     save_name = args.save_name
@@ -52,29 +117,60 @@ def train(rank, args):
     start_epoch = 0 if not resume_flag else int(args.resume_name.split('_')[-2][5:])
     start_iter = 0 if not resume_flag else int(args.resume_name.split('_')[-1].split('.')[0])
     
-    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    device = worker_device(rank, args)
+    set_attention_backend(args.attention)
+    load_start = time.time()
     if resume_flag:
         print('reload from ./model_ckpts/%s.pth'%args.resume_name)
         checkpoint = torch.load('./model_ckpts/%s.pth'%args.resume_name, map_location=device)
 
     if not resume_flag:
-        model = load_model('text300M', device=device)
+        # memory-mapped weights are shared by all workers on this host
+        model = load_model('text300M', device=device, mmap=not args.no_mmap_weights)
     else:
         model = model_from_config(load_config('text300M'), device=device)
         model.load_state_dict(checkpoint['model_state_dict'])
     model.eval()
-    if args.gpus > 1:
-        model = DistributedDataParallel(
-                model, device_ids=[rank], find_unused_parameters=False
-        )
+    print('worker %d loaded the model in %.1fs' % (rank, time.time() - load_start))
+    # BLIP2 captions repeat a lot, both across the 5 passes over one object and
+    # across objects, so CLIP text embeddings are only computed once.
+    text_cache = TextEmbeddingCache(
+        model.wrapped.clip,
+        max_entries=args.text_cache_size,
+        cache_path=None if args.text_cache_path == 'none' else args.text_cache_path,
+    )
     
     diffusion = diffusion_from_config(load_config('diffusion'))
 
-    paths = glob.glob(args.image_dir+'/*')
-    random.shuffle(paths)
-    for index, path in enumerate(paths):
+    # Every worker first scores its own deterministic shard, then helps with
+    # the other shards. Leases guarantee that no object is scored twice, and
+    # leases of crashed workers expire so their objects get picked up again.
+    if args.view_store != 'none':
+        # objects packed by pack_renders.py are listed from the store's index,
+        # their folders only hold caption.pkl; folders not packed yet are added
+        paths = [os.path.join(args.image_dir, uid) for uid in list_objects(args.image_dir, ViewStore(args.view_store))]
+    else:
+        paths = sorted(glob.glob(args.image_dir+'/*'))
+    owner = default_owner(rank)
+    if args.score_store != 'none':
+        score_store = ScoreStore(args.score_store)
+        score_writer = score_store.writer(owner)
+    else:
+        score_store, score_writer = None, None
+
+    def is_scored(path, refresh=False):
+        if score_store is None:
+            return os.path.exists(os.path.join(path, 'diffurank_scores.pkl'))
+        if refresh:
+            score_store.refresh()
+        return path.split('/')[-1] in score_store
+    own_shard = [p for p in paths if shard_of(p.split('/')[-1], args.workers) == rank]
+    other_shards = [p for p in paths if shard_of(p.split('/')[-1], args.workers) != rank]
+    # objects waiting to be packed into one batch of model forwards
+    pending = []
+    for index, path in enumerate(own_shard + other_shards):
         index_file = os.path.join(path, 'diffurank_scores.pkl')
-        if os.path.exists(index_file):
+        if is_scored(path):
             continue
 
         caption_file = os.path.join(path, 'caption.pkl')
@@ -94,50 +190,127 @@ def train(rank, args):
             print('caption file not completed:', path)
             continue
 
-        x_start = torch.load(os.path.join(args.latent_dir, path.split('/')[-1]+'.pt')).cuda()
-        print('DiffuRank:', index, path.split('/')[-1], len(paths))
-
-        batch_size = 140
-        model_kwargs=dict(texts=prompt)
-        x_start = x_start.repeat(batch_size,1)
-        x0 =x_start.detach()
-        view_loss = []
-        for _ in range(5):
-            with torch.no_grad():
-                t = []
-                for _ in range(5):
-                    # 800~900 is the hyperparameter we heuristically set
-                    # its principle should be 0~1000, i.e., the range of the time steps
-                    t_cur = torch.randint(850, 851, size=(int(batch_size/5),), device=device)
-                    random_integer = np.random.randint(-50, 51)
-                    t_cur += random_integer
-                    t.append(t_cur.unsqueeze(0))
-                t = torch.cat(t,0).transpose(0,1).reshape(-1)
-
-                loss = diffusion.diffurank_scores(model, x_start, t, model_kwargs=model_kwargs, times = 5)
-            view_loss.append(loss['mse'].reshape(1, -1, 5))
-
-        view_loss = torch.cat(view_loss)
-        pickle.dump(torch.mean(torch.mean(view_loss,-1),0).cpu().numpy(), open(index_file, 'wb'))
+        lease = Lease(index_file + '.lease', owner, ttl=args.lease_ttl)
+        if not lease.acquire():
+            continue
+        if is_scored(path, refresh=True):
+            # Finished by another worker between our check and the lease.
+            lease.release()
+            continue
+
+        print('DiffuRank:', rank, index, path.split('/')[-1], len(paths))
+        pending.append((path, prompt, lease))
+        if len(pending) == args.objects_per_batch:
+            score_pending(pending, diffusion, model, text_cache, args, device, rank, stats_queue, score_writer)
+            pending = []
+
+        if text_cache.cache_path is not None and (index + 1) % args.text_cache_save_every == 0:
+            text_cache.save()
+
+    if len(pending):
+        score_pending(pending, diffusion, model, text_cache, args, device, rank, stats_queue, score_writer)
+    if score_writer is not None:
+        score_writer.close()
+    print('text embedding cache: %d hits, %d misses' % (text_cache.hits, text_cache.misses))
+    if text_cache.cache_path is not None:
+        text_cache.save()
+
+
+def launch(args):
+    """
+    Run one scoring process per worker, restart workers that crash, and
+    report the aggregate throughput.
+    """
+    ctx = mp.get_context('spawn')
+    stats_queue = ctx.Queue()
+    procs = {}
+    restarts = {rank: 0 for rank in range(args.workers)}
+    scored = {rank: 0 for rank in range(args.workers)}
+
+    def start(rank):
+        proc = ctx.Process(target=train, args=(rank, args, stats_queue))
+        proc.start()
+        procs[rank] = proc
+
+    def report():
+        elapsed = max(time.time() - start_time, 1e-6)
+        total = sum(scored.values())
+        print('DiffuRank throughput: %d objects in %.0fs, %.1f objects/hour (%s)' % (
+            total, elapsed, total / elapsed * 3600,
+            ', '.join('w%d=%d' % (rank, n) for rank, n in sorted(scored.items())),
+        ))
+
+    start_time = time.time()
+    for rank in range(args.workers):
+        start(rank)
+
+    last_report = start_time
+    while procs:
+        try:
+            rank, count = stats_queue.get(timeout=5)
+            scored[rank] += count
+        except queue.Empty:
+            pass
+        for rank, proc in list(procs.items()):
+            if proc.is_alive():
+                continue
+            del procs[rank]
+            if proc.exitcode != 0 and restarts[rank] < args.max_restarts:
+                restarts[rank] += 1
+                print('worker %d exited with code %s, restart %d/%d' % (rank, proc.exitcode, restarts[rank], args.max_restarts))
+                start(rank)
+        if time.time() - last_report > args.report_every:
+            report()
+            last_report = time.time()
+
+    while True:
+        try:
+            rank, count = stats_queue.get(timeout=1)
+            scored[rank] += count
+        except queue.Empty:
+            break
+    report()
 
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     model_group = parser.add_argument_group('Model settings')
-    model_group.add_argument('--gpus', type = int, default = 1, help = 'how many gpu we use')
+    model_group.add_argument('--workers', '--gpus', type = int, default = 1, help = 'how many scoring processes to run, one per device')
+    model_group.add_argument('--device', type = str, default = 'cuda', choices = ['cuda', 'cpu'], help = 'workers use cuda:rank%%num_gpus, or the CPU')
+    model_group.add_argument('--cpu_threads', type = int, default = 0, help = 'torch threads per CPU worker (0 keeps the default)')
+    model_group.add_argument('--lease_ttl', type = float, default = 30 * 60, help = 'seconds after which a crashed worker\'s claim on an object expires')
+    model_group.add_argument('--max_restarts', type = int, default = 3, help = 'how often a crashed worker is restarted')
+    model_group.add_argument('--report_every', type = float, default = 60, help = 'seconds between throughput reports')
     model_group.add_argument('--resume_name', type = str, default = 'none', help = 'port for parallel')
     model_group.add_argument('--save_name', type = str, default = 'none', help = 'port for parallel')
+    model_group.add_argument('--attention', type = str, default = 'sdpa', choices = ['einsum', 'sdpa'], help = 'sdpa uses fused attention kernels, which fit larger --max_batch')
+    model_group.add_argument('--no_mmap_weights', action = 'store_true', help = 'deserialize the checkpoint in every worker instead of memory-mapping converted weights')
     model_group.add_argument('--image_dir', type = str, default='../example_material/Cap3D_imgs')
+    model_group.add_argument('--view_store', type = str, default='auto', help = 'list packed objects from the index of a view store as well as the folders of image_dir, auto uses Cap3D_packed next to image_dir if it exists, none lists image_dir')
     model_group.add_argument('--latent_dir', type = str, default='../example_material/extracted_shapE_latent')
+    model_group.add_argument('--score_store', type = str, default='../example_material/diffurank_scores', help = 'score store directory, or none for a diffurank_scores.pkl per object folder')
+    model_group.add_argument('--objects_per_batch', type = int, default = 1, help = 'how many objects are packed into the same model forwards')
+    model_group.add_argument('--max_batch', type = int, default = 140, help = 'max rows (object x view x caption) per model forward')
+    model_group.add_argument('--t_design', type = str, default = 'iid', choices = ['iid', 'stratified', 'sobol'], help = 'how timesteps cover the 800~900 window')
+    model_group.add_argument('--antithetic', action = 'store_true', help = 'pair passes with negated noise')
+    model_group.add_argument('--no_dedup', action = 'store_true', help = 'forward duplicate (caption, timestep, noise) rows separately')
+    model_group.add_argument('--adaptive_top_k', type = int, default = 0, help = 'if > 0, stop early once the top-k views are statistically settled')
+    model_group.add_argument('--adaptive_min_passes', type = int, default = 2, help = 'passes to run before adaptive scoring may drop views')
+    model_group.add_argument('--adaptive_confidence', type = float, default = 1.96, help = 'z-score of the per-view confidence bounds')
+    model_group.add_argument('--text_cache_path', type = str, default='none', help = 'file to persist CLIP text embeddings across runs')
+    model_group.add_argument('--text_cache_size', type = int, default = 2**18, help = 'max number of CLIP text embeddings kept in memory')
+    model_group.add_argument('--text_cache_save_every', type = int, default = 1000, help = 'persist the text embedding cache every N objects')
 
     args = parser.parse_args()
+    if args.view_store == 'auto':
+        args.view_store = os.path.join(os.path.dirname(os.path.normpath(args.image_dir)), 'Cap3D_packed')
+        if not os.path.isdir(args.view_store):
+            args.view_store = 'none'
 
-    if args.gpus == 1:
-        train(args.gpus, args)
+    if args.workers == 1:
+        train(0, args)
     else:
-        os.environ['MASTER_ADDR'] = 'localhost'
-        os.environ['MASTER_PORT'] = args.port
-        args.world_size = args.gpus
-        mp.spawn(train, nprocs=args.gpus, args=(args,))
-
-
+        launch(args)
+    if args.score_store != 'none':
+        # snapshot the index so readers do not have to rescan every shard
+        ScoreStore(args.score_store).save_index()
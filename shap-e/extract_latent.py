@@ -19,12 +19,20 @@ parser.add_argument('--uid_path', type = str, default='../example_material/examp
 parser.add_argument('--mother_dir', type = str, default='..')
 parser.add_argument('--cache_dir', type = str, default='./shapE_cache')
 parser.add_argument('--save_name', type = str, default='../example_material/extracted_shapE_latent')
+parser.add_argument('--no_mmap_weights', action = 'store_true', help = 'deserialize the checkpoint instead of memory-mapping converted weights')
+parser.add_argument('--blender_workers', type = int, default = 1, help = 'long-lived Blender processes rendering the views, 0 starts Blender once per object')
+parser.add_argument('--blender_max_jobs', type = int, default = 100, help = 'restart a Blender worker after this many objects')
 args = parser.parse_args()
 
 device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
 
 from shap_e.models.download import load_model
-xm = load_model('transmitter', device=device)
+xm = load_model('transmitter', device=device, mmap=not args.no_mmap_weights)
+
+if args.blender_workers > 0:
+    # keep Blender running across objects instead of paying its startup per render
+    from shap_e.rendering.blender import BlenderWorkerPool, set_worker_pool
+    set_worker_pool(BlenderWorkerPool(num_workers=args.blender_workers, max_jobs=args.blender_max_jobs, verbose=True))
 
 uid_list = pickle.load(open(args.uid_path, 'rb'))
 target_dir = args.save_name
@@ -0,0 +1,24 @@
+# ==============================================================================
+# Import per-folder diffurank_scores.pkl files into a consolidated score store
+# (see shap_e/util/score_store.py). Objects already in the store are skipped,
+# so the migration can be interrupted and resumed.
+#
+# python migrate_diffurank_scores.py --image_dir ../example_material/Cap3D_imgs --score_store ../example_material/diffurank_scores
+# ==============================================================================
+
+import argparse
+import time
+
+from shap_e.util.score_store import ScoreStore, migrate_pickles
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--image_dir', type = str, default='../example_material/Cap3D_imgs')
+    parser.add_argument('--score_store', type = str, default='../example_material/diffurank_scores')
+    args = parser.parse_args()
+
+    start = time.time()
+    store = ScoreStore(args.score_store)
+    num_imported = migrate_pickles(store, args.image_dir)
+    print('imported %d objects in %.1fs, store now holds %d objects' % (num_imported, time.time() - start, len(store)))
@@ -0,0 +1,398 @@
+"""
+Helpers for scoring caption/latent alignment with DiffuRank.
+
+Every DiffuRank work item ("row") evaluates the denoising loss of one caption
+embedding against one object's latent at one (timestep, noise) sample. Rows
+are described by index tensors into per-object tables, so that several
+objects can be packed into one model forward without materializing a latent
+and a noise vector per row up front.
+"""
+
+from dataclasses import dataclass
+from typing import Optional
+
+import torch
+
+from .gaussian_diffusion import GaussianDiffusion
+
+# 800~900 is the hyperparameter we heuristically set; in principle the
+# window could be anywhere in 0~1000, i.e. the range of the time steps.
+DEFAULT_T_CENTER = 850
+DEFAULT_T_SPREAD = 50
+
+
+@dataclass
+class DiffuRankBatch:
+    """
+    A flat batch of DiffuRank rows packed from one or more objects.
+
+    Row i evaluates caption embedding cond_index[i] against
+    latents[object_index[i]] using timestep t[sample_index[i]] and noise
+    noise[sample_index[i]], and its loss is averaged into output slot
+    (object_index[i], view_index[i]).
+    """
+
+    latents: torch.Tensor  # [K x D]
+    embeddings: torch.Tensor  # [M x E]
+    t: torch.Tensor  # [S]
+    noise: torch.Tensor  # [S x D]
+    object_index: torch.Tensor  # [N]
+    view_index: torch.Tensor  # [N]
+    cond_index: torch.Tensor  # [N]
+    sample_index: torch.Tensor  # [N]
+    num_views: int
+
+    @property
+    def num_objects(self) -> int:
+        return self.latents.shape[0]
+
+    def __len__(self) -> int:
+        return self.object_index.shape[0]
+
+    def unique_rows(self):
+        """
+        Find rows that evaluate exactly the same work item.
+
+        Two rows are duplicates if they use the same latent, the same
+        (timestep, noise) sample and bit-identical caption embeddings, which
+        happens whenever BLIP2 returned the same caption for several views.
+        Their losses are identical, so only one of them needs a forward.
+
+        :return: a tuple (rows, inverse), where rows holds the index of one
+                 representative row per unique work item, and inverse maps
+                 every row to its position in rows.
+        """
+        _, cond_id = torch.unique(self.embeddings, dim=0, return_inverse=True)
+        num_conds = len(self.embeddings)
+        num_samples = len(self.t)
+        key = (self.object_index * num_conds + cond_id[self.cond_index]) * num_samples
+        key = key + self.sample_index
+        _, inverse = torch.unique(key, return_inverse=True)
+        num_unique = int(inverse.max().item()) + 1 if len(inverse) else 0
+        rows = torch.full((num_unique,), len(self), dtype=torch.long, device=inverse.device)
+        rows = rows.scatter_reduce(
+            0, inverse, torch.arange(len(self), device=inverse.device), reduce="amin"
+        )
+        return rows, inverse
+
+
+def sample_timesteps(
+    shape,
+    device: torch.device,
+    center: int = DEFAULT_T_CENTER,
+    spread: int = DEFAULT_T_SPREAD,
+) -> torch.Tensor:
+    """
+    Draw integer timesteps uniformly from [center - spread, center + spread].
+    """
+    return torch.randint(center - spread, center + spread + 1, size=shape, device=device)
+
+
+def sample_design(
+    num_objects: int,
+    num_passes: int,
+    times: int,
+    d_latent: int,
+    device: torch.device,
+    t_design: str = "iid",
+    antithetic: bool = False,
+    center: int = DEFAULT_T_CENTER,
+    spread: int = DEFAULT_T_SPREAD,
+):
+    """
+    Draw the (timestep, noise) samples used to score K objects.
+
+    Every view of an object reuses the same samples (common random numbers),
+    so only the differences between views' captions show up in the ranking.
+
+    :param t_design: how the timesteps of an object cover the window:
+                     "iid" draws them independently, "stratified" puts one
+                     in each of num_passes*times equal strata, and "sobol"
+                     uses a scrambled Sobol sequence.
+    :param antithetic: if True, pass 2i+1 reuses the timesteps of pass 2i
+                       with negated noise, so every caption slot is scored
+                       under both +eps and -eps.
+    :return: a tuple (t, noise) of shapes [K x num_passes x times] and
+             [K x num_passes x times x d_latent].
+    """
+    num_free = (num_passes + 1) // 2 if antithetic else num_passes
+    num_samples = num_free * times
+    lo, hi = center - spread, center + spread
+    if t_design == "iid":
+        t = sample_timesteps(
+            (num_objects, num_samples), device=device, center=center, spread=spread
+        )
+    else:
+        if t_design == "stratified":
+            u = (
+                torch.arange(num_samples, device=device)
+                + torch.rand(num_objects, num_samples, device=device)
+            ) / num_samples
+        elif t_design == "sobol":
+            u = torch.stack(
+                [
+                    torch.quasirandom.SobolEngine(dimension=1, scramble=True).draw(num_samples)[
+                        :, 0
+                    ]
+                    for _ in range(num_objects)
+                ]
+            ).to(device)
+        else:
+            raise ValueError(f"unknown timestep design: {t_design}")
+        # Shuffle so that strata are not tied to particular passes or caption slots.
+        u = u.gather(1, torch.rand(num_objects, num_samples, device=device).argsort(dim=1))
+        t = (lo + (u * (hi - lo + 1)).long()).clamp(max=hi)
+    t = t.reshape(num_objects, num_free, times)
+    noise = torch.randn(num_objects, num_free, times, d_latent, device=device)
+
+    if antithetic:
+        pass_idx = torch.arange(num_passes, device=device)
+        sign = (1 - 2 * (pass_idx % 2)).to(noise.dtype)
+        t = t[:, pass_idx // 2]
+        noise = noise[:, pass_idx // 2] * sign[None, :, None, None]
+    return t, noise
+
+
+def pack_objects(
+    latents: torch.Tensor,
+    embeddings: torch.Tensor,
+    num_views: int,
+    num_passes: int = 5,
+    times: int = 5,
+    t: Optional[torch.Tensor] = None,
+    noise: Optional[torch.Tensor] = None,
+    view_mask: Optional[torch.Tensor] = None,
+    t_design: str = "iid",
+    antithetic: bool = False,
+) -> DiffuRankBatch:
+    """
+    Pack K objects into one batch of rows ordered by (object, pass, view,
+    caption), which matches the layout of the original one-object loop.
+
+    Within a pass, caption slot c of every view uses the (c % times)-th
+    (timestep, noise) sample of that pass, so all views of an object are
+    compared under common random numbers.
+
+    :param latents: a [K x D] tensor of Shap-E latents.
+    :param embeddings: a [K x (V*C) x E] tensor of caption embeddings, with
+                       the C captions of view v at rows v*C...(v+1)*C-1.
+    :param num_views: the number of views V per object.
+    :param num_passes: the number of independent passes over every caption.
+    :param times: the number of (timestep, noise) samples per pass.
+    :param t: optionally, a [K x num_passes x times] tensor of timesteps.
+    :param noise: optionally, a [K x num_passes x times x D] noise tensor.
+    :param view_mask: optionally, a [K x V] boolean tensor. Only rows of
+                      views where it is True are packed.
+    :param t_design: see sample_design(); used when t or noise is missing.
+    :param antithetic: see sample_design(); used when t or noise is missing.
+    """
+    device = latents.device
+    num_objects, d_latent = latents.shape
+    assert embeddings.shape[0] == num_objects
+    assert embeddings.shape[1] % num_views == 0, "every view must have the same caption count"
+    num_captions = embeddings.shape[1] // num_views
+
+    if t is None or noise is None:
+        design_t, design_noise = sample_design(
+            num_objects,
+            num_passes,
+            times,
+            d_latent,
+            device,
+            t_design=t_design,
+            antithetic=antithetic,
+        )
+        t = design_t if t is None else t
+        noise = design_noise if noise is None else noise
+    assert t.shape == (num_objects, num_passes, times)
+    assert noise.shape == (num_objects, num_passes, times, d_latent)
+
+    grid = torch.meshgrid(
+        torch.arange(num_objects, device=device),
+        torch.arange(num_passes, device=device),
+        torch.arange(num_views, device=device),
+        torch.arange(num_captions, device=device),
+        indexing="ij",
+    )
+    obj, pass_idx, view, caption = [x.reshape(-1) for x in grid]
+    if view_mask is not None:
+        keep = view_mask[obj, view]
+        obj, pass_idx, view, caption = obj[keep], pass_idx[keep], view[keep], caption[keep]
+    return DiffuRankBatch(
+        latents=latents,
+        embeddings=embeddings.reshape(-1, embeddings.shape[-1]),
+        t=t.reshape(-1),
+        noise=noise.reshape(-1, d_latent),
+        object_index=obj,
+        view_index=view,
+        cond_index=(obj * num_views + view) * num_captions + caption,
+        sample_index=(obj * num_passes + pass_idx) * times + caption % times,
+        num_views=num_views,
+    )
+
+
+def diffurank_view_scores(
+    diffusion: GaussianDiffusion,
+    model: torch.nn.Module,
+    latents: torch.Tensor,
+    embeddings: torch.Tensor,
+    num_views: int,
+    num_passes: int = 5,
+    times: int = 5,
+    max_batch: Optional[int] = None,
+    t_design: str = "iid",
+    antithetic: bool = False,
+    dedup: bool = True,
+) -> "ViewScores":
+    """
+    Score every view of K objects in packed model forwards.
+
+    :param dedup: if True, forward duplicate work items only once.
+    :return: a ViewScores whose view_scores is a [K x V] tensor of mean
+             denoising losses, where lower means the view's captions are
+             better aligned with the object's latent.
+    """
+    batch = pack_objects(
+        latents,
+        embeddings,
+        num_views,
+        num_passes=num_passes,
+        times=times,
+        t_design=t_design,
+        antithetic=antithetic,
+    )
+    with torch.no_grad():
+        terms = diffusion.packed_diffurank_scores(model, batch, max_batch=max_batch, dedup=dedup)
+    return ViewScores(
+        view_scores=terms["view_mse"],
+        view_passes=torch.full_like(terms["view_mse"], num_passes, dtype=torch.long),
+        num_rows=int(terms["num_evaluated"].item()),
+        max_rows=len(batch),
+    )
+
+
+@dataclass
+class ViewScores:
+    """
+    The result of diffurank_view_scores() and adaptive_view_scores().
+    """
+
+    view_scores: torch.Tensor  # [K x V] mean loss of every view
+    view_passes: torch.Tensor  # [K x V] number of passes spent on every view
+    num_rows: int  # model evaluations (rows) actually run
+    max_rows: int  # rows of the fixed-budget scorer without deduplication
+
+    @property
+    def rows_saved(self) -> int:
+        return self.max_rows - self.num_rows
+
+
+def adaptive_view_scores(
+    diffusion: GaussianDiffusion,
+    model: torch.nn.Module,
+    latents: torch.Tensor,
+    embeddings: torch.Tensor,
+    num_views: int,
+    top_k: int = 6,
+    max_passes: int = 5,
+    min_passes: int = 2,
+    times: int = 5,
+    confidence: float = 1.96,
+    max_batch: Optional[int] = None,
+    t_design: str = "iid",
+    antithetic: bool = False,
+    dedup: bool = True,
+) -> ViewScores:
+    """
+    Score every view of K objects, stopping early once the set of top_k views
+    (the lowest losses) is statistically settled.
+
+    Each pass evaluates all captions of every still-undecided view once. We
+    track the running mean and variance of every view's per-pass loss, and
+    after min_passes we drop views in the style of successive halving:
+
+    - a view is out if at least top_k other views have an upper confidence
+      bound below its lower confidence bound;
+    - a view is in if fewer than top_k other views have a lower confidence
+      bound below its upper confidence bound.
+
+    Objects stop when every view is decided, or after max_passes.
+
+    :param top_k: the number of views consumers of the scores care about.
+    :param max_passes: the pass budget per view (the fixed scorer's count).
+    :param min_passes: passes to run before any view may be dropped.
+    :param confidence: the z-score of the confidence bounds.
+    :param t_design: see sample_design(). The design is drawn for all
+                     max_passes up front and pass i uses its i-th pass, so
+                     views that run every pass cover the window as in
+                     diffurank_view_scores().
+    :param antithetic: see sample_design(); passes 2i and 2i+1 form a pair.
+    :param dedup: if True, forward duplicate work items only once.
+    :return: a ViewScores whose view_scores can be argsorted like the
+             output of diffurank_view_scores().
+    """
+    assert min_passes >= 2, "need at least two passes to estimate variance"
+    num_objects, d_latent = latents.shape
+    num_captions = embeddings.shape[1] // num_views
+    device = latents.device
+    t, noise = sample_design(
+        num_objects,
+        max_passes,
+        times,
+        d_latent,
+        device,
+        t_design=t_design,
+        antithetic=antithetic,
+    )
+
+    count = torch.zeros(num_objects, num_views, device=device)
+    mean = torch.zeros(num_objects, num_views, device=device)
+    m2 = torch.zeros(num_objects, num_views, device=device)
+    undecided = torch.ones(num_objects, num_views, dtype=torch.bool, device=device)
+    num_rows = 0
+
+    for pass_idx in range(max_passes):
+        batch = pack_objects(
+            latents,
+            embeddings,
+            num_views,
+            num_passes=1,
+            times=times,
+            t=t[:, pass_idx : pass_idx + 1],
+            noise=noise[:, pass_idx : pass_idx + 1],
+            view_mask=undecided,
+        )
+        with torch.no_grad():
+            terms = diffusion.packed_diffurank_scores(
+                model, batch, max_batch=max_batch, dedup=dedup
+            )
+        view_mse = terms["view_mse"]
+        num_rows += int(terms["num_evaluated"].item())
+
+        # Welford's online update, only for the views evaluated this pass.
+        sample = torch.where(undecided, view_mse, mean)
+        count = count + undecided.float()
+        delta = sample - mean
+        mean = mean + torch.where(undecided, delta / count.clamp(min=1), torch.zeros_like(mean))
+        m2 = m2 + torch.where(undecided, delta * (sample - mean), torch.zeros_like(m2))
+
+        if pass_idx + 1 < min_passes:
+            continue
+        stderr = (m2 / (count - 1).clamp(min=1) / count.clamp(min=1)).sqrt()
+        lower = mean - confidence * stderr
+        upper = mean + confidence * stderr
+
+        # [K x V x V]: entry (k, v, u) compares view v against other view u.
+        others = ~torch.eye(num_views, dtype=torch.bool, device=device)
+        surely_better = (upper[:, None, :] < lower[:, :, None]) & others
+        maybe_better = (lower[:, None, :] < upper[:, :, None]) & others
+        out = surely_better.sum(-1) >= top_k
+        accepted = maybe_better.sum(-1) < top_k
+        undecided = undecided & ~out & ~accepted
+        if not undecided.any():
+            break
+
+    max_rows = max_passes * num_objects * num_views * num_captions
+    return ViewScores(
+        view_scores=mean, view_passes=count.long(), num_rows=num_rows, max_rows=max_rows
+    )
@@ -809,7 +809,7 @@ class GaussianDiffusion:
         }
 
     def diffurank_scores(
-        self, model, x_start, t, model_kwargs=None, noise=None, times=None
+        self, model, x_start, t, model_kwargs=None, noise=None, times=None, x_index=None
     ) -> Dict[str, th.Tensor]:
         """
         Compute training losses for a single timestep.
@@ -818,20 +818,35 @@ class GaussianDiffusion:
         :param x_start: the [N x C x ...] tensor of inputs.
         :param t: a batch of timestep indices.
         :param model_kwargs: if not None, a dict of extra keyword arguments to
-            pass to the model. This can be used for conditioning.
+            pass to the model. This can be used for conditioning, either with
+            raw `texts` or with precomputed CLIP `embeddings`.
         :param noise: if specified, the specific Gaussian noise to try to remove.
+        :param x_index: if specified, a compact description of the batch:
+            x_start, t and noise hold U unique samples, and row i of the
+            model batch (and of the conditioning in model_kwargs) uses sample
+            x_index[i]. x_t is then computed once per unique sample and only
+            expanded at the model input, and only the "mse" term is computed.
         :return: a dict with the key "loss" containing a tensor of shape [N].
                  Some mean or variance settings may also have other keys.
         """
+        if x_index is not None:
+            return self._compact_diffurank_scores(
+                model, x_start, t, x_index, model_kwargs=model_kwargs, noise=noise
+            )
         x_start = self.scale_channels(x_start)
         if model_kwargs is None:
             model_kwargs = {}
+        # Copy so that repeating the conditioning below never grows the
+        # caller's texts/embeddings in place across passes.
+        model_kwargs = dict(model_kwargs)
+        cond_key = "embeddings" if model_kwargs.get("embeddings") is not None else "texts"
+        num_cond = len(model_kwargs[cond_key])
         # keep the noise same for all the captions
         if noise is None:
-            noise = th.randn_like(x_start[0].unsqueeze(0).repeat([int(len(x_start)/len(model_kwargs['texts'])*times),1]))
-            noise=noise.unsqueeze(1).repeat([1,int(len(model_kwargs['texts'])/times),1]).transpose(0,1).reshape(-1,noise.shape[1])
-        if len(model_kwargs['texts']) != len(t):
-            model_kwargs['texts'] *= int(len(x_start)/len(model_kwargs['texts']))
+            noise = th.randn_like(x_start[0].unsqueeze(0).repeat([int(len(x_start)/num_cond*times),1]))
+            noise=noise.unsqueeze(1).repeat([1,int(num_cond/times),1]).transpose(0,1).reshape(-1,noise.shape[1])
+        if num_cond != len(t):
+            model_kwargs[cond_key] = _repeat_cond(model_kwargs[cond_key], int(len(x_start) / num_cond))
         x_t = self.q_sample(x_start, t, noise=noise)
 
         terms = {}
@@ -898,6 +913,83 @@ class GaussianDiffusion:
                 terms["loss"] = terms["loss"] + loss * scale
 
         return terms
+
+    def _compact_diffurank_scores(
+        self, model, x_start, t, x_index, model_kwargs=None, noise=None
+    ) -> Dict[str, th.Tensor]:
+        assert self.loss_type in ["mse", "rescaled_mse"], "compact scoring only supports mse"
+        x_start = self.scale_channels(x_start)
+        if noise is None:
+            noise = th.randn_like(x_start)
+        x_t = self.q_sample(x_start, t, noise=noise)
+        model_output = model(x_t[x_index], t[x_index], **(model_kwargs or {}))
+        if isinstance(model_output, tuple):
+            model_output, _ = model_output
+        if self.model_var_type in ["learned", "learned_range"]:
+            model_output, _ = th.split(model_output, x_t.shape[1], dim=1)
+        if self.model_mean_type == "x_prev":
+            target = self.q_posterior_mean_variance(x_start=x_start, x_t=x_t, t=t)[0]
+        else:
+            target = {"x_start": x_start, "epsilon": noise}[self.model_mean_type]
+        mse = mean_flat((target[x_index] - model_output) ** 2)
+        return {"mse": mse, "loss": mse}
+
+    def packed_diffurank_scores(
+        self, model, batch, max_batch: Optional[int] = None, dedup: bool = False
+    ) -> Dict[str, th.Tensor]:
+        """
+        Compute DiffuRank losses for a packed multi-object batch.
+
+        :param model: the model to evaluate loss on.
+        :param batch: a DiffuRankBatch (see shap_e.diffusion.diffurank)
+                      describing the rows to evaluate.
+        :param max_batch: the maximum number of rows per model forward. If
+                          None, all rows are evaluated in one forward.
+        :param dedup: if True, rows that evaluate the same work item are only
+                      forwarded once and their loss is copied to every slot.
+        :return: a dict with keys "mse", a tensor of shape [N] with the loss
+                 of every row, "view_mse", a tensor of shape [K x V] with the
+                 mean loss of every (object, view) pair, and "num_evaluated",
+                 the number of rows that were actually forwarded.
+        """
+        if dedup:
+            rows, inverse = batch.unique_rows()
+        else:
+            rows = th.arange(len(batch), device=batch.object_index.device)
+            inverse = rows
+        num_rows = len(rows)
+        max_batch = max_batch or num_rows
+        mse = []
+        num_samples = len(batch.t)
+        for start in range(0, num_rows, max_batch):
+            chunk = rows[start : start + max_batch]
+            # Rows of one object share (t, noise) samples across captions, so
+            # x_t is built once per unique (object, sample) pair.
+            pairs, x_index = th.unique(
+                batch.object_index[chunk] * num_samples + batch.sample_index[chunk],
+                return_inverse=True,
+            )
+            sample_index = pairs % num_samples
+            terms = self.diffurank_scores(
+                model,
+                batch.latents[pairs // num_samples],
+                batch.t[sample_index],
+                model_kwargs=dict(embeddings=batch.embeddings[batch.cond_index[chunk]]),
+                noise=batch.noise[sample_index],
+                x_index=x_index,
+            )
+            mse.append(terms["mse"])
+        mse = th.cat(mse)[inverse]
+
+        groups = batch.object_index * batch.num_views + batch.view_index
+        num_groups = batch.num_objects * batch.num_views
+        totals = th.zeros(num_groups, device=mse.device, dtype=mse.dtype).index_add_(0, groups, mse)
+        counts = th.zeros(num_groups, device=mse.device, dtype=mse.dtype).index_add_(
+            0, groups, th.ones_like(mse)
+        )
+        view_mse = (totals / counts).reshape(batch.num_objects, batch.num_views)
+        return {"mse": mse, "view_mse": view_mse, "num_evaluated": th.tensor(num_rows)}
+
     def sds(
         self, model, x_start, t, model_kwargs=None, noise=None
     ) -> Dict[str, th.Tensor]:
@@ -1255,6 +1347,16 @@ def _extract_into_tensor(arr, timesteps, broadcast_shape):
     return res + th.zeros(broadcast_shape, device=timesteps.device)
 
 
+def _repeat_cond(cond, repeats: int):
+    """
+    Tile a batch of conditioning values (a list of texts, or a tensor or list
+    of embeddings) along the batch dimension without modifying the input.
+    """
+    if isinstance(cond, th.Tensor):
+        return cond.repeat(repeats, *([1] * (len(cond.shape) - 1)))
+    return list(cond) * repeats
+
+
 def normal_kl(mean1, logvar1, mean2, logvar2):
     """
     Compute the KL divergence between two gaussians.
@@ -4,7 +4,7 @@ Adapted from: https://github.com/openai/glide-text2im/blob/69b530740eb6cef69442d
 
 import os
 from functools import lru_cache
-from typing import Dict, Optional
+from typing import Any, Dict, Optional
 
 import requests
 import torch
@@ -99,13 +99,136 @@ def load_checkpoint(
     return torch.load(path, map_location=device)
 
 
+def convert_checkpoint(
+    model_name: str,
+    progress: bool = True,
+    cache_dir: Optional[str] = None,
+    chunk_size: int = 4096,
+) -> str:
+    """
+    Convert a checkpoint once into a file that torch.load() can memory-map,
+    and return the path of the converted file.
+
+    Besides the model's state dict, the converted file holds the weights of
+    frozen CLIP models. These are not part of the state dict, and would
+    otherwise be deserialized from CLIP's own archive by every process.
+    """
+    from .configs import model_from_config
+
+    path = fetch_file_cached(
+        MODEL_PATHS[model_name], progress=progress, cache_dir=cache_dir, chunk_size=chunk_size
+    )
+    mmap_path = os.path.splitext(path)[0] + ".mmap.pt"
+    if os.path.exists(mmap_path):
+        return mmap_path
+    with FileLock(mmap_path + ".lock"):
+        if os.path.exists(mmap_path):
+            return mmap_path
+        device = torch.device("cpu")
+        config = load_config(model_name, progress=progress, cache_dir=cache_dir)
+        model = model_from_config(config, device=device)
+        model.load_state_dict(torch.load(path, map_location=device))
+        frozen_clip = {}
+        for name, clip in _frozen_clips(model).items():
+            for key, value in clip.model.state_dict().items():
+                frozen_clip[f"{name}.{key}"] = value
+        tmp_path = mmap_path + ".tmp"
+        torch.save(dict(model=model.state_dict(), frozen_clip=frozen_clip), tmp_path)
+        os.rename(tmp_path, mmap_path)
+    return mmap_path
+
+
+def load_model_mmap(
+    model_name: str,
+    device: torch.device,
+    **kwargs,
+) -> torch.nn.Module:
+    """
+    Like load_model(), but build the model on the meta device and assign
+    memory-mapped weights to it, skipping parameter initialization and
+    checkpoint deserialization.
+
+    On the CPU, the weights stay memory-mapped, so processes on one host
+    share a single read-only copy through the page cache. On a GPU, the
+    weights are copied to the device without being held in host memory.
+    """
+    from .configs import model_from_config
+    from .generation.pretrained_clip import ImageCLIP, materialize_attention_masks
+
+    device = torch.device(device)
+    checkpoint = torch.load(
+        convert_checkpoint(model_name, **kwargs), map_location="cpu", mmap=True, weights_only=True
+    )
+    model = model_from_config(load_config(model_name, **kwargs), device=torch.device("meta"))
+    model.load_state_dict(checkpoint["model"], assign=True)
+    model.to(device)
+    for name, clip in _frozen_clips(model).items():
+        prefix = name + "."
+        clip.model.load_state_dict(
+            {
+                key[len(prefix) :]: value
+                for key, value in checkpoint["frozen_clip"].items()
+                if key.startswith(prefix)
+            },
+            assign=True,
+        )
+        clip.model.to(device)
+        materialize_attention_masks(clip.model.clip_model, device)
+        if device.type != "cpu":
+            # clip.load() keeps half-precision weights on accelerators.
+            from clip.model import convert_weights
+
+            convert_weights(clip.model.clip_model)
+        for parameter in clip.model.parameters():
+            parameter.requires_grad_(False)
+        _check_materialized(clip.model, name)
+    for module in model.modules():
+        if isinstance(module, ImageCLIP):
+            module.device = device
+            materialize_attention_masks(module.clip_model, device)
+    _check_materialized(model, model_name)
+    model.eval()
+    return model
+
+
+def _frozen_clips(model: torch.nn.Module) -> Dict[str, Any]:
+    """
+    Find FrozenImageCLIP instances, which are attributes of modules but not
+    modules themselves, keyed by their attribute path.
+    """
+    from .generation.pretrained_clip import FrozenImageCLIP
+
+    result = {}
+    for module_name, module in model.named_modules():
+        for attr, value in vars(module).items():
+            if isinstance(value, FrozenImageCLIP):
+                result[f"{module_name}.{attr}" if module_name else attr] = value
+    return result
+
+
+def _check_materialized(model: torch.nn.Module, name: str):
+    for module_name, module in model.named_modules():
+        tensors = dict(module.named_parameters(recurse=False))
+        tensors.update(module.named_buffers(recurse=False))
+        tensors.update((k, v) for k, v in vars(module).items() if isinstance(v, torch.Tensor))
+        for key, tensor in tensors.items():
+            if tensor is not None and tensor.is_meta:
+                raise RuntimeError(
+                    f"{name}: {module_name}.{key} is not in the checkpoint, "
+                    "so the model cannot be loaded with mmap=True"
+                )
+
+
 def load_model(
     model_name: str,
     device: torch.device,
+    mmap: bool = False,
     **kwargs,
 ) -> Dict[str, torch.Tensor]:
     from .configs import model_from_config
 
+    if mmap:
+        return load_model_mmap(model_name, device, **kwargs)
     model = model_from_config(load_config(model_name, **kwargs), device=device)
     model.load_state_dict(load_checkpoint(model_name, device=device, **kwargs))
     model.eval()
@@ -6,7 +6,7 @@ import torch.nn as nn
 
 from shap_e.models.nn.checkpoint import checkpoint
 
-from .transformer import MLP, Transformer, init_linear
+from .transformer import MLP, Transformer, init_linear, qkv_attention
 from .util import timestep_embedding
 
 
@@ -62,16 +62,10 @@ class QKVMultiheadCrossAttention(nn.Module):
         _, n_ctx, _ = q.shape
         bs, n_data, width = kv.shape
         attn_ch = width // self.heads // 2
-        scale = 1 / math.sqrt(math.sqrt(attn_ch))
         q = q.view(bs, n_ctx, self.heads, -1)
         kv = kv.view(bs, n_data, self.heads, -1)
         k, v = torch.split(kv, attn_ch, dim=-1)
-        weight = torch.einsum(
-            "bthc,bshc->bhts", q * scale, k * scale
-        )  # More stable with f16 than dividing afterwards
-        wdtype = weight.dtype
-        weight = torch.softmax(weight.float(), dim=-1).type(wdtype)
-        return torch.einsum("bhts,bshc->bthc", weight, v).reshape(bs, n_ctx, -1)
+        return qkv_attention(q, k, v)
 
 
 class ResidualCrossAttentionBlock(nn.Module):
@@ -9,6 +9,24 @@ from shap_e.models.download import default_cache_dir
 
 ImageType = Union[np.ndarray, torch.Tensor, Image.Image]
 
+# Constructor arguments of clip.model.CLIP, as inferred by clip.model.build_model().
+CLIP_ARCHITECTURES = {
+    "ViT-L/14": (768, 224, 24, 1024, 14, 77, 49408, 768, 12, 12),
+    "ViT-B/32": (512, 224, 12, 768, 32, 77, 49408, 512, 8, 12),
+}
+
+
+def materialize_attention_masks(clip_model: nn.Module, device: torch.device):
+    """
+    Rebuild the causal attention masks of a CLIP model's text transformer.
+
+    The masks are plain tensor attributes of the residual blocks rather than
+    buffers, so they are not in the state dict. A CLIP built on the meta
+    device keeps them there after its weights are assigned.
+    """
+    for block in clip_model.transformer.resblocks:
+        block.attn_mask = clip_model.build_attention_mask().to(device)
+
 
 class ImageCLIP(nn.Module):
     """
@@ -34,9 +52,19 @@ class ImageCLIP(nn.Module):
         # Lazy import because of torchvision.
         import clip
 
-        self.clip_model, self.preprocess = clip.load(
-            clip_name, device=device, download_root=cache_dir or default_cache_dir()
-        )
+        if torch.device(device).type == "meta":
+            # Only build the architecture, without loading or initializing
+            # weights; they are assigned later by load_model(..., mmap=True).
+            from clip.clip import _transform
+            from clip.model import CLIP
+
+            with torch.device("meta"):
+                self.clip_model = CLIP(*CLIP_ARCHITECTURES[clip_name]).eval()
+            self.preprocess = _transform(self.clip_model.visual.input_resolution)
+        else:
+            self.clip_model, self.preprocess = clip.load(
+                clip_name, device=device, download_root=cache_dir or default_cache_dir()
+            )
         self.clip_name = clip_name
 
         if dtype is not None:
@@ -80,6 +108,17 @@ class ImageCLIP(nn.Module):
         cannot be mixed for a single batch element. If no modality is provided,
         a zero embedding will be used for the batch element.
         """
+        if (
+            not self.ensure_used_params
+            and images is None
+            and texts is None
+            and isinstance(embeddings, torch.Tensor)
+        ):
+            # Fast path for precomputed (e.g. cached) embeddings, avoiding a
+            # per-element copy into the result tensor.
+            assert len(embeddings) == batch_size, "number of embeddings should match batch size"
+            return embeddings.to(device=self.device, dtype=torch.float32)
+
         image_seq = [None] * batch_size if images is None else list(images)
         text_seq = [None] * batch_size if texts is None else list(texts)
         embedding_seq = [None] * batch_size if embeddings is None else list(embeddings)
@@ -0,0 +1,27 @@
+import pytest
+import torch
+
+from shap_e.models.download import _check_materialized
+
+from .pretrained_clip import CLIP_ARCHITECTURES, ImageCLIP, materialize_attention_masks
+
+clip_model = pytest.importorskip("clip.model")
+
+
+def test_meta_clip_runs_after_loading():
+    torch.manual_seed(0)
+    reference = clip_model.CLIP(*CLIP_ARCHITECTURES["ViT-B/32"]).eval()
+
+    clip = ImageCLIP(device=torch.device("meta"), clip_name="ViT-B/32")
+    clip.clip_model.load_state_dict(reference.state_dict(), assign=True)
+    device = torch.device("cpu")
+    clip.device = device
+    materialize_attention_masks(clip.clip_model, device)
+    _check_materialized(clip, "ViT-B/32")
+
+    prompts = ["a red chair", "a 3D model of a car"]
+    with torch.no_grad():
+        expected = reference.encode_text(clip._tokenize(prompts, truncate=True)).float()
+        actual = clip.embed_text(prompts)
+    expected = expected / torch.linalg.norm(expected, dim=-1, keepdim=True)
+    assert torch.allclose(actual, expected, atol=1e-5)
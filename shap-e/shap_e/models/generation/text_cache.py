@@ -0,0 +1,132 @@
+import hashlib
+import os
+from collections import OrderedDict
+from typing import Dict, Iterable, List, Optional, Union
+
+import torch
+from filelock import FileLock
+
+from .pretrained_clip import FrozenImageCLIP, ImageCLIP
+
+
+class TextEmbeddingCache:
+    """
+    An LRU cache of CLIP text embeddings keyed by a hash of the caption.
+
+    Captions are looked up by content, so repeated prompts (across DiffuRank
+    passes, or across objects that share BLIP2 captions) are only tokenized
+    and encoded once. The cache can optionally be loaded from and persisted
+    to a single file so that it survives across runs.
+    """
+
+    def __init__(
+        self,
+        clip: Union[FrozenImageCLIP, ImageCLIP],
+        max_entries: Optional[int] = 2**18,
+        cache_path: Optional[str] = None,
+    ):
+        """
+        :param clip: the CLIP wrapper used to embed captions on a cache miss.
+        :param max_entries: the maximum number of embeddings kept in memory.
+                            The least recently used entries are evicted first.
+                            If None, the cache is unbounded.
+        :param cache_path: if specified, a file to load embeddings from (if it
+                           exists) and to write them to on save().
+        """
+        self.clip = clip
+        self.max_entries = max_entries
+        self.cache_path = cache_path
+        self.hits = 0
+        self.misses = 0
+        self._entries: "OrderedDict[str, torch.Tensor]" = OrderedDict()
+        if cache_path is not None and os.path.exists(cache_path):
+            self.load(cache_path)
+
+    @property
+    def clip_name(self) -> str:
+        model = self.clip.model if isinstance(self.clip, FrozenImageCLIP) else self.clip
+        return model.clip_name
+
+    @property
+    def device(self) -> torch.device:
+        model = self.clip.model if isinstance(self.clip, FrozenImageCLIP) else self.clip
+        return model.device
+
+    @staticmethod
+    def key(text: str) -> str:
+        return hashlib.sha1(text.encode("utf-8")).hexdigest()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def embed(self, texts: Iterable[str]) -> torch.Tensor:
+        """
+        Embed a batch of captions, encoding only the ones not already cached.
+
+        :param texts: N caption strings.
+        :return: an [N x D] tensor of normalized CLIP text embeddings, which
+                 can be passed to the model as `embeddings=`.
+        """
+        texts = list(texts)
+        keys = [self.key(text) for text in texts]
+        missing: Dict[str, str] = {}
+        for key, text in zip(keys, texts):
+            if key in self._entries:
+                self._entries.move_to_end(key)
+            elif key not in missing:
+                missing[key] = text
+        self.misses += len(missing)
+        self.hits += len(keys) - len(missing)
+
+        new_entries: Dict[str, torch.Tensor] = {}
+        if len(missing):
+            embs = self.clip.embed_text(list(missing.values()))
+            new_entries = dict(zip(missing.keys(), embs))
+
+        # Gather before inserting, so that evicting to make room for new
+        # entries can never drop an embedding this batch still needs.
+        result = torch.stack(
+            [new_entries[key] if key in new_entries else self._entries[key] for key in keys],
+            dim=0,
+        )
+        for key, emb in new_entries.items():
+            self._entries[key] = emb
+        self._evict()
+        return result
+
+    def load(self, path: str):
+        obj = torch.load(path, map_location="cpu")
+        if obj["clip_name"] != self.clip_name:
+            raise ValueError(
+                f"text embedding cache {path} was built with {obj['clip_name']}, "
+                f"not {self.clip_name}"
+            )
+        for key, emb in zip(obj["keys"], obj["embeddings"].to(self.device)):
+            self._entries[key] = emb
+        self._evict()
+
+    def save(self, path: Optional[str] = None):
+        """
+        Atomically write every cached embedding to path (or cache_path).
+        """
+        path = path or self.cache_path
+        assert path is not None, "must specify a path to save the cache to"
+        if not len(self._entries):
+            return
+        dirname = os.path.dirname(os.path.abspath(path))
+        os.makedirs(dirname, exist_ok=True)
+        keys: List[str] = list(self._entries.keys())
+        embeddings = torch.stack([self._entries[key] for key in keys], dim=0).cpu()
+        with FileLock(path + ".lock"):
+            tmp_path = path + ".tmp"
+            torch.save(
+                dict(clip_name=self.clip_name, keys=keys, embeddings=embeddings),
+                tmp_path,
+            )
+            os.replace(tmp_path, path)
+
+    def _evict(self):
+        if self.max_entries is None:
+            return
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
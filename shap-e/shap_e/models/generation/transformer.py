@@ -1,8 +1,10 @@
 import math
+from contextlib import contextmanager
 from typing import Any, Dict, Iterable, List, Optional, Sequence, Tuple
 
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
 
 from shap_e.models.nn.checkpoint import checkpoint
 
@@ -16,6 +18,64 @@ def init_linear(l, stddev):
         nn.init.constant_(l.bias, 0.0)
 
 
+ATTENTION_BACKENDS = ("einsum", "sdpa")
+_attention_backend = "einsum"
+
+
+def set_attention_backend(backend: str):
+    """
+    Select how QKVMultiheadAttention and QKVMultiheadCrossAttention compute
+    attention.
+
+    "einsum" materializes the full [N x H x T x S] attention weights and
+    applies a float32 softmax. "sdpa" uses scaled_dot_product_attention(),
+    which dispatches to fused flash or memory-efficient kernels where they
+    are available, and never materializes the weights on those kernels.
+    """
+    global _attention_backend
+    if backend not in ATTENTION_BACKENDS:
+        raise ValueError(f"unknown attention backend {backend}, expected one of {ATTENTION_BACKENDS}")
+    _attention_backend = backend
+
+
+def get_attention_backend() -> str:
+    return _attention_backend
+
+
+@contextmanager
+def attention_backend(backend: str):
+    previous = get_attention_backend()
+    set_attention_backend(backend)
+    try:
+        yield
+    finally:
+        set_attention_backend(previous)
+
+
+def qkv_attention(q: torch.Tensor, k: torch.Tensor, v: torch.Tensor) -> torch.Tensor:
+    """
+    Compute multi-head attention with the selected backend.
+
+    :param q: an [N x T x H x C] tensor of queries.
+    :param k: an [N x S x H x C] tensor of keys.
+    :param v: an [N x S x H x C] tensor of values.
+    :return: an [N x T x (H * C)] tensor.
+    """
+    bs, n_ctx, _, attn_ch = q.shape
+    if _attention_backend == "sdpa":
+        out = F.scaled_dot_product_attention(
+            q.transpose(1, 2), k.transpose(1, 2), v.transpose(1, 2), scale=1 / math.sqrt(attn_ch)
+        )
+        return out.transpose(1, 2).reshape(bs, n_ctx, -1)
+    scale = 1 / math.sqrt(math.sqrt(attn_ch))
+    weight = torch.einsum(
+        "bthc,bshc->bhts", q * scale, k * scale
+    )  # More stable with f16 than dividing afterwards
+    wdtype = weight.dtype
+    weight = torch.softmax(weight.float(), dim=-1).type(wdtype)
+    return torch.einsum("bhts,bshc->bthc", weight, v).reshape(bs, n_ctx, -1)
+
+
 class MultiheadAttention(nn.Module):
     def __init__(
         self,
@@ -69,15 +129,9 @@ class QKVMultiheadAttention(nn.Module):
     def forward(self, qkv):
         bs, n_ctx, width = qkv.shape
         attn_ch = width // self.heads // 3
-        scale = 1 / math.sqrt(math.sqrt(attn_ch))
         qkv = qkv.view(bs, n_ctx, self.heads, -1)
         q, k, v = torch.split(qkv, attn_ch, dim=-1)
-        weight = torch.einsum(
-            "bthc,bshc->bhts", q * scale, k * scale
-        )  # More stable with f16 than dividing afterwards
-        wdtype = weight.dtype
-        weight = torch.softmax(weight.float(), dim=-1).type(wdtype)
-        return torch.einsum("bhts,bshc->bthc", weight, v).reshape(bs, n_ctx, -1)
+        return qkv_attention(q, k, v)
 
 
 class ResidualAttentionBlock(nn.Module):
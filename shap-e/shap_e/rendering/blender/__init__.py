@@ -1,4 +1,5 @@
 from .render import render_mesh, render_model
 from .view_data import BlenderViewData
+from .worker_pool import BlenderWorkerPool, set_worker_pool
 
-__all__ = ["BlenderViewData", "render_model"]
+__all__ = ["BlenderViewData", "render_model", "BlenderWorkerPool", "set_worker_pool"]
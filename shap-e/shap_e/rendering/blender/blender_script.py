@@ -10,7 +10,9 @@ import json
 import math
 import os
 import random
+import socket
 import sys
+import traceback
 
 import bpy
 from mathutils import Vector
@@ -627,15 +629,7 @@ def save_rendering_dataset(
         json.dump(info, f)
 
 
-def main():
-    global UNIFORM_LIGHT_DIRECTION, BASIC_AMBIENT_COLOR, BASIC_DIFFUSE_COLOR
-
-    try:
-        dash_index = sys.argv.index("--")
-    except ValueError as exc:
-        raise ValueError("arguments must be preceded by '--'") from exc
-
-    raw_args = sys.argv[dash_index + 1 :]
+def parse_args(raw_args):
     parser = argparse.ArgumentParser()
     parser.add_argument("--input_path", required=True, type=str)
     parser.add_argument("--output_path", required=True, type=str)
@@ -654,7 +648,11 @@ def main():
     parser.add_argument("--uniform_light_direction", required=True, type=float, nargs="+")
     parser.add_argument("--basic_ambient", required=True, type=float)
     parser.add_argument("--basic_diffuse", required=True, type=float)
-    args = parser.parse_args(raw_args)
+    return parser.parse_args(raw_args)
+
+
+def run_job(args):
+    global UNIFORM_LIGHT_DIRECTION, BASIC_AMBIENT_COLOR, BASIC_DIFFUSE_COLOR
 
     UNIFORM_LIGHT_DIRECTION = args.uniform_light_direction
     BASIC_AMBIENT_COLOR = args.basic_ambient
@@ -695,4 +693,58 @@ def main():
         )
 
 
+def resident_memory():
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        # peak instead of current memory where /proc is not available
+        import resource
+
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def serve(address):
+    """
+    Render jobs sent by worker_pool.py, one JSON line {"args": [...]} at a
+    time, answering each with {"ok", "error", "rss"}.
+    """
+    host, port = address.rsplit(":", 1)
+    conn = socket.create_connection((host, int(port)))
+    stream = conn.makefile("rw")
+
+    def send(**message):
+        stream.write(json.dumps(dict(message, rss=resident_memory())) + "\n")
+        stream.flush()
+
+    send(ok=True, error=None)
+    for line in stream:
+        job = json.loads(line)
+        if job.get("exit"):
+            break
+        # Start every job from the same state as a fresh Blender process, so
+        # that no objects, materials or images leak between jobs.
+        bpy.ops.wm.read_factory_settings(use_empty=False)
+        try:
+            run_job(parse_args(job["args"]))
+        except BaseException:
+            send(ok=False, error=traceback.format_exc())
+        else:
+            send(ok=True, error=None)
+    conn.close()
+
+
+def main():
+    try:
+        dash_index = sys.argv.index("--")
+    except ValueError as exc:
+        raise ValueError("arguments must be preceded by '--'") from exc
+
+    raw_args = sys.argv[dash_index + 1 :]
+    if raw_args[:1] == ["--worker_address"]:
+        serve(raw_args[1])
+    else:
+        run_job(parse_args(raw_args))
+
+
 main()
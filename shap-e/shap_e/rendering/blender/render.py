@@ -11,6 +11,7 @@ from PIL import Image
 from shap_e.rendering.mesh import TriMesh
 
 from .constants import BASIC_AMBIENT_COLOR, BASIC_DIFFUSE_COLOR, UNIFORM_LIGHT_DIRECTION
+from .worker_pool import get_worker_pool
 
 SCRIPT_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "blender_script.py")
 from IPython import embed
@@ -37,57 +38,59 @@ def render_model(
         tmp_out = os.path.join(tmp_dir, "out")
         zip_out = tmp_out + ".zip"
         os.mkdir(tmp_out)
-        args = []
-        if platform.system() == "Linux":
-            # Needed to enable Eevee backend on headless linux.
-            args = ["xvfb-run", "-a"]
-        args.extend(
-            [
-                _blender_binary_path(),
-                "-b",
-                "-P",
-                SCRIPT_PATH,
-                "--",
-                "--input_path",
-                tmp_in,
-                "--output_path",
-                tmp_out,
-                "--num_images",
-                str(num_images),
-                "--backend",
-                backend,
-                "--light_mode",
-                light_mode,
-                "--camera_pose",
-                camera_pose,
-                "--camera_dist_min",
-                str(camera_dist_min),
-                "--camera_dist_max",
-                str(camera_dist_max),
-                "--uniform_light_direction",
-                *[str(x) for x in UNIFORM_LIGHT_DIRECTION],
-                "--basic_ambient",
-                str(BASIC_AMBIENT_COLOR),
-                "--basic_diffuse",
-                str(BASIC_DIFFUSE_COLOR),
-            ]
-        )
+        script_args = [
+            "--input_path",
+            tmp_in,
+            "--output_path",
+            tmp_out,
+            "--num_images",
+            str(num_images),
+            "--backend",
+            backend,
+            "--light_mode",
+            light_mode,
+            "--camera_pose",
+            camera_pose,
+            "--camera_dist_min",
+            str(camera_dist_min),
+            "--camera_dist_max",
+            str(camera_dist_max),
+            "--uniform_light_direction",
+            *[str(x) for x in UNIFORM_LIGHT_DIRECTION],
+            "--basic_ambient",
+            str(BASIC_AMBIENT_COLOR),
+            "--basic_diffuse",
+            str(BASIC_DIFFUSE_COLOR),
+        ]
         if fast_mode:
-            args.append("--fast_mode")
+            script_args.append("--fast_mode")
         if extract_material:
-            args.append("--extract_material")
+            script_args.append("--extract_material")
         if delete_material:
-            args.append("--delete_material")
-        if verbose:
-            subprocess.check_call(args)
+            script_args.append("--delete_material")
+        output = None
+        pool = get_worker_pool()
+        if pool is not None:
+            # A long-lived Blender process renders the job, see worker_pool.py.
+            pool.render(script_args, timeout=timeout)
         else:
-            try:
-                output = subprocess.check_output(args, stderr=subprocess.STDOUT, timeout=timeout)
-            except subprocess.CalledProcessError as exc:
-                raise RuntimeError(f"{exc}: {exc.output}") from exc
+            args = []
+            if platform.system() == "Linux":
+                # Needed to enable Eevee backend on headless linux.
+                args = ["xvfb-run", "-a"]
+            args.extend([_blender_binary_path(), "-b", "-P", SCRIPT_PATH, "--", *script_args])
+            if verbose:
+                subprocess.check_call(args)
+            else:
+                try:
+                    output = subprocess.check_output(
+                        args, stderr=subprocess.STDOUT, timeout=timeout
+                    )
+                except subprocess.CalledProcessError as exc:
+                    raise RuntimeError(f"{exc}: {exc.output}") from exc
 
         if not os.path.exists(os.path.join(tmp_out, "info.json")):
-            if verbose:
+            if verbose or pool is not None:
                 # There is no output available, since it was
                 # logged directly to stdout/stderr.
                 raise RuntimeError(f"render failed: output file missing")
@@ -0,0 +1,267 @@
+"""
+A pool of long-lived Blender processes that render jobs for render_model().
+
+Starting xvfb-run and Blender takes several seconds per object. Instead, each
+worker runs blender_script.py in worker mode: it connects back to the pool
+over a local socket and renders one job per line of JSON it receives,
+resetting the scene to factory settings before every job. Workers are
+replaced after a fixed number of jobs, when their memory has grown too much,
+or when a job fails or times out.
+
+Enable it for render_model() by setting BLENDER_WORKERS to the number of
+workers, or explicitly with set_worker_pool().
+"""
+
+import atexit
+import json
+import os
+import platform
+import queue
+import signal
+import socket
+import subprocess
+import tempfile
+import threading
+from typing import List, Optional
+
+
+class WorkerError(RuntimeError):
+    pass
+
+
+class BlenderWorker:
+    def __init__(
+        self,
+        blender_path: str,
+        script_path: str,
+        log_dir: str,
+        start_timeout: float = 120.0,
+        verbose: bool = False,
+    ):
+        self.num_jobs = 0
+        self.listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.listener.bind(("127.0.0.1", 0))
+        self.listener.listen(1)
+        self.listener.settimeout(start_timeout)
+        address = "%s:%d" % self.listener.getsockname()
+
+        args = []
+        if platform.system() == "Linux":
+            # Needed to enable Eevee backend on headless linux.
+            args = ["xvfb-run", "-a"]
+        args.extend([blender_path, "-b", "-P", script_path, "--", "--worker_address", address])
+        if verbose:
+            self.log_path = None
+            output = None
+        else:
+            fd, self.log_path = tempfile.mkstemp(
+                prefix="blender_worker_", suffix=".log", dir=log_dir
+            )
+            output = os.fdopen(fd, "wb")
+        # A new session, so that xvfb-run and Blender can be killed together.
+        self.process = subprocess.Popen(
+            args, stdout=output, stderr=subprocess.STDOUT, start_new_session=True
+        )
+        if output is not None:
+            output.close()
+        try:
+            self.conn, _ = self.listener.accept()
+        except socket.timeout as exc:
+            self.fail("blender worker did not start", exc)
+        finally:
+            self.listener.close()
+        self.conn.settimeout(start_timeout)
+        self.stream = self.conn.makefile("rw")
+        self.initial_rss = self._receive()["rss"]
+        self.rss = self.initial_rss
+
+    def _receive(self) -> dict:
+        try:
+            line = self.stream.readline()
+        except socket.timeout as exc:
+            self.fail("blender worker timed out", exc)
+        except OSError as exc:
+            self.fail(f"blender worker failed: {exc}", exc)
+        if not line:
+            self.fail("blender worker exited")
+        return json.loads(line)
+
+    def fail(self, message: str, exc: Optional[BaseException] = None):
+        output = self.log_tail()
+        self.kill()
+        raise WorkerError(f"{message}. Output: {output}") from exc
+
+    def render(self, script_args: List[str], timeout: Optional[float] = None):
+        """
+        Render one job, given the arguments blender_script.py takes after '--'.
+        """
+        self.conn.settimeout(timeout)
+        self.stream.write(json.dumps({"args": script_args}) + "\n")
+        self.stream.flush()
+        result = self._receive()
+        self.num_jobs += 1
+        self.rss = result["rss"]
+        if not result["ok"]:
+            # The worker resets the scene before every job, so it can be reused.
+            raise RuntimeError(f"render failed: {result['error']}")
+
+    def log_tail(self, num_bytes: int = 4096) -> str:
+        if self.log_path is None:
+            return "(logged to stdout)"
+        with open(self.log_path, "rb") as f:
+            f.seek(max(0, os.path.getsize(self.log_path) - num_bytes))
+            return f.read().decode("utf-8", errors="replace")
+
+    def alive(self) -> bool:
+        return self.process.poll() is None
+
+    def close(self, timeout: float = 10.0):
+        try:
+            self.stream.write(json.dumps({"exit": True}) + "\n")
+            self.stream.flush()
+            self.process.wait(timeout)
+        except (OSError, subprocess.TimeoutExpired):
+            pass
+        self.kill()
+
+    def kill(self):
+        if self.alive():
+            try:
+                os.killpg(self.process.pid, signal.SIGKILL)
+            except ProcessLookupError:
+                pass
+            self.process.wait()
+        if self.log_path is not None and os.path.exists(self.log_path):
+            os.remove(self.log_path)
+            self.log_path = None
+
+
+class BlenderWorkerPool:
+    """
+    A thread-safe pool of Blender workers. Workers are started lazily, and
+    render() blocks until a worker is free.
+
+    :param num_workers: the maximum number of Blender processes.
+    :param max_jobs: replace a worker after this many jobs.
+    :param max_rss_growth: replace a worker when its resident memory has grown
+                           by this many bytes since it started.
+    """
+
+    def __init__(
+        self,
+        num_workers: int = 1,
+        max_jobs: int = 100,
+        max_rss_growth: int = 4 * 2**30,
+        blender_path: Optional[str] = None,
+        script_path: Optional[str] = None,
+        verbose: bool = False,
+    ):
+        from .render import SCRIPT_PATH, _blender_binary_path
+
+        self.num_workers = num_workers
+        self.max_jobs = max_jobs
+        self.max_rss_growth = max_rss_growth
+        self.blender_path = blender_path or _blender_binary_path()
+        self.script_path = script_path or SCRIPT_PATH
+        self.verbose = verbose
+        self.log_dir = tempfile.mkdtemp(prefix="blender_workers_")
+        self.idle = queue.LifoQueue()
+        self.slots = threading.Semaphore(num_workers)
+        self.lock = threading.Lock()
+        self.workers = set()
+        self.stats = dict(jobs=0, started=0, recycled=0, failed=0)
+
+    def _start_worker(self) -> BlenderWorker:
+        worker = BlenderWorker(
+            self.blender_path, self.script_path, self.log_dir, verbose=self.verbose
+        )
+        with self.lock:
+            self.workers.add(worker)
+            self.stats["started"] += 1
+        return worker
+
+    def _retire(self, worker: BlenderWorker, key: str):
+        worker.close()
+        with self.lock:
+            self.workers.discard(worker)
+            self.stats[key] += 1
+
+    def _release(self, worker: BlenderWorker):
+        if (
+            worker.num_jobs >= self.max_jobs
+            or worker.rss - worker.initial_rss > self.max_rss_growth
+            or not worker.alive()
+        ):
+            self._retire(worker, "recycled")
+        else:
+            self.idle.put(worker)
+
+    def render(self, script_args: List[str], timeout: Optional[float] = None):
+        self.slots.acquire()
+        try:
+            try:
+                worker = self.idle.get_nowait()
+            except queue.Empty:
+                worker = self._start_worker()
+            try:
+                worker.render(script_args, timeout=timeout)
+            except WorkerError:
+                # The worker died or timed out.
+                self._retire(worker, "failed")
+                raise
+            finally:
+                with self.lock:
+                    self.stats["jobs"] += 1
+                if worker in self.workers:
+                    self._release(worker)
+        finally:
+            self.slots.release()
+
+    def close(self):
+        with self.lock:
+            workers = list(self.workers)
+            self.workers.clear()
+        for worker in workers:
+            worker.close()
+        while not self.idle.empty():
+            self.idle.get_nowait()
+        if os.path.isdir(self.log_dir):
+            os.rmdir(self.log_dir)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        self.close()
+
+
+_POOL = None
+_POOL_LOCK = threading.Lock()
+
+
+def set_worker_pool(pool: Optional[BlenderWorkerPool]):
+    """
+    Make render_model() render through the given pool, or start a new Blender
+    process per call again if pool is None.
+    """
+    global _POOL
+    with _POOL_LOCK:
+        _POOL = pool
+
+
+def get_worker_pool() -> Optional[BlenderWorkerPool]:
+    """
+    Return the pool set with set_worker_pool(), or create one if the
+    BLENDER_WORKERS environment variable is set. BLENDER_WORKER_MAX_JOBS and
+    BLENDER_WORKER_MAX_RSS_GROWTH_MB tune recycling.
+    """
+    global _POOL
+    with _POOL_LOCK:
+        if _POOL is None and int(os.getenv("BLENDER_WORKERS", "0")) > 0:
+            _POOL = BlenderWorkerPool(
+                num_workers=int(os.environ["BLENDER_WORKERS"]),
+                max_jobs=int(os.getenv("BLENDER_WORKER_MAX_JOBS", "100")),
+                max_rss_growth=int(os.getenv("BLENDER_WORKER_MAX_RSS_GROWTH_MB", "4096")) * 2**20,
+            )
+            atexit.register(_POOL.close)
+        return _POOL
@@ -0,0 +1,304 @@
+"""
+A consolidated store for per-object DiffuRank view scores.
+
+Instead of one tiny pickle per object folder, scores are appended as
+fixed-size records to a handful of shard files in one directory:
+
+    <root>/meta.json       the record layout (number of views)
+    <root>/<name>.shard    append-only records (uid, scores, metadata)
+    <root>/index.npz       a snapshot of the uid -> record index
+
+Every writer appends to its own shard, so many scorer processes can write
+concurrently without coordinating. A record is written with a single
+O_APPEND write, and readers ignore a torn trailing record, so a crash never
+corrupts a shard. Readers memory-map the shards, keep a uid -> record index
+for O(1) lookups, and can load the scores of all objects as one array.
+If an object is scored more than once, the most recent record wins.
+"""
+
+import glob
+import json
+import os
+import pickle
+import time
+from typing import Iterable, Optional, Tuple
+
+import numpy as np
+from filelock import FileLock
+
+META_NAME = "meta.json"
+INDEX_NAME = "index.npz"
+SHARD_SUFFIX = ".shard"
+UID_BYTES = 64
+
+
+def record_dtype(num_views: int) -> np.dtype:
+    return np.dtype(
+        [
+            ("uid", f"S{UID_BYTES}"),
+            ("scores", "<f4", (num_views,)),
+            ("num_rows", "<i8"),  # model evaluations spent on the object
+            ("time", "<f8"),  # unix time at which the record was written
+        ]
+    )
+
+
+class ScoreStore:
+    """
+    Read access to a score store directory, and a factory for its writers.
+    """
+
+    def __init__(self, root: str, num_views: int = 28):
+        """
+        :param root: the store directory, created if it does not exist.
+        :param num_views: the number of scores per object. Must match the
+                          layout of an existing store.
+        """
+        self.root = root
+        os.makedirs(root, exist_ok=True)
+        meta_path = os.path.join(root, META_NAME)
+        with FileLock(meta_path + ".lock"):
+            if os.path.exists(meta_path):
+                with open(meta_path, "r") as f:
+                    meta = json.load(f)
+            else:
+                meta = dict(num_views=num_views, uid_bytes=UID_BYTES)
+                with open(meta_path + ".tmp", "w") as f:
+                    json.dump(meta, f)
+                os.replace(meta_path + ".tmp", meta_path)
+        if meta["num_views"] != num_views or meta["uid_bytes"] != UID_BYTES:
+            raise ValueError(f"store {root} has an incompatible layout: {meta}")
+        self.num_views = num_views
+        self.dtype = record_dtype(num_views)
+
+        self._shard_names = []  # shard id -> shard file name
+        self._shard_ids = {}  # shard file name -> shard id
+        self._shard_sizes = []  # shard id -> number of indexed records
+        self._maps = {}  # shard id -> memory map of the indexed records
+        self._index = {}  # uid -> (shard id, row, time)
+        self._load_index()
+        self.refresh()
+
+    def __len__(self) -> int:
+        return len(self._index)
+
+    def __contains__(self, uid: str) -> bool:
+        return uid in self._index
+
+    def get(self, uid: str) -> Optional[np.ndarray]:
+        """
+        Look up the scores of one object.
+
+        :return: a float32 array of shape [num_views], or None if the object
+                 has not been scored.
+        """
+        entry = self._index.get(uid)
+        if entry is None:
+            return None
+        shard_id, row, _ = entry
+        return np.array(self._map(shard_id)[row]["scores"])
+
+    def refresh(self) -> int:
+        """
+        Index records appended since the last refresh, including new shards.
+
+        :return: the number of newly indexed records.
+        """
+        num_new = 0
+        for path in sorted(glob.glob(os.path.join(self.root, "*" + SHARD_SUFFIX))):
+            name = os.path.basename(path)
+            if name not in self._shard_ids:
+                self._shard_ids[name] = len(self._shard_names)
+                self._shard_names.append(name)
+                self._shard_sizes.append(0)
+            shard_id = self._shard_ids[name]
+            start = self._shard_sizes[shard_id]
+            # A torn trailing record from a crashed writer is not counted.
+            stop = os.path.getsize(path) // self.dtype.itemsize
+            if stop <= start:
+                continue
+            records = np.memmap(
+                path,
+                dtype=self.dtype,
+                mode="r",
+                offset=start * self.dtype.itemsize,
+                shape=(stop - start,),
+            )
+            self._add(shard_id, start, records["uid"], records["time"])
+            self._shard_sizes[shard_id] = stop
+            self._maps.pop(shard_id, None)
+            num_new += stop - start
+        return num_new
+
+    def uids(self) -> np.ndarray:
+        return np.array(sorted(self._index), dtype=object)
+
+    def arrays(self, uids: Optional[Iterable[str]] = None) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Gather the scores of many objects with one fancy index per shard.
+
+        :param uids: the objects to read, all of which must be in the store.
+                     Defaults to every object, sorted by uid.
+        :return: a tuple (uids, scores) of an [N] uid array and an
+                 [N x num_views] float32 array.
+        """
+        uids = self.uids() if uids is None else np.array(list(uids), dtype=object)
+        entries = np.array([self._index[uid][:2] for uid in uids], dtype=np.int64)
+        scores = np.empty((len(uids), self.num_views), dtype=np.float32)
+        if len(uids):
+            for shard_id in np.unique(entries[:, 0]):
+                mask = entries[:, 0] == shard_id
+                scores[mask] = self._map(shard_id)["scores"][entries[mask, 1]]
+        return uids, scores
+
+    def top_k(self, k: int, uids: Optional[Iterable[str]] = None) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Select the k best (lowest scoring) views of every object.
+
+        :return: a tuple (uids, views) of an [N] uid array and an [N x k]
+                 array of view indices, best view first.
+        """
+        uids, scores = self.arrays(uids)
+        return uids, np.argsort(scores, axis=1, kind="stable")[:, :k]
+
+    def writer(self, name: str) -> "ScoreWriter":
+        return ScoreWriter(self, name)
+
+    def save_index(self):
+        """
+        Snapshot the index, so that the next reader only has to scan the
+        records appended after this point.
+        """
+        uids = np.array([uid.encode("utf-8") for uid in self._index], dtype=f"S{UID_BYTES}")
+        entries = np.array(list(self._index.values()), dtype=np.float64).reshape(-1, 3)
+        path = os.path.join(self.root, INDEX_NAME)
+        with FileLock(path + ".lock"):
+            with open(path + ".tmp", "wb") as f:
+                np.savez(
+                    f,
+                    shard_names=np.array(self._shard_names, dtype=str),
+                    shard_sizes=np.array(self._shard_sizes, dtype=np.int64),
+                    uids=uids,
+                    shard_ids=entries[:, 0].astype(np.int64),
+                    rows=entries[:, 1].astype(np.int64),
+                    times=entries[:, 2],
+                )
+            os.replace(path + ".tmp", path)
+
+    def _load_index(self):
+        path = os.path.join(self.root, INDEX_NAME)
+        if not os.path.exists(path):
+            return
+        with np.load(path) as snapshot:
+            self._shard_names = [str(name) for name in snapshot["shard_names"]]
+            self._shard_sizes = [int(x) for x in snapshot["shard_sizes"]]
+            self._shard_ids = {name: i for i, name in enumerate(self._shard_names)}
+            uids, shard_ids, rows, times = (
+                snapshot["uids"],
+                snapshot["shard_ids"],
+                snapshot["rows"],
+                snapshot["times"],
+            )
+        self._index = {
+            uid.decode("utf-8"): (int(shard_id), int(row), float(t))
+            for uid, shard_id, row, t in zip(uids, shard_ids, rows, times)
+        }
+
+    def _add(self, shard_id: int, start: int, uids: np.ndarray, times: np.ndarray):
+        for row, (uid, t) in enumerate(zip(uids.tolist(), times.tolist()), start=start):
+            uid = uid.decode("utf-8")
+            previous = self._index.get(uid)
+            if previous is None or t >= previous[2]:
+                self._index[uid] = (shard_id, row, t)
+
+    def _map(self, shard_id: int) -> np.memmap:
+        if shard_id not in self._maps:
+            path = os.path.join(self.root, self._shard_names[shard_id])
+            self._maps[shard_id] = np.memmap(
+                path, dtype=self.dtype, mode="r", shape=(self._shard_sizes[shard_id],)
+            )
+        return self._maps[shard_id]
+
+
+class ScoreWriter:
+    """
+    An exclusive appender to one shard of a ScoreStore.
+    """
+
+    def __init__(self, store: ScoreStore, name: str):
+        """
+        :param store: the store to write to.
+        :param name: the shard name, unique per concurrent writer, e.g. the
+                     host name and worker rank.
+        """
+        self.store = store
+        self.path = os.path.join(store.root, name.replace("/", "_") + SHARD_SUFFIX)
+        # Shards have a single writer; the lock turns a misconfiguration
+        # (two workers with the same name) into an error instead of
+        # interleaved records.
+        self._lock = FileLock(self.path + ".lock")
+        self._lock.acquire(timeout=0)
+        try:
+            # Drop a torn record left behind by a previous writer that crashed.
+            if os.path.exists(self.path):
+                size = os.path.getsize(self.path)
+                if size % store.dtype.itemsize:
+                    os.truncate(self.path, size - size % store.dtype.itemsize)
+            self._fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        except BaseException:
+            self._lock.release()
+            raise
+
+    def append(self, uid: str, scores: np.ndarray, num_rows: int = 0):
+        """
+        Append the scores of one object with a single write.
+        """
+        encoded = uid.encode("utf-8")
+        if len(encoded) > UID_BYTES:
+            raise ValueError(f"uid longer than {UID_BYTES} bytes: {uid}")
+        record = np.zeros((), dtype=self.store.dtype)
+        record["uid"] = encoded
+        record["scores"] = np.asarray(scores, dtype=np.float32).reshape(self.store.num_views)
+        record["num_rows"] = num_rows
+        record["time"] = time.time()
+        os.write(self._fd, record.tobytes())
+
+    def flush(self):
+        os.fsync(self._fd)
+
+    def close(self):
+        if self._fd is None:
+            return
+        os.fsync(self._fd)
+        os.close(self._fd)
+        self._fd = None
+        self._lock.release()
+
+    def __enter__(self) -> "ScoreWriter":
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def migrate_pickles(store: ScoreStore, image_dir: str, writer_name: str = "migrated") -> int:
+    """
+    Import per-folder diffurank_scores.pkl files into a store.
+
+    :param image_dir: a directory with one folder per object uid.
+    :return: the number of imported objects. Objects already in the store
+             are skipped, so the migration can be resumed.
+    """
+    num_imported = 0
+    with store.writer(writer_name) as writer:
+        for path in sorted(glob.glob(os.path.join(image_dir, "*", "diffurank_scores.pkl"))):
+            uid = path.split("/")[-2]
+            if uid in store:
+                continue
+            with open(path, "rb") as f:
+                scores = pickle.load(f)
+            writer.append(uid, np.asarray(scores))
+            num_imported += 1
+    store.refresh()
+    store.save_index()
+    return num_imported
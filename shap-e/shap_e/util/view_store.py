@@ -0,0 +1,325 @@
+"""
+Packed per-object render outputs.
+
+Rendering writes about a hundred small files per object into
+Cap3D_imgs/<uid>/: RGBA, depth and MatAlpha PNGs and a JSON per view. A view
+store instead keeps one container per object, plus an index of all packed
+objects:
+
+    <root>/objects/<uid[:2]>/<uid>.zip   the files of one object folder
+    <root>/index/<name>.jsonl            one line per packed object
+
+Containers are zip files with the same member names as the object folder,
+which is the layout BlenderViewData reads. Members are stored without
+compression (PNGs are compressed already), so a single view is read with
+one seek into the container, without extracting anything.
+
+Every packer appends to its own index shard, so render processes can pack
+objects concurrently. An index line is written with a single O_APPEND write
+after the container is complete, and readers ignore a torn trailing line.
+If an object is packed more than once, the most recent line wins. The
+index lists the member names of every container, so readers can tell which
+views exist without touching the file system.
+
+This module only uses the standard library, so that Blender's Python can
+pack objects right after rendering them.
+"""
+
+import json
+import os
+import shutil
+import socket
+import time
+import zipfile
+from typing import Dict, Iterable, List, Optional
+
+INDEX_DIR = "index"
+OBJECTS_DIR = "objects"
+INDEX_SUFFIX = ".jsonl"
+
+
+def container_name(uid: str) -> str:
+    return os.path.join(OBJECTS_DIR, uid[:2], uid + ".zip")
+
+
+def pack_folder(folder: str, path: str) -> List[str]:
+    """
+    Pack the files of an object folder into a container.
+
+    :param folder: a folder of render outputs, e.g. Cap3D_imgs/<uid>.
+    :param path: the container to write. It is written under a temporary name
+                 and renamed once complete.
+    :return: the member names, in the order they were written.
+    """
+    names = sorted(
+        name for name in os.listdir(folder) if os.path.isfile(os.path.join(folder, name))
+    )
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path + ".tmp", "wb") as f:
+        with zipfile.ZipFile(f, "w", compression=zipfile.ZIP_STORED) as zf:
+            for name in names:
+                zf.write(os.path.join(folder, name), arcname=name)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(path + ".tmp", path)
+    return names
+
+
+class PackedObject:
+    """
+    Random access to the members of one container.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.zipfile = zipfile.ZipFile(path, mode="r")
+
+    def names(self) -> List[str]:
+        return self.zipfile.namelist()
+
+    def __contains__(self, name: str) -> bool:
+        try:
+            self.zipfile.getinfo(name)
+        except KeyError:
+            return False
+        return True
+
+    def open(self, name: str):
+        return self.zipfile.open(name, "r")
+
+    def read(self, name: str) -> bytes:
+        return self.zipfile.read(name)
+
+    def close(self):
+        self.zipfile.close()
+
+    def __enter__(self) -> "PackedObject":
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class ViewStore:
+    """
+    Read access to a view store directory, and a factory for its writers.
+    Reading members opens the container for each call, so a store can be
+    shared by threads.
+    """
+
+    def __init__(self, root: str):
+        """
+        :param root: the store directory, created if it does not exist.
+        """
+        self.root = root
+        os.makedirs(os.path.join(root, INDEX_DIR), exist_ok=True)
+        self._offsets = {}  # index shard path -> bytes indexed
+        self._index = {}  # uid -> index entry
+        self.refresh()
+
+    def __len__(self) -> int:
+        return len(self._index)
+
+    def __contains__(self, uid: str) -> bool:
+        return uid in self._index
+
+    def refresh(self) -> int:
+        """
+        Index the lines appended to the index shards since the last refresh.
+
+        :return: the number of new lines.
+        """
+        num_new = 0
+        index_dir = os.path.join(self.root, INDEX_DIR)
+        for name in sorted(os.listdir(index_dir)):
+            if not name.endswith(INDEX_SUFFIX):
+                continue
+            path = os.path.join(index_dir, name)
+            with open(path, "rb") as f:
+                f.seek(self._offsets.get(path, 0))
+                data = f.read()
+            # A torn trailing line from a crashed writer is read again later.
+            end = data.rfind(b"\n") + 1
+            for line in data[:end].splitlines():
+                entry = json.loads(line)
+                previous = self._index.get(entry["uid"])
+                if previous is None or entry["time"] >= previous["time"]:
+                    self._index[entry["uid"]] = entry
+                num_new += 1
+            self._offsets[path] = self._offsets.get(path, 0) + end
+        return num_new
+
+    def uids(self) -> List[str]:
+        return sorted(self._index)
+
+    def names(self, uid: str) -> List[str]:
+        """
+        The member names of an object's container, read from the index.
+        """
+        return self._index[uid]["names"]
+
+    def has(self, uid: str, name: str) -> bool:
+        entry = self._index.get(uid)
+        return entry is not None and name in entry["names"]
+
+    def path(self, uid: str) -> str:
+        return os.path.join(self.root, self._index[uid]["path"])
+
+    def open(self, uid: str) -> PackedObject:
+        return PackedObject(self.path(uid))
+
+    def read(self, uid: str, names: Iterable[str]) -> List[bytes]:
+        """
+        Read several members of one object, opening its container once.
+        """
+        with self.open(uid) as obj:
+            return [obj.read(name) for name in names]
+
+    def writer(self, name: Optional[str] = None) -> "ViewStoreWriter":
+        return ViewStoreWriter(self, name)
+
+
+def list_objects(image_dir: str, store: Optional[ViewStore] = None) -> List[str]:
+    """
+    List the objects of a render output directory and its store.
+
+    :param image_dir: a directory with one folder per object uid, e.g.
+                      Cap3D_imgs. Folders that are not packed yet, such as
+                      objects rendered after the last pack, are listed too.
+    :param store: the store the folders are packed into, if any.
+    :return: the sorted uids of the packed objects and the object folders.
+    """
+    uids = set(store.uids()) if store is not None else set()
+    if os.path.isdir(image_dir):
+        uids.update(
+            name for name in os.listdir(image_dir) if os.path.isdir(os.path.join(image_dir, name))
+        )
+    return sorted(uids)
+
+
+class ViewStoreWriter:
+    """
+    An exclusive appender to one shard of a ViewStore's index.
+    """
+
+    def __init__(self, store: ViewStore, name: Optional[str] = None):
+        """
+        :param store: the store to write to.
+        :param name: the index shard name, unique per concurrent writer.
+                     Defaults to the host name and process id.
+        """
+        if name is None:
+            name = f"{socket.gethostname()}_{os.getpid()}"
+        self.store = store
+        self.path = os.path.join(store.root, INDEX_DIR, name.replace("/", "_") + INDEX_SUFFIX)
+        # Drop a torn line left behind by a previous writer that crashed.
+        if os.path.exists(self.path):
+            with open(self.path, "rb") as f:
+                data = f.read()
+            if not data.endswith(b"\n"):
+                os.truncate(self.path, data.rfind(b"\n") + 1)
+        self._fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+
+    def add(self, uid: str, names: List[str]):
+        """
+        Index the container of an object with a single write.
+        """
+        entry = dict(uid=uid, path=container_name(uid), names=names, time=time.time())
+        os.write(self._fd, (json.dumps(entry) + "\n").encode("utf-8"))
+
+    def pack(self, uid: str, folder: str, delete: bool = False) -> str:
+        """
+        Pack an object folder into the store and index it.
+
+        :param delete: remove the folder once the container is indexed.
+        :return: the path of the container.
+        """
+        path = os.path.join(self.store.root, container_name(uid))
+        names = pack_folder(folder, path)
+        self.add(uid, names)
+        if delete:
+            os.fsync(self._fd)
+            shutil.rmtree(folder)
+        return path
+
+    def flush(self):
+        os.fsync(self._fd)
+
+    def close(self):
+        if self._fd is None:
+            return
+        os.fsync(self._fd)
+        os.close(self._fd)
+        self._fd = None
+
+    def __enter__(self) -> "ViewStoreWriter":
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def _is_packed(store: ViewStore, uid: str, folder: str, keep: Iterable[str]) -> bool:
+    """
+    Check if the render outputs in an object folder are in the store already,
+    i.e. the container holds all of them and was written after them.
+    """
+    names = [
+        name
+        for name in os.listdir(folder)
+        if name not in keep and os.path.isfile(os.path.join(folder, name))
+    ]
+    if not names:
+        # only files that stay after packing, such as caption.pkl
+        return True
+    if uid not in store or not set(names).issubset(store.names(uid)):
+        return False
+    try:
+        packed_time = os.path.getmtime(store.path(uid))
+    except OSError:
+        return False
+    return all(os.path.getmtime(os.path.join(folder, name)) <= packed_time for name in names)
+
+
+def pack_folders(
+    store: ViewStore,
+    image_dir: str,
+    writer_name: str = "packed",
+    delete: bool = False,
+    keep: Iterable[str] = (),
+) -> Dict[str, int]:
+    """
+    Pack the object folders of a render output directory into a store.
+
+    :param image_dir: a directory with one folder per object uid.
+    :param delete: remove the files of each folder once they are packed.
+                   Files named in keep stay in the folder.
+    :param keep: files that later stages write next to the views, such as
+                 caption.pkl; they are packed but not deleted.
+    :return: counts of packed and skipped objects. Folders whose files are
+             all in their container, which is newer than them, are skipped,
+             so packing can be interrupted and resumed. Folders that were
+             rendered again, or rendered further after they were packed,
+             are packed again, and their new index line wins.
+    """
+    keep = set(keep)
+    counts = dict(packed=0, skipped=0)
+    with store.writer(writer_name) as writer:
+        for uid in sorted(os.listdir(image_dir)):
+            folder = os.path.join(image_dir, uid)
+            if not os.path.isdir(folder):
+                continue
+            if _is_packed(store, uid, folder, keep):
+                counts["skipped"] += 1
+            else:
+                writer.pack(uid, folder)
+                counts["packed"] += 1
+            if delete:
+                writer.flush()
+                for name in os.listdir(folder):
+                    if name not in keep:
+                        os.remove(os.path.join(folder, name))
+                if not os.listdir(folder):
+                    os.rmdir(folder)
+    store.refresh()
+    return counts
@@ -0,0 +1,114 @@
+"""
+A minimal file-based work queue for running one scoring job per object across
+several processes (or hosts sharing a filesystem).
+
+Objects are assigned to shards deterministically by a hash of their uid, and
+a worker claims an object by atomically creating a lease file next to its
+output. Leases that have not been renewed within their time-to-live are
+treated as abandoned by a crashed worker and may be taken over.
+"""
+
+import hashlib
+import os
+import socket
+import time
+from typing import Optional
+
+
+def shard_of(uid: str, num_shards: int) -> int:
+    """
+    Map a uid to a shard in [0, num_shards), stably across processes and runs.
+    """
+    return int(hashlib.sha1(uid.encode("utf-8")).hexdigest()[:8], 16) % num_shards
+
+
+def default_owner(rank: int) -> str:
+    return f"{socket.gethostname()}:{rank}"
+
+
+class Lease:
+    """
+    An exclusive, expiring claim on a unit of work, backed by a lease file.
+    """
+
+    def __init__(self, path: str, owner: str, ttl: float = 30 * 60):
+        """
+        :param path: the lease file to create.
+        :param owner: a string identifying the worker. A worker restarted
+                      with the same owner may reclaim its own leases at once.
+        :param ttl: seconds after the last renewal at which the lease is
+                    considered abandoned.
+        """
+        self.path = path
+        self.owner = owner
+        self.ttl = ttl
+        self.held = False
+
+    def acquire(self) -> bool:
+        """
+        Try to claim the lease, taking over an expired or self-owned one.
+
+        :return: True if this worker now holds the lease.
+        """
+        if self._try_create():
+            return True
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            # Released in the meantime.
+            return self._try_create()
+        holder = self._read_owner()
+        expired = time.time() - stat.st_mtime > self.ttl
+        if holder != self.owner and not expired:
+            return False
+        # Move the stale lease out of the way. Another worker may have taken
+        # it over, or its holder renewed it, since we looked at it. Then the
+        # moved file is not the one judged stale and is put back; os.link
+        # never replaces a lease created in the meantime.
+        stale_path = f"{self.path}.stale.{os.getpid()}.{time.time_ns()}"
+        try:
+            os.rename(self.path, stale_path)
+        except FileNotFoundError:
+            return False
+        moved = os.stat(stale_path)
+        if (moved.st_ino, moved.st_mtime_ns) != (stat.st_ino, stat.st_mtime_ns) or (
+            self._read_owner(stale_path) != holder
+        ):
+            try:
+                os.link(stale_path, self.path)
+            except FileExistsError:
+                pass
+            os.remove(stale_path)
+            return False
+        os.remove(stale_path)
+        return self._try_create()
+
+    def renew(self):
+        assert self.held, "cannot renew a lease that is not held"
+        os.utime(self.path)
+
+    def release(self):
+        if not self.held:
+            return
+        self.held = False
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
+
+    def _try_create(self) -> bool:
+        try:
+            fd = os.open(self.path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            return False
+        with os.fdopen(fd, "w") as f:
+            f.write(self.owner)
+        self.held = True
+        return True
+
+    def _read_owner(self, path: Optional[str] = None) -> Optional[str]:
+        try:
+            with open(path or self.path, "r") as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
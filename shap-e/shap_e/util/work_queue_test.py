@@ -0,0 +1,62 @@
+import os
+import time
+
+from .work_queue import Lease
+
+
+def _expired_lease(path: str, owner: str, ttl: float):
+    with open(path, "w") as f:
+        f.write(owner)
+    mtime = time.time() - 2 * ttl
+    os.utime(path, (mtime, mtime))
+
+
+def test_takeover_of_expired_lease(tmp_path):
+    path = str(tmp_path / "object.lease")
+    _expired_lease(path, "crashed", ttl=60)
+    lease = Lease(path, "a", ttl=60)
+    assert lease.acquire()
+    with open(path) as f:
+        assert f.read() == "a"
+    assert not Lease(path, "b", ttl=60).acquire()
+
+
+def test_concurrent_takeover_of_expired_lease(tmp_path, monkeypatch):
+    path = str(tmp_path / "object.lease")
+    _expired_lease(path, "crashed", ttl=60)
+    a = Lease(path, "a", ttl=60)
+    b = Lease(path, "b", ttl=60)
+
+    rename = os.rename
+
+    def rename_after_takeover(src, dst):
+        # b has judged the lease expired; a takes it over before b moves it.
+        monkeypatch.setattr(os, "rename", rename)
+        assert a.acquire()
+        rename(src, dst)
+
+    monkeypatch.setattr(os, "rename", rename_after_takeover)
+    assert not b.acquire()
+    assert a.held and not b.held
+    with open(path) as f:
+        assert f.read() == "a"
+    assert sorted(os.listdir(tmp_path)) == ["object.lease"]
+
+
+def test_lease_renewed_during_takeover(tmp_path, monkeypatch):
+    path = str(tmp_path / "object.lease")
+    _expired_lease(path, "slow", ttl=60)
+
+    rename = os.rename
+
+    def rename_after_renewal(src, dst):
+        # The holder renews the lease after b has judged it expired.
+        monkeypatch.setattr(os, "rename", rename)
+        os.utime(path)
+        rename(src, dst)
+
+    monkeypatch.setattr(os, "rename", rename_after_renewal)
+    assert not Lease(path, "b", ttl=60).acquire()
+    with open(path) as f:
+        assert f.read() == "slow"
+    assert sorted(os.listdir(tmp_path)) == ["object.lease"]
@@ -0,0 +1,101 @@
+# ==============================================================================
+# Shrink rendered views before they are sent to GPT in captioning_gpt.py.
+#
+# The renderer writes 512x512 RGBA PNGs. Sending them as they are makes every
+# request several MB. Views are instead composited onto an opaque
+# background, optionally downscaled, and encoded as JPEG or WebP, optionally
+# tiled into a single mosaic image.
+# ==============================================================================
+import base64
+import io
+import math
+
+from PIL import Image
+
+BACKGROUNDS = {
+    'white': (255, 255, 255),
+    'black': (0, 0, 0),
+    'gray': (128, 128, 128),
+}
+FORMATS = ['jpeg', 'webp', 'png', 'raw']
+
+
+def parse_background(value):
+    if value in BACKGROUNDS:
+        return BACKGROUNDS[value]
+    return tuple(int(x) for x in value.split(','))
+
+
+def load_view(path, background=(255, 255, 255), size=0):
+    """
+    Load one view as an RGB image, compositing transparent pixels onto the
+    background and shrinking it to at most size x size pixels.
+    """
+    image = Image.open(path)
+    if image.mode in ('RGBA', 'LA', 'PA') or 'transparency' in image.info:
+        image = image.convert('RGBA')
+        canvas = Image.new('RGBA', image.size, tuple(background) + (255,))
+        image = Image.alpha_composite(canvas, image)
+    image = image.convert('RGB')
+    if size:
+        image.thumbnail((size, size), Image.LANCZOS)
+    return image
+
+
+def make_mosaic(images, background=(255, 255, 255)):
+    """
+    Tile images of equal size into a grid with ceil(sqrt(N)) columns.
+    """
+    columns = math.ceil(math.sqrt(len(images)))
+    rows = math.ceil(len(images) / columns)
+    width, height = images[0].size
+    mosaic = Image.new('RGB', (columns * width, rows * height), tuple(background))
+    for i, image in enumerate(images):
+        mosaic.paste(image, ((i % columns) * width, (i // columns) * height))
+    return mosaic
+
+
+def encode(image, fmt='jpeg', quality=90):
+    buffer = io.BytesIO()
+    if fmt == 'jpeg':
+        image.save(buffer, format='JPEG', quality=quality, optimize=True)
+    elif fmt == 'webp':
+        image.save(buffer, format='WEBP', quality=quality, method=4)
+    else:
+        image.save(buffer, format='PNG', optimize=True)
+    return buffer.getvalue()
+
+
+def read_views(paths):
+    raw = []
+    for path in paths:
+        with open(path, 'rb') as f:
+            raw.append(f.read())
+    return raw
+
+
+def encode_views(paths, **kwargs):
+    """
+    Encode the view files of one object as data URLs, see encode_view_data().
+    """
+    return encode_view_data(read_views(paths), **kwargs)
+
+
+def encode_view_data(raw, fmt='jpeg', quality=90, size=512, background=(255, 255, 255), mosaic=False):
+    """
+    Encode the views of one object, given as the bytes of their files, as
+    data URLs.
+
+    :return: a tuple (urls, raw_bytes, encoded_bytes), where raw_bytes and
+             encoded_bytes are the total file sizes before and after.
+    """
+    raw_bytes = sum(len(data) for data in raw)
+    if fmt == 'raw':
+        encoded, mime = raw, 'png'
+    else:
+        images = [load_view(io.BytesIO(data), background=background, size=size) for data in raw]
+        if mosaic:
+            images = [make_mosaic(images, background=background)]
+        encoded, mime = [encode(image, fmt=fmt, quality=quality) for image in images], fmt
+    urls = ['data:image/%s;base64,%s' % (mime, base64.b64encode(data).decode('utf-8')) for data in encoded]
+    return urls, raw_bytes, sum(len(data) for data in encoded)